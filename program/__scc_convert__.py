@@ -5,6 +5,7 @@ Main algorithm for pre-processing the raw signals and retrieve the optical produ
 """
 import warnings, os, sys
 from readers.parse_config import parse_config
+from readers import read_licel
 from tools import process, automate
 
 # -f "/mnt/DATA/LRZ_Sync/CARS-LMU (Volker Freudenthaler)/data/EVE/20220617" -i EV -d --trim_overflows 3 -M R
@@ -16,55 +17,116 @@ from tools import process, automate
 # Ignores all warnings --> they are not printed in terminal
 warnings.filterwarnings('ignore')
 
-# def main(args):
-args = parse_config()
+def main(args):
 
-# Identify the measurement type (rayleigh , telecover, or polarization_calibration)    
-meas_type = automate.get_meas_type(args)
-     
-# In[1]
-#------------------------------------------------------------
-# A) Read and pre-process the signals
-#------------------------------------------------------------
-allowed_types = ['rayleigh', 'telecover', 
-                 'polarization_calibration', 'standalone_dark'] 
-
-processors = {'rayleigh' : process.rayleigh,
-              'telecover' : process.telecover,
-              'polarization_calibration' : process.polarization_calibration,
-              'standalone_dark' : process.dark}
-
-modes = {'rayleigh' : 'R',
-         'telecover' : 'T',
-         'polarization_calibration' : 'C',
-         'standalone_dark' : 'D'}
-
-fnames = dict()
-# Call all the processors sequentially
-for mtype in allowed_types: 
+    # Identify the measurement type (rayleigh , telecover, or polarization_calibration)    
+    meas_type = automate.get_meas_type(args)
+         
+    # In[1]
+    #------------------------------------------------------------
+    # A) Read and pre-process the signals
+    #------------------------------------------------------------
+    allowed_types = ['rayleigh', 'telecover', 
+                     'polarization_calibration', 'standalone_dark'] 
     
-    if mtype in meas_type and (args['mode'] == 'A' or args['mode'] == modes[mtype]):
+    processors = {'rayleigh' : process.rayleigh,
+                  'telecover' : process.telecover,
+                  'polarization_calibration' : process.polarization_calibration,
+                  'standalone_dark' : process.dark}
     
-        nc_fname = processors[mtype](args)
-        
-        if mtype == 'rayleigh':
-            args['rayleigh_filename'] = os.path.basename(nc_fname[0])
-            args['radiosonde_filename'] = os.path.basename(nc_fname[1])
-            fnames['rayleigh'] = nc_fname[0]
-            fnames['radiosonde'] = nc_fname[0]
-        else:
-            fnames[mtype] = nc_fname
+    modes = {'rayleigh' : 'R',
+             'telecover' : 'T',
+             'polarization_calibration' : 'C',
+             'standalone_dark' : 'D'}
     
-    elif mtype not in meas_type and args['mode'] == 'A':
-        print(f"--Warning: No {mtype} files were processed!")
-        print("")
+    folders = {'rayleigh' : [args['rayleigh_folder']],
+               'telecover' : [args['telecover_sectors_folder'], 
+                              args['telecover_rings_folder']],
+               'polarization_calibration' : [args['pol_cal_stc_folder'], 
+                                             args['pol_cal_p45_folder'], 
+                                             args['pol_cal_m45_folder']],
+               'standalone_dark' : [args['dark_folder']]}
+    
+    fnames = dict()
+    # Call all the processors sequentially
+    try:
+        run_processors(args, meas_type, allowed_types, processors, modes, 
+                       folders, fnames)
+    finally:
+        # The overflow summary of the run is written once, also if a processor failed
+        automate.write_overflow_summary(os.path.join(args['results_folder'], 'overflows.json'))
         
-    elif mtype not in meas_type and args['mode'] == modes[mtype]:
-        raise Exception(f"--Error: No {mtype} folder was detected despite the provided mode ({modes[mtype]})!")
+        # The dark of the run is not reused by later runs
+        process.clear_darks()
+    
+    return(fnames)
 
-    # return(fnames)
+def run_processors(args, meas_type, allowed_types, processors, modes, folders,
+                   fnames):
+    
+    """ Calls the processors of the measurement types sequentially and 
+    adds the output filenames to fnames. With several layouts the radiosonde
+    file is created by the first rayleigh conversion and reused by the rest.
+    The polarization calibration of each layout refers to the rayleigh file
+    of the same layout, if there is one"""
+    
+    layout = args['layout']
+    
+    # Rayleigh filename per layout
+    rayleigh_fnames = dict()
+    
+    for mtype in allowed_types: 
+        
+        if mtype in meas_type and (args['mode'] == 'A' or args['mode'] == modes[mtype]):
+            
+            # One conversion per channel layout of the raw files
+            if args['split_layouts']:
+                layouts = read_licel.find_layouts(folders[mtype], 
+                                                  mcode = args['measurement_identifier'],
+                                                  workers = args['workers'])
+            
+            if not args['split_layouts'] or len(layouts) == 0:
+                layouts = [layout]
+            
+            for layout_i in layouts:
+                
+                args['layout'] = layout_i
+                
+                label = mtype if len(layouts) == 1 else f'{mtype}_{layout_i}'
+                
+                if mtype == 'polarization_calibration' and layout_i in rayleigh_fnames.keys():
+                    args['rayleigh_filename'] = rayleigh_fnames[layout_i]
+        
+                nc_fname = processors[mtype](args)
+            
+                if mtype == 'rayleigh':
+                    rayleigh_fnames[layout_i] = os.path.basename(nc_fname[0])
+                    fnames[label] = nc_fname[0]
+                    # Only the first rayleigh conversion creates the radiosonde file
+                    if nc_fname[1] != None:
+                        args['radiosonde_filename'] = os.path.basename(nc_fname[1])
+                        fnames[label.replace('rayleigh', 'radiosonde')] = nc_fname[1]
+                else:
+                    fnames[label] = nc_fname
+            
+            # The first rayleigh file is used by the processors without a rayleigh file of their layout
+            if mtype == 'rayleigh':
+                args['rayleigh_filename'] = rayleigh_fnames[layouts[0]]
+            
+            args['layout'] = layout
+        
+        elif mtype not in meas_type and args['mode'] == 'A':
+            print(f"--Warning: No {mtype} files were processed!")
+            print("")
+            
+        elif mtype not in meas_type and args['mode'] == modes[mtype]:
+            raise Exception(f"--Error: No {mtype} folder was detected despite the provided mode ({modes[mtype]})!")
+    
+    return(fnames)
 
-# if __name__ == '__main__':
-#     # Get the command line argument information
-#     args = parse_config()
-#     main(args)
+# The main guard is needed when the files are decoded in a process pool 
+# (--executor process) so that the workers do not re-run the conversion
+if __name__ == '__main__':
+    # Get the command line argument information
+    args = parse_config()
+    main(args)
@@ -1 +1 @@
-__all__ = ["parse_config", "read_config", "read_licel", "read_polly", "read_rayleigh", "read_files"]
+__all__ = ["parse_config", "read_config", "read_licel", "read_polly", "read_rayleigh", "read_files", "cache", "archive", "catalog"]
@@ -0,0 +1,355 @@
+"""
+@author: N. Siomos
+
+Access to raw files stored in zip or tar (.tar, .tar.gz, .tgz, .tar.bz2,
+.tar.xz) archives without extracting them. A path inside an archive is
+written as a normal path that goes through the archive file, e.g.:
+/data/20220617.tar.gz/drk/ID22617.0000
+The functions exists, listdir, glob, walk, and getsize mirror the os and
+glob functions used by the readers and accept both normal paths and paths
+inside archives. If all the members of an archive are stored under a single
+top folder (e.g. 20220617/drk/...), the top folder is skipped, unless it is
+one of the measurement folders (e.g. drk/...).
+"""
+import os, glob as glob_, fnmatch, tarfile, zipfile, threading, queue
+from functools import lru_cache
+
+extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+              '.tar.xz', '.txz')
+
+# Default measurement folders (see parse_config), never skipped as top folders
+measurement_folders = ('drk', 'nrm', 'tlc', 'pcl', 'rs')
+
+# Archive indexes and open zip files, shared by all threads
+_index = dict()
+_zips = dict()
+_lock = threading.Lock()
+
+def is_archive(path):
+
+    """ Returns True if the path is a zip or tar archive file"""
+
+    return(path.lower().endswith(extensions) and os.path.isfile(path))
+
+@lru_cache(maxsize = None)
+def split(path):
+
+    """ Splits a path in the archive file and the member path inside it
+    (with / separators). Returns (None, path) if the path does not go
+    through an archive"""
+
+    head = os.path.normpath(path)
+
+    tail = []
+
+    while True:
+
+        if is_archive(head):
+            return(head, '/'.join(reversed(tail)))
+
+        head_next, name = os.path.split(head)
+
+        if head_next == head or name == '':
+            return(None, path)
+
+        tail.append(name)
+
+        head = head_next
+
+def is_member(path):
+
+    """ Returns True if the path is inside an archive"""
+
+    return(split(path)[0] != None)
+
+def get_index(path_arc):
+
+    """ Returns the index of the archive, built once per archive with a
+    single pass over it. The index holds, per member file, the original
+    member name, the size, and the first few KB of the member (enough for
+    the licel header). It holds also the set of the member folders"""
+
+    key = (path_arc, os.stat(path_arc).st_mtime_ns)
+
+    with _lock:
+        if key not in _index.keys():
+            _index[key] = build_index(path_arc)
+
+        index = _index[key]
+
+    return(index)
+
+def build_index(path_arc, chunk = 4096):
+
+    """ Creates the archive index (see get_index). Compressed tar archives
+    are read as a stream"""
+
+    members = dict()
+
+    if zipfile.is_zipfile(path_arc):
+        with zipfile.ZipFile(path_arc) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        members[info.filename] = (info.file_size, f.read(chunk))
+
+    else:
+        with tarfile.open(path_arc, 'r|*') as tf:
+            for info in tf:
+                if info.isfile():
+                    with tf.extractfile(info) as f:
+                        members[info.name] = (info.size, f.read(chunk))
+
+    # Skip a common top folder, unless it is a measurement folder
+    roots = set([name.split('/')[0] for name in members.keys()])
+
+    if len(roots) == 1 and all(['/' in name for name in members.keys()]) and \
+        not roots.issubset(measurement_folders):
+        n_root = len(roots.pop()) + 1
+    else:
+        n_root = 0
+
+    files = {name[n_root:] : (name, size, head)
+             for name, (size, head) in members.items()}
+
+    dirs = set([''])
+    for name in files.keys():
+        parts = name.split('/')[:-1]
+        for k in range(len(parts)):
+            dirs.add('/'.join(parts[:k + 1]))
+
+    return({'files' : files, 'dirs' : dirs})
+
+def exists(path):
+
+    """ os.path.exists for paths inside archives"""
+
+    path_arc, member = split(path)
+
+    if path_arc == None:
+        return(os.path.exists(path))
+
+    index = get_index(path_arc)
+
+    return(member in index['files'].keys() or member in index['dirs'])
+
+def listdir(path):
+
+    """ os.listdir for paths inside archives"""
+
+    path_arc, member = split(path)
+
+    if path_arc == None:
+        return(os.listdir(path))
+
+    index = get_index(path_arc)
+
+    prefix = member + '/' if member != '' else ''
+
+    names = [name[len(prefix):].split('/')[0]
+             for name in list(index['files'].keys()) + list(index['dirs'])
+             if name.startswith(prefix) and name != member]
+
+    return(sorted(set(names)))
+
+def glob(path, pattern):
+
+    """ glob.glob(os.path.join(path, pattern)) for paths inside archives.
+    Only the files of the folder are matched"""
+
+    path_arc, member = split(path)
+
+    if path_arc == None:
+        return(glob_.glob(os.path.join(path, pattern)))
+
+    index = get_index(path_arc)
+
+    prefix = member + '/' if member != '' else ''
+
+    fnames = [os.path.join(path, name[len(prefix):]) for name in index['files'].keys()
+              if name.startswith(prefix) and '/' not in name[len(prefix):]
+              and fnmatch.fnmatch(name[len(prefix):], pattern)]
+
+    return(fnames)
+
+def walk(path):
+
+    """ os.walk for paths inside archives. Yields (folder, [], files) per
+    folder that contains files"""
+
+    path_arc, member = split(path)
+
+    if path_arc == None:
+        yield from os.walk(path)
+        return
+
+    index = get_index(path_arc)
+
+    prefix = member + '/' if member != '' else ''
+
+    folders = dict()
+
+    for name in index['files'].keys():
+        if name.startswith(prefix):
+            folder, _, fname = name[len(prefix):].rpartition('/')
+            folders.setdefault(folder, []).append(fname)
+
+    for folder, fnames in folders.items():
+        yield(os.path.join(path, *folder.split('/')), [], fnames)
+
+def getsize(path):
+
+    """ os.path.getsize for paths inside archives"""
+
+    path_arc, member = split(path)
+
+    if path_arc == None:
+        return(os.path.getsize(path))
+
+    return(get_index(path_arc)['files'][member][1])
+
+def read_head(path):
+
+    """ Returns the first few KB of an archive member from the index"""
+
+    path_arc, member = split(path)
+
+    return(get_index(path_arc)['files'][member][2])
+
+def read(path):
+
+    """ Reads a single archive member. Members of zip files and uncompressed
+    tar files are accessed directly. Compressed tar files are decompressed
+    up to the member, prefer read_members for many members"""
+
+    path_arc, member = split(path)
+
+    name = get_index(path_arc)['files'][member][0]
+
+    if zipfile.is_zipfile(path_arc):
+        with _lock:
+            if path_arc not in _zips.keys():
+                _zips[path_arc] = zipfile.ZipFile(path_arc)
+            buffer = _zips[path_arc].read(name)
+
+    else:
+        with tarfile.open(path_arc, 'r:*') as tf:
+            with tf.extractfile(name) as f:
+                buffer = f.read()
+
+    return(buffer)
+
+def read_members(paths, depth = 2, max_pending = 2**28):
+
+    """ Generator that yields (buffer, error) per archive member of paths, in
+    the order of paths. The members are decompressed in a background thread
+    at most depth members ahead, so that the decompression runs while the
+    previous members are decoded. Tar archives are read as a single stream,
+    members found earlier in the stream than their turn are kept in memory
+    until they are yielded, up to max_pending bytes. Beyond that the stream
+    stops and the rest of the members are read one by one (see read)"""
+
+    outputs = queue.Queue(maxsize = depth)
+
+    stop = threading.Event()
+
+    reader = threading.Thread(target = stream_members,
+                              args = (paths, outputs, stop, max_pending), 
+                              daemon = True)
+
+    reader.start()
+
+    try:
+        for k in range(len(paths)):
+            yield(outputs.get())
+    finally:
+        stop.set()
+
+def stream_members(paths, outputs, stop, max_pending = 2**28):
+
+    """ Puts the (buffer, error) pair of each member of paths in the outputs
+    queue, in the order of paths (see read_members)"""
+
+    def put(output):
+        while not stop.is_set():
+            try:
+                outputs.put(output, timeout = 0.1)
+                return(True)
+            except queue.Full:
+                continue
+        return(False)
+
+    def read_output(path):
+        try:
+            return((read(path), None))
+        except Exception as e:
+            return((None, repr(e)))
+
+    path_arc = split(paths[0])[0] if len(paths) > 0 else None
+
+    stream = path_arc != None and not zipfile.is_zipfile(path_arc) and \
+        all([split(path)[0] == path_arc for path in paths])
+
+    if not stream:
+        for path in paths:
+            if not put(read_output(path)):
+                return
+        return
+
+    files = get_index(path_arc)['files']
+
+    # Position of each member name in paths
+    positions = {files[split(path)[1]][0] : k for k, path in enumerate(paths)
+                 if split(path)[1] in files.keys()}
+
+    pending = dict()
+    
+    pending_size = 0
+
+    k_next = 0
+
+    try:
+        with tarfile.open(path_arc, 'r|*') as tf:
+            for info in tf:
+
+                if info.name not in positions.keys():
+                    continue
+
+                with tf.extractfile(info) as f:
+                    pending[positions[info.name]] = (f.read(), None)
+                
+                pending_size = pending_size + info.size
+
+                while k_next in pending.keys():
+                    output = pending.pop(k_next)
+                    pending_size = pending_size - len(output[0])
+                    if not put(output):
+                        return
+                    k_next = k_next + 1
+                
+                if pending_size > max_pending:
+                    break
+            
+            else:
+                error = 'Member not found in the archive'
+
+    except Exception as e:
+        error = repr(e)
+    
+    # The stream stopped early, the members that were not reached are read one by one
+    if pending_size > max_pending:
+        print('-- Warning: The archive members are stored out of order, the rest of the members are read one by one')
+        while k_next < len(paths):
+            output = pending.pop(k_next, None)
+            if output == None:
+                output = read_output(paths[k_next])
+            if not put(output):
+                return
+            k_next = k_next + 1
+        return
+
+    # Members that were not found or not reached
+    while k_next < len(paths):
+        if not put(pending.pop(k_next, (None, error))):
+            return
+        k_next = k_next + 1
@@ -0,0 +1,124 @@
+"""
+@author: N. Siomos
+
+Persistent on-disk cache of the decoded raw files. Each entry corresponds
+to a single raw file and is keyed by the file path, size, and modification
+time so that a modified raw file never hits a stale entry. The least
+recently used entries are evicted when the cache exceeds its size limit.
+"""
+import os, hashlib, threading
+import numpy as np
+from readers import archive
+
+def entry_path(cache_dir, fname):
+
+    """ Returns the path of the cache entry of a raw file. The key is made
+    out of the absolute path, the size, and the modification time. For
+    files inside archives the size and the modification time are the ones
+    of the archive"""
+
+    path_arc, member = archive.split(fname)
+
+    stat = os.stat(fname if path_arc == None else path_arc)
+
+    key = f'{os.path.abspath(fname)}|{stat.st_size}|{stat.st_mtime_ns}'
+
+    path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    return(path)
+
+def load(cache_dir, fname, nread):
+
+    """ Loads the decoded file [start time, end time, shots, data blocks]
+    from the cache. Returns None if there is no valid entry for the
+    file or if the entry was decoded with a different selection of 
+    channels and bins (nread)"""
+
+    path = entry_path(cache_dir, fname)
+
+    if not os.path.exists(path):
+        return(None)
+
+    try:
+        with np.load(path) as entry:
+            if not np.array_equal(entry['nread'], nread):
+                return(None)
+            bins = entry['bins']
+            start_time = entry['start_time'][()]
+            end_time = entry['end_time'][()]
+            shots = entry['shots']
+            data = entry['data']
+    except Exception:
+        # A corrupted entry is treated as a miss and overwritten later
+        return(None)
+
+    # Mark the entry as recently used
+    os.utime(path)
+
+    # The blocks are limited to the bins of the file
+    nsel = np.minimum(nread, bins)[nread > 0]
+
+    blocks = np.split(data, np.cumsum(nsel)[:-1])
+
+    return(start_time, end_time, shots, blocks)
+
+def store(cache_dir, fname, bins, nread, result):
+
+    """ Stores the decoded file [start time, end time, shots, data blocks].
+    The entry is written in a temporary file first (one per process and 
+    thread) so that concurrent workers never see a partial entry"""
+
+    start_time, end_time, shots, blocks = result
+
+    path = entry_path(cache_dir, fname)
+
+    os.makedirs(cache_dir, exist_ok = True)
+
+    path_tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    with open(path_tmp, 'wb') as f:
+        np.savez(f, bins = bins, nread = nread, start_time = start_time, end_time = end_time,
+                 shots = shots, data = np.concatenate(blocks))
+
+    os.replace(path_tmp, path)
+
+    return()
+
+def evict(cache_dir, max_size):
+
+    """ Removes the least recently used entries until the total size of the
+    cache is below max_size (in MB). Entries removed in the meantime by 
+    another thread or process are skipped"""
+
+    if not os.path.exists(cache_dir):
+        return()
+
+    paths = [os.path.join(cache_dir, fname) for fname in os.listdir(cache_dir)
+             if fname.endswith('.npz')]
+
+    stats = []
+
+    for path in paths:
+        try:
+            stats.append((path, os.stat(path)))
+        except FileNotFoundError:
+            continue
+
+    paths = [path for path, stat in stats]
+
+    size = np.array([stat.st_size for path, stat in stats])
+
+    order = np.argsort([stat.st_mtime_ns for path, stat in stats])
+
+    excess = np.sum(size) - max_size * 1E6
+
+    for k in order:
+        if excess <= 0:
+            break
+        try:
+            os.remove(paths[k])
+        except FileNotFoundError:
+            pass
+        excess = excess - size[k]
+
+    return()
@@ -0,0 +1,160 @@
+"""
+@author: N. Siomos
+
+Catalog of the radiosonde files of a folder. The radiosonde filenames start
+with the launch date and time (yyyymmdd_hhmm) and end with .txt. The catalog
+holds the filenames sorted by launch time and is stored in the radiosonde
+folder (.rs_catalog.npz) so that large archives of soundings are listed and
+validated only once. It is rebuilt when the folder modification time changes
+(files added, removed, or renamed).
+"""
+import os, glob
+import numpy as np
+
+catalog_name = '.rs_catalog.npz'
+
+# Catalogs already loaded in this run
+_catalogs = dict()
+
+def get_catalog(finput_rs):
+
+    """ Returns the radiosonde filenames and the launch times, both sorted
+    by launch time. The catalog is taken from memory, from the on-disk copy,
+    or else built from the folder, in this order"""
+
+    mtime = os.stat(finput_rs).st_mtime_ns
+
+    key = os.path.abspath(finput_rs)
+
+    if key in _catalogs.keys() and _catalogs[key][0] == mtime:
+        return(_catalogs[key][1:])
+
+    path = os.path.join(finput_rs, catalog_name)
+
+    catalog = load(path, mtime)
+
+    if catalog == None:
+
+        catalog = build(finput_rs)
+
+        store(path, mtime, catalog)
+
+    _catalogs[key] = (mtime,) + catalog
+
+    return(catalog)
+
+def build(finput_rs):
+
+    """ Lists and validates the radiosonde files of the folder and sorts
+    them by launch time"""
+
+    paths = glob.glob(os.path.join(finput_rs,'*_*.txt'))
+
+    if len(paths) == 0 :
+        raise Exception("-- Error: No txt file provided in the radiosonde folder! Please provide a single file with the radiosonde data with a filename that starts with 'yyyymmdd_hhmm' and ends with '.txt' ")
+
+    bpaths = np.array([os.path.basename(path) for path in paths])
+
+    bad_length = np.char.str_len(bpaths) < 14
+
+    if any(bad_length) :
+        raise Exception(f"-- Error: Radiosonde filename with wrong length detected! Please revise the following files: {bpaths[bad_length]}. They should start with 'yyyymmdd_hhmm' and end with '.txt' ")
+
+    bad_format = np.array([path[8] != '_' or not (path[:8] + path[9:13]).isdigit()
+                           for path in bpaths])
+
+    if any(bad_format):
+        raise Exception(f"-- Error: Radiosonde filename with wrong format detected! Please revise the following files: {bpaths[bad_format]}. They should start with 'yyyymmdd_hhmm' and end with '.txt' ")
+
+    launch_time = to_datetime(bpaths)
+
+    order = np.argsort(launch_time, kind = 'stable')
+
+    return(bpaths[order], launch_time[order])
+
+def to_datetime(bpaths):
+
+    """ Converts the yyyymmdd_hhmm part of the filenames to datetime64 (min)
+    in a single conversion. Invalid dates or times raise an error"""
+
+    iso = np.array([f'{path[:4]}-{path[4:6]}-{path[6:8]}T{path[9:11]}:{path[11:13]}'
+                    for path in bpaths])
+
+    try:
+        launch_time = iso.astype('datetime64[m]')
+    except ValueError:
+        bad = np.array([not is_valid(iso_i) for iso_i in iso])
+        raise ValueError(f"-- Error: The date or time provided in at least one radiosonde filename is not correct. Please revise the following files: {bpaths[bad]}. It should start with 'yyyymmdd_hhmm' and end with '.txt' ")
+
+    bad = launch_time < np.datetime64('1960-01-01')
+
+    if any(bad):
+        raise Exception(f"-- Error: The date or time provided in at least one radiosonde filename is not correct. Please revise the following files: {bpaths[bad]}. It should start with 'yyyymmdd_hhmm' and end with '.txt' ")
+
+    return(launch_time)
+
+def is_valid(iso):
+
+    """ Checks a single yyyy-mm-ddThh:mm string"""
+
+    try:
+        return(np.datetime64(iso, 'm') >= np.datetime64('1960-01-01'))
+    except ValueError:
+        return(False)
+
+def nearest(finput_rs, mtime):
+
+    """ Returns the filename and the launch time of the radiosonde that is
+    nearest in time to mtime (datetime) with a binary search in the
+    catalog"""
+
+    bpaths, launch_time = get_catalog(finput_rs)
+
+    mtime = np.datetime64(mtime, 'm')
+
+    k = np.searchsorted(launch_time, mtime)
+
+    # The candidates on either side of mtime
+    candidates = [k_i for k_i in [k - 1, k] if 0 <= k_i < launch_time.size]
+
+    ind_rs = min(candidates, key = lambda k_i: abs(launch_time[k_i] - mtime))
+
+    return(bpaths[ind_rs], launch_time[ind_rs])
+
+def load(path, mtime):
+
+    """ Loads the on-disk catalog. Returns None if there is no catalog or
+    if the folder was modified since it was stored"""
+
+    if not os.path.exists(path):
+        return(None)
+
+    try:
+        with np.load(path) as entry:
+            if int(entry['mtime']) != mtime:
+                return(None)
+            catalog = (entry['bpaths'], entry['launch_time'].astype('datetime64[m]'))
+    except Exception:
+        return(None)
+
+    return(catalog)
+
+def store(path, mtime, catalog):
+
+    """ Stores the catalog in the radiosonde folder with the folder
+    modification time read before writing. Creating the catalog file changes
+    the folder modification time, so a new catalog is rebuilt once more in
+    the next run. Read only folders are skipped, the catalog is then kept
+    only in memory"""
+
+    bpaths, launch_time = catalog
+
+    try:
+        with open(path, 'wb') as f:
+            np.savez(f, mtime = np.array(mtime), bpaths = bpaths,
+                     launch_time = launch_time.astype('int64'))
+
+    except OSError:
+        print('-- Warning: The radiosonde catalog could not be stored in the radiosonde folder, it will be rebuilt in the next run')
+
+    return()
@@ -15,6 +15,7 @@ Returns:
 
 import argparse
 import os
+from readers import archive
 
 def parse_config():
         
@@ -27,7 +28,7 @@ def parse_config():
 
     parser.add_argument('-f', '--parent_folder', metavar='parent_folder', 
                         type=str, nargs='?',  default = None,
-                        help='The path to the parent folder that contains the normal folder and all other optional input folders (dark, atmosphere, overlap). If no results folder is provided, it will be exported here by default')
+                        help='The path to the parent folder that contains the normal folder and all other optional input folders (dark, atmosphere, overlap). If no results folder is provided, it will be exported here by default. The parent folder can also be a zip or tar(.gz) archive with the same folder structure inside. In that case the results folder, the configuration file, and the radiosonde folder default to the folder of the archive')
 
     parser.add_argument('--dark_folder', metavar='dark_folder', 
                         type=str, nargs='?', default = None,
@@ -47,11 +48,11 @@ def parse_config():
         
     parser.add_argument('--pol_cal_p45_folder', metavar='pol_cal_p45_folder', 
                         type=str, nargs='?', default = None,
-                        help='The path to the polarization calibration +45 folder. Defaults to a pcl/+45 folder inside the parent folder')
+                        help='The path to the polarization calibration +45 folder. Defaults to a pcl/+45 folder inside the parent folder. For PollyXT the +45 profiles are selected by the calibrator angle, so it can point to the rayleigh folder; a folder is then read only once for all the calibrator angles')
 
     parser.add_argument('--pol_cal_m45_folder', metavar='pol_cal_m45_folder', 
                         type=str, nargs='?', default = None,
-                        help='The path to the polarization calibration -45 folder. Defaults to a pcl/-45 folder inside the parent folder')
+                        help='The path to the polarization calibration -45 folder. Defaults to a pcl/-45 folder inside the parent folder. For PollyXT the -45 profiles are selected by the calibrator angle, so it can point to the rayleigh folder; a folder is then read only once for all the calibrator angles')
 
     parser.add_argument('--pol_cal_stc_folder', metavar='pol_cal_stc_folder', 
                         type=str, nargs='?', default = None,
@@ -134,9 +135,65 @@ def parse_config():
                         type=float, nargs=3, default = [None, None, None], 
                         help="The radiosonde station latitude, longitude, and altitude. Mandatory if the mode is set to S. For example: --rsonde_geodata 40.5 22.9 60.0 ")   
 
+    parser.add_argument('--rsonde_resolution', metavar='rsonde_resolution', 
+                        type=float, nargs='?', default = None, 
+                        help="The vertical resolution in meters of the altitude grid that the radiosonde pressure, temperature, and relative humidity profiles will be resampled to before they are exported. Levels that do not increase in altitude (duplicates or descents) are dropped. Useful for high resolution soundings. Defaults to None (the levels of the radiosonde file are kept)")   
+
     parser.add_argument('--trim_overflows', metavar='trim_overflows', 
                         type=int, nargs='?', default = 0, 
                         help="This options determines how overflow values will be treated. If set to 0 (default), no action will be taken, if set to 1 the files containing at least one overflow value will be screened out. If set to 2, overflow will be interpolated (use with care and only for a few bins per profile). If set to 3 then overflows will be included, use this only for debuging purposes")   
+
+    parser.add_argument('-w', '--workers', metavar='workers', 
+                        type=int, nargs='?', default = 1, 
+                        help="The number of workers used to decode the raw files concurrently. Defaults to 1 (serial decoding)")   
+
+    parser.add_argument('--executor', metavar='executor', 
+                        type=str, nargs='?', default = 'thread', 
+                        help="The type of worker pool used when workers is larger than 1. Choose one of thread, process. Defaults to thread")   
+
+    parser.add_argument('--mmap', metavar = 'mmap',
+                        type = bool, default = False, 
+                        action = argparse.BooleanOptionalAction,
+                        help = 'If called then the raw files will be memory-mapped instead of being read in memory. The data blocks are decoded as views of the mapped files. Defaults to False ')
+
+    parser.add_argument('--cache_dir', metavar='cache_dir', 
+                        type=str, nargs='?', default = None,
+                        help='The path to a folder where the decoded raw files will be cached. Cached files are reused as long as the path, size, and modification time of the raw file do not change. Defaults to None (no caching)')
+
+    parser.add_argument('--cache_size', metavar='cache_size', 
+                        type=float, nargs='?', default = 2048.,
+                        help='The size limit of the cache folder in MB. The least recently used entries are removed when the limit is exceeded. Defaults to 2048 MB')
+
+    parser.add_argument('--max_bins', metavar='max_bins', 
+                        type=int, nargs='?', default = None,
+                        help='The maximum number of bins that will be read per channel. The rest of the bins are not decoded at all. Defaults to None (all bins are read)')
+
+    parser.add_argument('--max_range', metavar='max_range', 
+                        type=float, nargs='?', default = None,
+                        help='The maximum range in m up to which the bins will be read per channel based on the range resolution of each channel. The rest of the bins are not decoded at all. Defaults to None (all bins are read)')
+
+    parser.add_argument('--compact', metavar = 'compact',
+                        type = bool, default = False, 
+                        action = argparse.BooleanOptionalAction,
+                        help = 'If called then the signals will be stored in single precision (float32) throughout the conversion, including the Raw_Lidar_Data and Background_Profile variables of the exported files. Photon counts remain exact. Defaults to False ')
+
+    parser.add_argument('--lazy', metavar = 'lazy',
+                        type = bool, default = False, 
+                        action = argparse.BooleanOptionalAction,
+                        help = 'If called then the signals will be read lazily as a dask array (requires dask). The files are decoded chunk by chunk only when the output files are written, so that measurements larger than the available memory can be converted. The output is identical. Defaults to False ')
+
+    parser.add_argument('--chunk_size', metavar='chunk_size', 
+                        type=int, nargs='?', default = 100,
+                        help='The number of raw files per chunk of the lazy signals. Used only with --lazy. Defaults to 100')
+
+    parser.add_argument('--layout', metavar='layout', 
+                        type=str, nargs='?', default = None,
+                        help='The channel layout fingerprint of the licel files that will be read. The fingerprints are reported when the files of a folder have different channel layouts (e.g. the acquisition settings changed during the measurement). Defaults to None (the layout of the first file in time)')
+
+    parser.add_argument('--split_layouts', metavar = 'split_layouts',
+                        type = bool, default = False, 
+                        action = argparse.BooleanOptionalAction,
+                        help = 'If called then the measurement is converted once per channel layout found in the licel file headers, producing separate output files per layout. Only for licel files. Defaults to False ')
                 
 
     args = vars(parser.parse_args())
@@ -151,13 +208,19 @@ def parse_config():
         raise Exception("-- Error: Neither a parent folder nor individual folders for the dark, rayleigh_fit, telecover, and polarization_calibration tests where provided. Please either provide the parent_folder and use the default folder structure within or define each test folder explicitly! ")          
                 
             
+    # Only the raw files are read from inside an archive
+    if args['parent_folder'] != None and archive.is_archive(args['parent_folder']):
+        local_folder = os.path.dirname(args['parent_folder'])
+    else:
+        local_folder = args['parent_folder']
+    
     if args['results_folder'] == None:
-        res_path = os.path.join(args['parent_folder'],'out','results')
+        res_path = os.path.join(local_folder,'out','results')
         args['results_folder'] = res_path
         os.makedirs(res_path, exist_ok = True)
 
     if args['config_file'] == None:
-        args['config_file'] = os.path.join(args['parent_folder'],'config_file.ini')  
+        args['config_file'] = os.path.join(local_folder,'config_file.ini')  
 
     if len(args['rsonde_column_index']) == 3:
         rsonde_column_index = args['rsonde_column_index']
@@ -178,7 +241,9 @@ def parse_config():
                    os.path.join('pcl','-45'), os.path.join('pcl','stc'), 'rs']
     
     for i in range(len(fld)):
-        if args[fld[i]] == None:
+        if args[fld[i]] == None and fld[i] == 'radiosonde_folder':
+            args[fld[i]] = os.path.join(local_folder, default_loc[i])
+        elif args[fld[i]] == None:
             args[fld[i]] = os.path.join(args['parent_folder'], default_loc[i])
 
     print("-- The following arguments have been imported!")
@@ -206,6 +271,27 @@ def parse_config():
     if args['mode'] not in ['A', 'R', 'T', 'C', 'D']:
         raise Exception(f"-- Error: mode field not recognized. Please revise the settings file and use one of {['A', 'R', 'T', 'C', 'D']} with: -M <mode>")
 
+    if args['workers'] < 1:
+        raise Exception("-- Error: workers field should be a positive integer. Please provide it with: -w <workers>")
+
+    if args['max_bins'] != None and args['max_bins'] < 1:
+        raise Exception("-- Error: max_bins field should be a positive integer. Please provide it with: --max_bins <max_bins>")
+
+    if args['max_range'] != None and args['max_range'] <= 0:
+        raise Exception("-- Error: max_range field should be a positive number (m). Please provide it with: --max_range <max_range>")
+
+    if args['cache_size'] <= 0:
+        raise Exception("-- Error: cache_size field should be a positive number (MB). Please provide it with: --cache_size <cache_size>")
+
+    if args['chunk_size'] < 1:
+        raise Exception("-- Error: chunk_size field should be a positive integer. Please provide it with: --chunk_size <chunk_size>")
+
+    if args['split_layouts'] and args['file_format'] != 'licel':
+        raise Exception("-- Error: split_layouts is only available for licel files. Please remove: --split_layouts")
+
+    if args['executor'] not in ['thread', 'process']:
+        raise Exception(f"-- Error: executor field not recognized. Please use one of {['thread', 'process']} with: --executor <executor>")
+
     if len(args['rsonde_column_index']) != 4:
         raise Exception("-- Error: rsonde_column_index field has less or more elements than expected. Please provide 3 or 4 integer eg: --rsonde_column_index 1 2 3")
 
@@ -221,6 +307,9 @@ def parse_config():
     if len(args['rsonde_geodata']) != 3:
         raise Exception("-- Error: rsonde_geodata field has less or more elements than expected. Please provide 3 floats that correspond to the radiosonde station latitude, longitude, and altitude eg: --rsonde_geodata 40.5 22.9 60.0")
             
+    if args['rsonde_resolution'] != None and not args['rsonde_resolution'] > 0:
+        raise Exception("-- Error: rsonde_resolution field must be a positive number of meters eg: --rsonde_resolution 50")
+            
     if any([not geodata_i for geodata_i in args['rsonde_geodata']]) and args['mode'] == 'S':
         raise Exception("-- Error: The rsonde_geodata field is mandatory when processing a radiosonde file (mode = S). Please provide 3 floats that correspond to the radiosonde station latitude, longitude, and altitude eg: --rsonde_geodata 40.5 22.9 60.0")
             
@@ -1,18 +1,19 @@
 """
 @author: Peristera
 """
-import os, sys, glob
+import os, sys, io
 import numpy as np
-from readers import read_licel, read_polly
+from readers import read_licel, read_polly, archive, catalog
 import xarray as xr
 import pandas as pd
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-def rayleigh(finput_ray, mcode, file_format):
+def rayleigh(finput_ray, mcode, file_format, **options):
     
     """Extracts the raw signal, shots, and rest metadata information out of the 
     raw input files. The default format is currently licel. The signal units
-    are always mV for analog and counts for photon channels"""
+    are always mV for analog and counts for photon channels. Any additional
+    keyword arguments (options) are passed to the licel or PollyXT reader"""
     
     # Reading
     print('-----------------------------------------')
@@ -21,14 +22,14 @@ def rayleigh(finput_ray, mcode, file_format):
     
     # Select reader based on the file format
     if file_format == 'polly_xt':
-        raise Exception('-- Error: PollyXT reading routines are not yet ready!')
-     # In case of Polly define the cal_angle  
-        # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-        #     read_polly.dtfs(path, cfg, cal_angle)
+        # Only the normal profiles (no depolarization calibration)
+        meas_info, channel_info, time_info, sig, shots = \
+            read_polly.dtfs(dir_meas = finput_ray, mcode = mcode, 
+                            cal_angle = read_polly.cal_angles['nrm'], **options)
             
     elif file_format == 'licel':
         meas_info, channel_info, time_info, sig, shots = \
-            read_licel.dtfs(dir_meas = finput_ray, mcode = mcode)
+            read_licel.dtfs(dir_meas = finput_ray, mcode = mcode, **options)
         
     print('Reading Rayleigh signals complete!')
     print('-----------------------------------------')
@@ -37,119 +38,62 @@ def rayleigh(finput_ray, mcode, file_format):
     return(sig, shots, meas_info, channel_info, time_info)
 
 def telecover(finput_sec, finput_rin, mcode, file_format, 
-              files_per_sector = None, files_per_ring = None):
+              files_per_sector = None, files_per_ring = None, **options):
     
     """Extracts the raw signal, shots, and rest metadata information out of the 
     raw input files. The default format is currently licel. The signal units
-    are always mV for analog and counts for photon channels"""
+    are always mV for analog and counts for photon channels. Any additional
+    keyword arguments (options) are passed to the licel or PollyXT reader.
+    The sector and ring folders are read concurrently"""
     
     # Reading
     print('-----------------------------------------')
     print('Start reading telecover signals...')
     print('-----------------------------------------')
     
+    # Select reader based on the file format
+    if file_format == 'polly_xt':
+        raise Exception('-- Error: Telecover measurements are not available for PollyXT!')
+
+    if not files_per_sector:
+        paths = [os.path.join(finput_sec, sector) for sector in ['north', 'east', 'south', 'west']] + \
+            [os.path.join(finput_rin, ring) for ring in ['inner', 'outer']]
+    
+    else:
+        paths = [path for path in [finput_sec, finput_rin] if archive.exists(path)]
+
+    print(f'-- Reading {len(paths)} folder(s)..')   
+    
+    outputs = read_folders(paths, mcode = mcode, file_format = file_format, 
+                           **options)
+    
     sig_sec = []
-    sector_sec = []
     shots_sec = []
     time_info_sec = []
     
-    if not files_per_sector:
-        for sector in ['north', 'east', 'south', 'west']:
-            path = os.path.join(finput_sec, sector)
-            print(f'-- Reading {sector} sector..')           
-            # Select reader based on the file format
-            if file_format == 'polly_xt':
-             # In case of Polly define the cal_angle  
-                # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-                #     read_polly.dtfs(path, cfg, cal_angle)
-                raise Exception('-- Error: PollyXT reading routines are not yet ready!')
-                    
-            if file_format == 'licel':
-                meas_info, channel_info, time_info, sig, shots = \
-                    read_licel.dtfs(dir_meas = path, mcode = mcode)
-                
-            sector = folder_to_sector(folder = time_info['folder'].values)
-            time_info['sector'] = sector
-                
-            sig_sec.append(sig)
-            shots_sec.append(shots)
-            sector_sec.append(sector)
-            time_info_sec.append(time_info)
-
-        for ring in ['inner', 'outer']:
-            path = os.path.join(finput_rin, ring)
-            print(f'-- Reading {ring} rings..')           
-            # Select reader based on the file format
-            if file_format == 'polly_xt':
-             # In case of Polly define the cal_angle  
-                # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-                #     read_polly.dtfs(path, cfg, cal_angle)
-                raise Exception('-- Error: PollyXT reading routines are not yet ready!')
-                    
-            if file_format == 'licel':
-                meas_info, channel_info, time_info, sig, shots = \
-                    read_licel.dtfs(dir_meas = path, mcode = mcode)
-                
-            ring = folder_to_sector(folder = time_info['folder'].values)
-            time_info['sector'] = ring
-                
-            sig_sec.append(sig)
-            shots_sec.append(shots)
-            sector_sec.append(ring)
-            time_info_sec.append(time_info)
-
-        sig = xr.concat(sig_sec, dim = 'time').sortby('time')
-        shots = xr.concat(shots_sec, dim = 'time').sortby('time')
-        time_info = pd.concat(time_info_sec).sort_index()
+    for path, (meas_info_f, channel_info_f, time_info_f, sig_f, shots_f) in zip(paths, outputs):
         
-    else:
-            
-        # Select reader based on the file format
-        if file_format == 'polly_xt':
-         # In case of Polly define the cal_angle  
-            # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-            #     read_polly.dtfs(path, cfg, cal_angle)
-            raise Exception('-- Error: PollyXT reading routines are not yet ready!')
-
-        if os.path.exists(finput_sec):
-            
-            print('-- Reading sectors..')           
-                        
-            if file_format == 'licel':
-                meas_info, channel_info, time_info, sig, shots = \
-                    read_licel.dtfs(dir_meas = finput_sec, mcode = mcode)
-                    
-            sector = time_to_sector(folder = time_info['folder'], 
-                                    files_per_sector = files_per_sector)
+        if len(time_info_f) == 0:
+            continue
         
-            time_info['sector'] = sector
-            
-            sig_sec.append(sig)
-            shots_sec.append(shots)
-            sector_sec.append(sector)
-            time_info_sec.append(time_info)
-
-        if os.path.exists(finput_rin):
-            
-            print('-- Reading rings..')    
-            
-            if file_format == 'licel':
-                meas_info, channel_info, time_info, sig, shots = \
-                    read_licel.dtfs(dir_meas = finput_rin, mcode = mcode)
-                
-            ring = time_to_ring(folder = time_info['folder'], 
-                                files_per_ring = files_per_ring)
+        meas_info, channel_info = meas_info_f, channel_info_f
         
-            time_info['sector'] = ring
+        # The sectors and rings in a single folder are given by the file order
+        if files_per_sector and path == finput_sec:
+            time_info_f['sector'] = time_to_sector(folder = time_info_f['folder'], 
+                                                   files_per_sector = files_per_sector)
+        elif files_per_sector:
+            time_info_f['sector'] = time_to_ring(folder = time_info_f['folder'], 
+                                                 files_per_ring = files_per_ring)
+        
+        sig_sec.append(sig_f)
+        shots_sec.append(shots_f)
+        time_info_sec.append(time_info_f)
     
-            sig_sec.append(sig)
-            shots_sec.append(shots)
-            sector_sec.append(ring)
-            time_info_sec.append(time_info)
+    sig, shots, time_info = merge_folders(sig_sec, shots_sec, time_info_sec)
 
-        sig = xr.concat(sig_sec, dim = 'time').sortby('time')
-        shots = xr.concat(shots_sec, dim = 'time').sortby('time')
-        time_info = pd.concat(time_info_sec).sort_index()
+    if not files_per_sector:
+        time_info['sector'] = folder_to_sector(folder = time_info['folder'].values)
 
     print('Reading telecover signals complete!')
     print('-----------------------------------------')
@@ -157,94 +101,155 @@ def telecover(finput_sec, finput_rin, mcode, file_format,
 
     return(sig, shots, meas_info, channel_info, time_info)
 
-def polarization_calibration(finput_p45, finput_m45, finput_stc, mcode, file_format):
+def polarization_calibration(finput_p45, finput_m45, finput_stc, mcode, file_format, **options):
     
     """Extracts the raw signal, shots, and rest metadata information out of the 
     raw input files. The default format is currently licel. The signal units
-    are always mV for analog and counts for photon channels"""
+    are always mV for analog and counts for photon channels. Any additional
+    keyword arguments (options) are passed to the licel or PollyXT reader.
+    The static, -45, and +45 folders are read concurrently"""
     
     # Reading
     print('-----------------------------------------')
     print('Start reading Polarization Calibration signals...')
     print('-----------------------------------------')
+                
+    # Select reader based on the file format
+    if file_format == 'polly_xt' and archive.exists(finput_stc):
+        raise Exception('-- Error: Static polarization calibration measurements are not available for PollyXT!')
+
+    # Calibrator positions: static (0), -45 (1), +45 (2)
+    paths = [finput_stc, finput_m45, finput_p45]
+    
+    positions = [position for position in range(len(paths)) if archive.exists(paths[position])]
+    
+    paths = [paths[position] for position in positions]
+    
+    # The PollyXT -45 and +45 profiles are selected by the calibrator angle
+    cal_angles = [None, read_polly.cal_angles['-45'], read_polly.cal_angles['+45']]
+        
+    print(f'-- Reading {len(paths)} folder(s)..')  
+    
+    outputs = read_folders(paths, mcode = mcode, file_format = file_format, 
+                           cal_angles = [cal_angles[position] for position in positions],
+                           **options)
     
-            
     sig_pos = []
     shots_pos = []
-    position_pos = []
     time_info_pos = []
 
-                
-    # Select reader based on the file format
-    if file_format == 'polly_xt':
-     # In case of Polly define the cal_angle  
-        # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-        #     read_polly.dtfs(path, cfg, cal_angle)
-        raise Exception('-- Error: PollyXT reading routines are not yet ready!')
+    for position, (meas_info_f, channel_info_f, time_info_f, sig_f, shots_f) in zip(positions, outputs):
 
-    if os.path.exists(finput_stc):
-        
-        print('-- Reading static calibration files..')  
+        if len(time_info_f) == 0:
+            continue
         
-        if file_format == 'licel':
-            meas_info, channel_info, time_info, sig, shots = \
-                read_licel.dtfs(dir_meas = finput_stc, mcode = mcode)
+        meas_info, channel_info = meas_info_f, channel_info_f
+                
+        time_info_f['position'] = np.full(time_info_f.index.size, position)
 
-        position = np.array(time_info.index.size * [0])
-        time_info['position'] = position
-        sig_pos.append(sig)
-        shots_pos.append(shots)
-        position_pos.append(position)
-        time_info_pos.append(time_info)
+        sig_pos.append(sig_f)
+        shots_pos.append(shots_f)
+        time_info_pos.append(time_info_f)
 
-    if os.path.exists(finput_m45):
+    sig, shots, time_info = merge_folders(sig_pos, shots_pos, time_info_pos)
         
-        print('-- Reading -45 files..')  
-        
-        if file_format == 'licel':
-            meas_info, channel_info, time_info, sig, shots = \
-                read_licel.dtfs(dir_meas = finput_m45, mcode = mcode)
-
-        position = np.array(time_info.index.size * [1])
-        time_info['position'] = position
+    print('Reading Polarization Calibration signals complete!')
+    print('-----------------------------------------')
+    print('')
 
-        sig_pos.append(sig)
-        shots_pos.append(shots)
-        position_pos.append(position)
-        time_info_pos.append(time_info)
+    return(sig, shots, meas_info, channel_info, time_info)
 
-    if os.path.exists(finput_p45):
-        
-        print('-- Reading +45 files..')  
-        
+def read_folders(paths, mcode, file_format, cal_angles = None, **options):
+    
+    """ Reads several measurement folders concurrently, one thread per 
+    folder. With a process pool for the decoding (executor = 'process') the
+    folders are read one after the other instead, because forking the 
+    decoding processes from several threads can deadlock. For PollyXT the 
+    profiles of each folder are selected with the respective cal_angles. 
+    Returns the reader output per folder in the order of paths"""
+    
+    def read_folder(k):
         if file_format == 'licel':
-            meas_info, channel_info, time_info, sig, shots = \
-                read_licel.dtfs(dir_meas = finput_p45, mcode = mcode)
+            output = read_licel.dtfs(dir_meas = paths[k], mcode = mcode, **options)
 
-        position = np.array(time_info.index.size * [2])
-        time_info['position'] = position
-        
-        sig_pos.append(sig)
-        shots_pos.append(shots)
-        position_pos.append(position)
-        time_info_pos.append(time_info)
-
-    sig = xr.concat(sig_pos, dim = 'time').sortby('time')
-    shots = xr.concat(shots_pos, dim = 'time').sortby('time')
-    time_info = pd.concat(time_info_pos).sort_index()
+        elif file_format == 'polly_xt':
+            output = read_polly.dtfs(dir_meas = paths[k], mcode = mcode, 
+                                     cal_angle = cal_angles[k], **options)
+        return(output)
+    
+    if len(paths) == 0:
+        return([])
+    
+    if options.get('executor') == 'process':
+        outputs = [read_folder(k) for k in range(len(paths))]
+        return(outputs)
+    
+    with ThreadPoolExecutor(max_workers = len(paths)) as executor:
+        outputs = list(executor.map(read_folder, range(len(paths))))
         
-    print('Reading Polarization Calibration signals complete!')
-    print('-----------------------------------------')
-    print('')
+    return(outputs)
 
-    return(sig, shots, meas_info, channel_info, time_info)
+def merge_folders(sig_list, shots_list, time_info_list):
+    
+    """ Merges the signals, shots, and time_info of several folders in 
+    single time ordered arrays. The merged arrays are allocated once and 
+    each folder is copied directly to its time ordered positions. Folders 
+    with different channels or bins, or lazy (dask) signals, are merged 
+    with xarray instead"""
+    
+    if len(sig_list) == 0:
+        raise Exception('-- Error: None of the measurement folders contains readable files!')
+
+    time_arr = np.concatenate([sig.time.values for sig in sig_list])
+    
+    order = np.argsort(time_arr, kind = 'stable')
+    
+    time_info = pd.concat(time_info_list).iloc[order]
+    
+    same = all([sig.channel.equals(sig_list[0].channel) and \
+                sig.bins.equals(sig_list[0].bins) and \
+                    isinstance(sig.data, np.ndarray) for sig in sig_list])
+    
+    if not same:
+        sig = xr.concat(sig_list, dim = 'time').isel(time = order)
+        shots = xr.concat(shots_list, dim = 'time').isel(time = order)
+        return(sig, shots, time_info)
+    
+    # Position of each profile in the merged arrays
+    target = np.empty(order.size, dtype = int)
+    target[order] = np.arange(order.size)
+    
+    sig_arr = np.empty((order.size,) + sig_list[0].shape[1:], 
+                       dtype = np.result_type(*[sig.dtype for sig in sig_list]))
+
+    shots_arr = np.empty((order.size,) + shots_list[0].shape[1:], 
+                         dtype = np.result_type(*[shots.dtype for shots in shots_list]))
+    
+    start = 0
+    
+    for sig_f, shots_f in zip(sig_list, shots_list):
+        stop = start + sig_f.time.size
+        sig_arr[target[start:stop]] = sig_f.values
+        shots_arr[target[start:stop]] = shots_f.values
+        start = stop
+    
+    sig = xr.DataArray(sig_arr, 
+                       coords = [time_arr[order], sig_list[0].channel.values, sig_list[0].bins.values],
+                       dims = ['time', 'channel', 'bins'])
+
+    shots = xr.DataArray(shots_arr, 
+                         coords = [time_arr[order], shots_list[0].channel.values],
+                         dims = ['time', 'channel'])
+
+    return(sig, shots, time_info)
 
 
-def dark(finput_drk, mcode, file_format):
+def dark(finput_drk, mcode, file_format, **options):
     
     """Extracts the raw signal, shots, and rest metadata information out of the 
     raw input files. The default format is currently licel. The signal units
-    are always mV for analog and counts for photon channels"""
+    are always mV for analog and counts for photon channels. Any additional
+    keyword arguments (options) are passed to the licel or PollyXT reader"""
     
     # Reading
     print('-----------------------------------------')
@@ -253,14 +258,13 @@ def dark(finput_drk, mcode, file_format):
     
     # Select reader based on the file format
     if file_format == 'polly_xt':
-     # In case of Polly define the cal_angle  
-        # sig_raw, sig_dev, info_val, info_dev, ground_alt, SZA, azimuth =\
-        #     read_polly.dtfs(path, cfg, cal_angle)
-        raise Exception('-- Error: PollyXT reading routines are not yet ready!')
+        meas_info, channel_info, time_info, sig, shots = \
+            read_polly.dtfs(dir_meas = finput_drk, mcode = mcode, 
+                            cal_angle = read_polly.cal_angles['nrm'], **options)
 
     elif file_format == 'licel':
         meas_info, channel_info, time_info, sig, shots = \
-            read_licel.dtfs(dir_meas = finput_drk, mcode = mcode)
+            read_licel.dtfs(dir_meas = finput_drk, mcode = mcode, **options)
 
     print('Reading dark signals complete!')
     print('-----------------------------------------')
@@ -280,12 +284,6 @@ def radiosonde(finput_rs, delimiter, skip_header, skip_footer,
     print('Start reading radiosonde file...')
     print('-----------------------------------------')
     
-    paths = glob.glob(os.path.join(finput_rs,'*_*.txt'))
-    
-    lib_delimiter =  {"S": "",
-                      "C": ",",
-                      "T": "\t"}
-    
     # Unit conversion functions
     def Km_to_m(x):
         return(1E3 * x)
@@ -299,44 +297,7 @@ def radiosonde(finput_rs, delimiter, skip_header, skip_footer,
     def fraction_to_percent(x):
         return(100. * x)
     
-    if len(paths) == 0 :
-        raise Exception("-- Error: No txt file provided in the radiosonde folder! Please provide a single file with the radiosonde data with a filename that starts with 'yyyymmdd_hhmm' and ends with '.txt' ")
-
-    bpaths = [os.path.basename(path) for path in paths]
-
-    bad_length = [len(path) < 14 for path in bpaths]
-    
-    if any(bad_length) :
-        raise Exception(f"-- Error: Radiosonde filename with wrong length detected! Please revise the following files: {bpaths[bad_length]}. They should start with 'yyyymmdd_hhmm' and end with '.txt' ")
-    else:
-        bad_format = [path[8] != '_' for path in bpaths]
-        if any(bad_format):
-            raise Exception(f"-- Error: Radiosonde filename with wrong format detected! Please revise the following files: {bpaths[bad_format]}. They should start with 'yyyymmdd_hhmm' and end with '.txt' ")
-        else:
-            dates = [path[:13].split('_')[0] for path in bpaths]
-            times = [path[:13].split('_')[1] for path in bpaths]
-
-    bad_dates = [int(date[:4]) not in np.arange(1960,9999,1) or \
-                 int(date[4:6]) not in np.arange(1,13,1) or \
-                 int(date[6:8]) not in np.arange(1,31,1) for date in dates]
-
-    bad_times = [int(time[:2]) not in np.arange(0,24,1) or \
-                 int(time[2:4]) not in np.arange(0,60,1) for time in times]
-        
-    if any(bad_dates):
-        raise Exception("-- Error: The date provided in at least one radiosonde filename is not correct. Please revise the following files: {bpaths[bad_dates]}. It should start with 'yyyymmdd_hhmm' and end with '.txt' ")
-
-    if any(bad_times):
-        raise Exception("-- Error: The time provided in at least radiosond filename is not correct. Please revise the following files: {bpaths[bad_times]}. It should start with 'yyyymmdd_hhmm' and end with '.txt' ")
-        
-    date_dt = np.array([datetime.strptime(date,'%Y%m%d') for date in dates])
-    
-    delta_t = np.array([(dt - mtime).total_seconds() /3600. for dt in date_dt])
-
-    ind_rs = np.argmin(np.abs(delta_t))
-    
-    if not any(np.abs(delta_t) < 18):
-        raise Exception(f"-- Error: The nearest radiosonde in time was launched with a time difference of {np.round(delta_t[ind_rs],decimals=1)} hours with respect to the middle time of the measurement! Please provide a radiosond file with less than 18 hours temporal difference")
+    bpath = nearest_radiosonde(finput_rs, mtime = mtime)
     
     if usecols[3] == None:
         parameters = ['P', 'T']
@@ -346,12 +307,11 @@ def radiosonde(finput_rs, delimiter, skip_header, skip_footer,
         parameters = ['P', 'T', 'RH']
         
         
-    data = np.genfromtxt(paths[ind_rs],skip_header = skip_header, 
+    data = read_sounding(os.path.join(finput_rs, bpath), 
+                         delimiter = delimiter, 
+                         skip_header = skip_header, 
                          skip_footer = skip_footer,
-                         delimiter = lib_delimiter[delimiter], 
-                         autostrip = True,
-                         usecols = np.array(usecols) - 1, dtype = float)
-
+                         usecols = usecols)
 
     # Change units if they are not the default ones (m, hPa, K, %)
     if units[0] == 'Km':
@@ -372,34 +332,83 @@ def radiosonde(finput_rs, delimiter, skip_header, skip_footer,
                         coords = [alt, parameters], 
                         dims = ['height', 'parameters'] )
     
-    return(dates[ind_rs], times[ind_rs], atmo)
+    return(bpath[:8], bpath[9:13], atmo)
+
+def nearest_radiosonde(finput_rs, mtime):
+    
+    """Returns the filename of the radiosonde file that is nearest in time 
+    to mtime (datetime). The radiosonde must be launched within 18 hours
+    from mtime"""
+    
+    # Binary search in the sorted catalog of the radiosonde folder
+    bpath, launch_time = catalog.nearest(finput_rs, mtime = mtime)
+    
+    delta_t = (launch_time - np.datetime64(mtime, 'm')) / np.timedelta64(1, 'h')
+    
+    if not np.abs(delta_t) < 18:
+        raise Exception(f"-- Error: The nearest radiosonde in time was launched with a time difference of {np.round(delta_t,decimals=1)} hours with respect to the middle time of the measurement! Please provide a radiosond file with less than 18 hours temporal difference")
+    
+    return(bpath)
+
+def read_sounding(path, delimiter, skip_header, skip_footer, usecols):
+    
+    """Reads the usecols columns (1-based) of a radiosonde text file with the
+    C parser of pandas. The delimiter is one of S: space(s), C: comma, 
+    T: tab. The first skip_header and the last skip_footer lines are 
+    skipped, empty lines at the end of the file are not counted. As with
+    np.genfromtxt, comments (#) are skipped and the values that cannot be
+    parsed (e.g. missing value markers) are set to nan"""
+
+    lib_delimiter =  {"S": r"\s+",
+                      "C": ",",
+                      "T": "\t"}
+
+    with open(path, 'r') as f:
+        lines = f.read().rstrip().splitlines()
+
+    lines = lines[skip_header:len(lines) - skip_footer]
+    
+    cols = [int(col) - 1 for col in usecols]
+
+    data = pd.read_csv(io.StringIO('\n'.join(lines)), 
+                       sep = lib_delimiter[delimiter],
+                       header = None, index_col = False, 
+                       usecols = cols, skipinitialspace = True,
+                       comment = '#', engine = 'c')
+    
+    # usecols does not keep the order of the columns
+    data = data.loc[:, cols].apply(pd.to_numeric, errors = 'coerce').to_numpy(dtype = float)
+
+    return(data)
 
 def folder_to_sector(folder):
 
+    """ Sector (1 - 4) or ring (5, 6) number per file from its folder name"""
+
     fld = ['north','east','south','west','outer','inner']
     sec = [1,2,3,4,5,6]
-            
-    sector = np.nan * np.zeros(folder.shape)
     
-    for i in range(len(fld)):
-        sector[folder == fld[i]] = sec[i]
+    sector = pd.Series(folder).map(dict(zip(fld, sec))).values.astype(float)
         
     return(sector)
 
 def folder_to_position(folder):
 
+    """ Calibrator position (0 - 2) per file from its folder name"""
+
     fld = ['static', '-45', '+45']
     sec = [0, 1, 2]
             
-    position = np.nan * np.zeros(folder.shape)
-    
-    for i in range(len(fld)):
-        position[folder == fld[i]] = sec[i]
+    position = pd.Series(folder).map(dict(zip(fld, sec))).values.astype(float)
         
     return(position)
 
 def time_to_sector(folder, files_per_sector):
     
+    """ Sector number per file for a single folder with the sectors measured
+    one after the other (north, east, south, west, north, ...) with 
+    files_per_sector files each"""
+    
     blocks = folder.size / files_per_sector
     
     if blocks - np.floor(blocks) > 0.:
@@ -409,20 +418,18 @@ def time_to_sector(folder, files_per_sector):
                  "files per sector was not constant during measurements then " +
                  "provide the telecover in individual folders per sector.")
     
-    sec = [1, 2, 3, 4]
-    
-    sec_list = int(np.floor(blocks / 4.)) * sec
-    sec_list.extend(sec[:np.int((blocks - np.floor(blocks / 4.)) * 4.)])
-            
-    sector = np.nan * np.zeros(folder.shape)
+    sec = np.array([1, 2, 3, 4], dtype = float)
     
-    for i in range(len(sec_list)):
-        sector[i*files_per_sector:(i+1)*files_per_sector] = sec_list[i]
+    sector = sec[(np.arange(folder.size) // files_per_sector) % sec.size]
     
     return(sector)
 
 def time_to_ring(folder, files_per_ring):
     
+    """ Ring number per file for a single folder with the rings measured
+    one after the other (outer, inner, outer, ...) with files_per_ring 
+    files each"""
+    
     blocks = folder.size / files_per_ring
     
     if blocks - np.floor(blocks) > 0.:
@@ -432,14 +439,8 @@ def time_to_ring(folder, files_per_ring):
                  "files per ring was not constant during measurements then " +
                  "provide the telecover in individual folders per ring.")
     
-    sec = [5, 6]
-    
-    sec_list = int(np.floor(blocks / 2.)) * sec
-    sec_list.extend(sec[:np.int((blocks - np.floor(blocks / 2.)) * 2.)])
-            
-    ring = np.nan * np.zeros(folder.shape)
+    sec = np.array([5, 6], dtype = float)
     
-    for i in range(len(sec_list)):
-        ring[i*files_per_ring:(i+1)*files_per_ring] = sec_list[i]
+    ring = sec[(np.arange(folder.size) // files_per_ring) % sec.size]
     
-    return(ring)
\ No newline at end of file
+    return(ring)
@@ -1,179 +1,908 @@
-import os
+import os, mmap, hashlib
 import numpy as np
 import pandas as pd
-import glob
-from datetime import datetime as dt
-from datetime import timedelta
 import xarray as xr
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from readers import cache, archive
+
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask = None
+
+# Columns of the channel rows of the licel header
+header_cols = ['active', 'acquisition_mode', 'laser', 'bins', 
+               'laser_polarization', 'pmt_high_voltage', 'range_resolution', 
+               'wave_pol', 'unk1', 'unk2', 'unk3', 'unk4', 
+               'analog_to_digital_resolution', 'shots', 'data_acquisition_range',
+               'channel_id']
 
 # Read measurement
-def dtfs(dir_meas, mcode):
+def dtfs(dir_meas, mcode, workers = 1, executor = 'thread', use_mmap = False,
+         cache_dir = None, cache_size = 2048., channels = None, 
+         max_bins = None, max_range = None, compact = False, lazy = False,
+         chunk_size = 100, layout = None):
     
-    """ Reads information from the raw licel files"""
+    """ Reads information from the raw licel files. With workers > 1 the
+    files are decoded concurrently in a thread or process pool (executor).
+    With use_mmap the files are memory-mapped instead of read in memory.
+    If a cache_dir is provided the decoded files are cached there and 
+    reused in later runs (cache_size is the cache size limit in MB).
+    Only the channels in the channels list (channel_id_Llaser IDs) and 
+    the bins up to max_bins or max_range (in m) are decoded if provided.
+    With compact the signals are stored as float32 instead of float64.
+    With lazy the signals are returned as a dask array in chunks of 
+    chunk_size files that is decoded only when it is computed (requires
+    dask). Only the files with the given channel layout fingerprint (see
+    get_layout) are read, by default the layout of the first file in time.
+    Otherwise this is a wrapper that concatenates all the blocks of 
+    dtfs_blocks"""
     
     # Setting sig, info, and time as empty lists in the beggining    
     sig_raw = []     
     shots = []
-    folder = []
-    start_time_arr = []
-    end_time_arr = []
-    filename = []
     
     meas_info = []
     channel_info = []
     time_info = []
     
-    if not(os.path.exists(dir_meas)):
+    if lazy:
+        folder = scan_folder(dir_meas = dir_meas, mcode = mcode, 
+                             channels = channels, max_bins = max_bins, 
+                             max_range = max_range, workers = workers,
+                             layout = layout)
+        
+        if folder != None:
+            mfiles, heads, meas_info, channel_info, nread = folder
+            
+            time_info, sig_raw, shots = \
+                read_lazy(mfiles, heads = heads, channel_info = channel_info,
+                          nread = nread, chunk_size = chunk_size,
+                          dtype = np.float32 if compact else float,
+                          use_mmap = use_mmap, cache_dir = cache_dir)
+            
+            if cache_dir != None:
+                cache.evict(cache_dir, max_size = cache_size)
+                
+        return(meas_info, channel_info, time_info, sig_raw, shots)
+    
+    blocks = list(dtfs_blocks(dir_meas = dir_meas, mcode = mcode, 
+                              block_size = None, workers = workers, 
+                              executor = executor, use_mmap = use_mmap,
+                              cache_dir = cache_dir, cache_size = cache_size,
+                              channels = channels, max_bins = max_bins, 
+                              max_range = max_range, compact = compact,
+                              layout = layout))
+    
+    if len(blocks) == 1:
+        meas_info, channel_info, time_info, sig_raw, shots = blocks[0]
+
+    elif len(blocks) > 1:
+        meas_info, channel_info = blocks[0][:2]
+        time_info = pd.concat([block[2] for block in blocks])
+        sig_raw = xr.concat([block[3] for block in blocks], dim = 'time')
+        shots = xr.concat([block[4] for block in blocks], dim = 'time')
+
+    return(meas_info, channel_info, time_info, sig_raw, shots)
+
+def dtfs_blocks(dir_meas, mcode, block_size = 100, workers = 1, 
+                executor = 'thread', use_mmap = False, 
+                cache_dir = None, cache_size = 2048., channels = None, 
+                max_bins = None, max_range = None, compact = False,
+                layout = None):
+    
+    """ Generator that reads the raw licel files in blocks of block_size 
+    files (profiles). The files are first ordered by the end time reported 
+    in their headers so that consecutive blocks are time sorted and the
+    signals are decoded straight into their final, time ordered, slot. Yields
+    (meas_info, channel_info, time_info, sig_raw, shots) per block. 
+    If block_size is None all files are read in a single block. See dtfs
+    for the rest of the arguments"""
+    
+    folder = scan_folder(dir_meas = dir_meas, mcode = mcode, 
+                         channels = channels, max_bins = max_bins, 
+                         max_range = max_range, workers = workers,
+                         layout = layout)
+    
+    if folder == None:
+        return
+    
+    mfiles, heads, meas_info, channel_info, nread = folder
+    
+    if block_size == None:
+        block_size = len(mfiles)
+
+    outputs = decode_files(mfiles, nread = nread, heads = heads,
+                           workers = workers, executor = executor, 
+                           use_mmap = use_mmap, cache_dir = cache_dir)
+
+    for k in range(0, len(mfiles), block_size):
+        
+        mfiles_block = mfiles[k:k + block_size]
+        
+        time_info, sig_raw, shots = \
+            read_block(mfiles_block, channel_info = channel_info, 
+                       outputs = islice(outputs, len(mfiles_block)),
+                       dtype = np.float32 if compact else float)
+        
+        yield(meas_info, channel_info, time_info, sig_raw, shots)
+
+    # Keep the cache within its size limit
+    if cache_dir != None:
+        cache.evict(cache_dir, max_size = cache_size)
+
+def dtfs_buffers(buffers, workers = 1, executor = 'thread', channels = None,
+                 max_bins = None, max_range = None, compact = False, 
+                 layout = None):
+    
+    """ Reads licel files from memory. buffers is an iterable of (name, 
+    bytes-like) pairs, e.g. files received over the network. The name is 
+    the filename, optionally with its folder (e.g. north/filename) which 
+    is used in the same way as the folder of the files read from disk. 
+    Returns the same (meas_info, channel_info, time_info, sig_raw, shots)
+    as dtfs. bytes, bytearray, and mmap buffers are not copied, the signals
+    are decoded directly from them. Other bytes-like objects (e.g. 
+    memoryview or numpy arrays) are copied once to bytes, because the 
+    header is searched with find. See dtfs for the rest of the arguments"""
+    
+    # Setting sig, info, and time as empty lists in the beggining    
+    sig_raw = []     
+    shots = []
+    
+    meas_info = []
+    channel_info = []
+    time_info = []
+    
+    names = []
+    buffers_in = []
+    
+    for name, buffer in buffers:
+        # The header is searched with find, available in bytes, bytearray, and mmap 
+        if not hasattr(buffer, 'find'):
+            buffer = bytes(buffer)
+        names.append(name)
+        buffers_in.append(buffer)
+    
+    if len(names) == 0:
+        print('---- Warning! No buffers were provided \n'+\
+              '---> !! Skip reading measurement files')  
+        return(meas_info, channel_info, time_info, sig_raw, shots)
+    
+    print(f'-- {len(names)} file(s) provided!')
+    
+    heads = [try_scan_buffer(buffer) for buffer in buffers_in]
+    
+    # Order the files by time using only their headers
+    order = sort_heads(heads)
+    
+    names = [names[k] for k in order]
+    heads = [heads[k] for k in order]
+    buffers_in = [buffers_in[k] for k in order]
+    
+    inspection = inspect_heads(names, heads, channels = channels, 
+                               max_bins = max_bins, max_range = max_range,
+                               layout = layout)
+    
+    if inspection == None:
+        print('---> !! Skip reading measurement files')  
+        return(meas_info, channel_info, time_info, sig_raw, shots)
+    
+    keep, meas_info, channel_info, nread = inspection
+    
+    names = [names[k] for k in keep]
+    heads = [heads[k] for k in keep]
+    buffers_in = [buffers_in[k] for k in keep]
+    
+    outputs = decode_files(names, nread = nread, heads = heads, 
+                           workers = workers, 
+                           executor = executor, 
+                           buffers = ((buffer, None) for buffer in buffers_in))
+    
+    time_info, sig_raw, shots = \
+        read_block(names, channel_info = channel_info, outputs = outputs,
+                   dtype = np.float32 if compact else float)
+    
+    return(meas_info, channel_info, time_info, sig_raw, shots)
+
+def scan_folder(dir_meas, mcode, channels = None, max_bins = None, 
+                max_range = None, workers = 1, layout = None):
+    
+    """ Lists the raw files of the folder and reads their headers (first 
+    pass). Only the first few KB of each file are read. Returns the time 
+    ordered files, their headers, the measurement and channel information,
+    and the bins that will be read per channel (see select_bins). The 
+    bins of each channel are the maximum over all headers, so that the 
+    signals can be allocated once. The metadata are taken from the first
+    file in time. The headers are checked by preflight and only the files
+    with the given channel layout (by default the layout of the first file
+    in time) are kept. Returns None if there are no files to read"""
+
+    if not(archive.exists(dir_meas)):
         print('---- Warning : The folder for reading signals does not exist! '+\
               f'Check the input directory! \n Given folder: {dir_meas}')
+        return(None)
+        
+    mfiles = archive.glob(dir_meas, mcode + '*')
+        
+    if len(mfiles) == 0:
+        print('---- Warning! Folder empty \n'+\
+              f'---> !! Skip reading measurement files from folder {dir_meas}')  
+        return(None)
+
+    # for existing directory and files inside it, starts the reading of files     
+    print(f'-- Folder contains {len(mfiles)} file(s)!')
+    
+    # Order the files by time using only their headers
+    mfiles, heads = sort_files(mfiles, workers = workers)
+    
+    inspection = inspect_heads(mfiles, heads, channels = channels, 
+                               max_bins = max_bins, max_range = max_range,
+                               layout = layout)
+    
+    if inspection == None:
+        print(f'---> !! Skip reading measurement files from folder {dir_meas}')  
+        return(None)
+    
+    keep, meas_info, channel_info, nread = inspection
+    
+    mfiles = [mfiles[k] for k in keep]
+    heads = [heads[k] for k in keep]
+    
+    return(mfiles, heads, meas_info, channel_info, nread)
+
+def inspect_heads(names, heads, channels = None, max_bins = None, 
+                  max_range = None, layout = None):
+    
+    """ Checks the time ordered headers of the files with preflight and keeps
+    only the files with the given channel layout (by default the layout of
+    the first file in time). Returns the indexes of the kept files, the 
+    measurement and channel information of the first kept file, and the 
+    bins that will be read per channel (see select_bins). The bins of each
+    channel are the maximum over all kept headers, so that the signals can
+    be allocated once. Returns None if no file can be read"""
+    
+    layouts = preflight(names, heads)
+    
+    if layout == None:
+        layout = next((layout_k for layout_k in layouts if layout_k != None), None)
+    
+    valid = np.array([layout_k == layout for layout_k in layouts], dtype = bool)
+    
+    if layout == None or not valid.any():
+        print(f'---- Warning! None of the files has a readable header or the channel layout {layout}')
+        return(None)
+
+    if not valid.all():
+        print(f'-- Warning! {np.sum(~valid)} file(s) will be skipped, only the files with the channel layout {layout} are read')
+    
+    keep = np.where(valid)[0]
+    
+    heads = [heads[k] for k in keep]
     
+    # Reading the licel file metadatas (header) - only for the first file
+    meas_info = pd.Series()
+    channel_info = pd.DataFrame()
+    meas_info = read_geodata(meas_info, head = heads[0])
+    meas_info = read_lasers(meas_info, head = heads[0])
+    channel_info = read_header(channel_info, head = heads[0])
+    
+    # Maximum bins per channel over all files
+    bins = np.max([head['bins'] for head in heads], axis = 0)
+
+    channel_info.loc[:,'bins'] = bins.astype(float)
+    
+    # Bins that will be read
+    nread = select_bins(channel_info, channels = channels, 
+                        max_bins = max_bins, max_range = max_range)
+    
+    # Skipped channels are removed from the channel information
+    channel_info = channel_info.loc[nread > 0,:].copy()
+    channel_info.loc[:,'bins'] = nread[nread > 0].astype(float)
+    
+    return(keep, meas_info, channel_info, nread)
+
+def read_lazy(mfiles, heads, channel_info, nread, chunk_size = 100, 
+              dtype = float, use_mmap = False, cache_dir = None):
+    
+    """ Creates the time_info, sig_raw, and shots objects without decoding
+    the files. The times and shots are taken from the headers and sig_raw
+    is a dask array with one chunk per chunk_size files. Each chunk is 
+    decoded when it is computed. A file that fails when the signals are 
+    computed raises an error because the time dimension is already fixed"""
+
+    if dask == None:
+        raise Exception("-- Error: The lazy mode requires the dask package. Please install it or disable the lazy option!")
+
+    channels = channel_info.index.values
+    bins_arr = np.arange(1., nread.max() + 1.)
+
+    start_time_arr = np.array([head['start_time'] for head in heads], 
+                              dtype = 'datetime64[ms]')
+    end_time_arr = np.array([head['end_time'] for head in heads], 
+                            dtype = 'datetime64[ms]')
+
+    shots_arr = np.array([head['shots'][nread > 0] for head in heads], 
+                         dtype = float).reshape(len(heads), len(channels))
+    
+    time_info = make_time_info(mfiles, start_time_arr, end_time_arr)
+    
+    chunks = []
+    for k in range(0, len(mfiles), chunk_size):
+        mfiles_chunk = mfiles[k:k + chunk_size]
+        chunk = dask.delayed(decode_chunk)(mfiles_chunk, nread = nread, 
+                                           heads = heads[k:k + chunk_size],
+                                           dtype = dtype,
+                                           use_mmap = use_mmap, 
+                                           cache_dir = cache_dir)
+        chunks.append(da.from_delayed(chunk, dtype = dtype,
+                                      shape = (len(mfiles_chunk), 
+                                               len(channels), 
+                                               len(bins_arr))))
+
+    sig_raw = xr.DataArray(da.concatenate(chunks, axis = 0), 
+                           coords=[time_info.index.values, channels, bins_arr],
+                           dims=['time', 'channel', 'bins']) 
+    
+    shots = xr.DataArray(shots_arr,  
+                         coords=[time_info.index.values, channels],
+                         dims=['time', 'channel'])
+    
+    return(time_info, sig_raw, shots)
+
+def decode_chunk(mfiles, nread, heads = None, dtype = float, 
+                 use_mmap = False, cache_dir = None):
+    
+    """ Decodes a chunk of files in a padded signal array (time, channel, 
+    bins). Used for the chunks of the lazy signal cube. heads are the 
+    headers of the files from the scan (see decode_file). Files inside
+    archives are decompressed in a single pass per chunk (see 
+    archive.read_members)"""
+    
+    if heads == None:
+        heads = [None] * len(mfiles)
+    
+    if len(mfiles) > 0 and archive.is_member(mfiles[0]):
+        buffers = archive.read_members(mfiles)
     else:
+        buffers = ((None, None) for fname in mfiles)
+    
+    nsel = nread[nread > 0]
+    
+    sig_arr = np.empty((len(mfiles), len(nsel), nsel.max()), dtype = dtype)
+
+    for j in range(len(nsel)):
+        sig_arr[:, j, nsel[j]:] = np.nan
+    
+    for k, (buffer, error) in zip(range(len(mfiles)), buffers):
+        try:
+            if error != None:
+                raise Exception(error)
+            blocks = decode_file(mfiles[k], nread, use_mmap, cache_dir, 
+                                 buffer = buffer, head = heads[k])[3]
+        except Exception as e:
+            raise Exception(f"-- Error: File {os.path.basename(mfiles[k])} could not be read: {repr(e)}")
+        
+        fill_slot(sig_arr[k], blocks = blocks, nread = nsel)
+    
+    return(sig_arr)
+
+def make_time_info(mfiles, start_time_arr, end_time_arr):
+    
+    """ Creates the time_info dataframe of the files. It is indexed by the 
+    end time of the files, which is also the time coordinate of the signals.
+    Files with the same start and end time get an end time 500ms after 
+    the start"""
+    
+    filename = np.empty(len(mfiles), dtype = object)
+    folder = np.empty(len(mfiles), dtype = object)
+    
+    end_time_arr = end_time_arr.copy()
+    
+    for k in range(len(mfiles)):
         
-        mfiles = glob.glob(os.path.join(dir_meas,mcode + '*'))
+        filename[k] = os.path.basename(mfiles[k])
         
-        # for existing directory and files inside it, starts the reading of files     
-        if len(mfiles) > 0:
-            print(f'-- Folder contains {len(mfiles)} file(s)!')
-            
-            buffer = read_buffer(mfiles[0])
-            sep = find_sep(buffer)
-            
-            # Reading the licel file metadatas (header) - only for the first file
-            meas_info = pd.Series()
-            channel_info = pd.DataFrame()
-            meas_info = read_geodata(meas_info, buffer = buffer, sep = sep)
-            meas_info = read_lasers(meas_info, buffer = buffer, sep = sep)
-            channel_info = read_header(channel_info, buffer = buffer, sep = sep)
+        if start_time_arr[k] == end_time_arr[k]: #only possible if the files are different by only milliseconds 
+            end_time_arr[k] = end_time_arr[k] + np.timedelta64(500, 'ms')
+            print(f'-- Warning! File {filename[k]} has the same start and end time reported (recording lasted < 1s). Please check it! ')
+             
+        if os.path.basename(os.path.dirname(mfiles[k])) in ['north', 'east', 'south', 'west', 'inner', 'outer', '+45', '-45', 'static']:
+            folder[k] = os.path.basename(os.path.dirname(mfiles[k]))
+    
+    tdata = {'folder' : folder, 
+             'filename' : filename, 
+             'start_time' : start_time_arr, 
+             'end_time' : end_time_arr}
+    
+    time_info = pd.DataFrame(tdata, index = end_time_arr)  
+    
+    return(time_info)
+
+def read_block(mfiles, channel_info, outputs, dtype = float):
+    
+    """ Collects the decoded outputs of a block of files into the time_info,
+    sig_raw, and shots objects of the block. The decoded outputs hold each 
+    channel at its native length. They are padded only here, because the
+    processing chain and the SCC format expect a common bins dimension.
+    The padding is limited to the tail of the shorter channels. The signal
+    cube is stored with the given floating point dtype. Photon counts are 
+    exact in float32 up to 2^24, well above the overflow limit (2^15).
+    The files are already time ordered, so the arrays are allocated once
+    and each file is written straight into its slot. The slots of files 
+    that fail are closed up, so no sorting or copying is needed"""
+    
+    channels = channel_info.index.values
+    bins = channel_info.bins.values.astype(int)
+    bins_arr = np.arange(1., bins.max() + 1.)
+
+    # Creating empty signal, shots, and time arrays
+    start_time_arr = np.empty(len(mfiles), dtype = 'datetime64[ms]')
+    end_time_arr = np.empty(len(mfiles), dtype = 'datetime64[ms]')
+
+    shots_arr = np.full((len(mfiles), len(channels)), np.nan)
+    sig_arr = np.empty((len(mfiles), len(channels), len(bins_arr)), dtype = dtype)
+
+    for j in range(len(channels)):
+        sig_arr[:, j, bins[j]:] = np.nan
+
+    # Files that were read
+    mfiles_read = []
+
+    # Iterate over the files, i is the next free slot
+    for k, (result, error) in enumerate(outputs):
+        
+        if error != None:
+            print(f'-- Warning! File {os.path.basename(mfiles[k])} could not be read and will be skipped: {error}')
+            continue
+        
+        i = len(mfiles_read)
+
+        start_time_arr[i], end_time_arr[i], shots_arr[i,:], blocks = result
+
+        # The only copy of the data blocks: uint32 to the float cube
+        fill_slot(sig_arr[i], blocks = blocks, nread = bins)
+        
+        mfiles_read.append(mfiles[k])
+    
+    # Views, the unused slots at the end are dropped without copying
+    if len(mfiles_read) < len(mfiles):
+        mfiles = mfiles_read
+        start_time_arr = start_time_arr[:len(mfiles)]
+        end_time_arr = end_time_arr[:len(mfiles)]
+        shots_arr = shots_arr[:len(mfiles)]
+        sig_arr = sig_arr[:len(mfiles)]
+
+    time_info = make_time_info(mfiles, start_time_arr, end_time_arr)
+
+    sig_raw = xr.DataArray(sig_arr, 
+                           coords=[time_info.index.values, channels, bins_arr],
+                           dims=['time', 'channel', 'bins']) 
+    
+    shots = xr.DataArray(shots_arr,  
+                         coords=[time_info.index.values, channels],
+                         dims=['time', 'channel'])
+
+    return(time_info, sig_raw, shots)
+
+def fill_slot(sig_slot, blocks, nread):
+    
+    """ Copies the data blocks of a file in its (channel, bins) slot of the 
+    signal array. Files with fewer bins than the maximum (nread) of a 
+    channel are padded with nans"""
+    
+    for j in range(len(blocks)):
+        sig_slot[j, :len(blocks[j])] = blocks[j]
+        if len(blocks[j]) < nread[j]:
+            sig_slot[j, len(blocks[j]):nread[j]] = np.nan
+    
+    return()
+
+def sort_files(mfiles, workers = 1):
+    
+    """ Sorts the files by the end time reported in their header, with the
+    same 500ms correction as make_time_info for files with the same start 
+    and end time. Only the first few KB of each file are read, in a thread
+    pool if workers > 1. Files with an unreadable header are placed last. 
+    Returns the sorted files and their headers (None for an unreadable 
+    header)"""
+    
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            heads = list(pool.map(try_scan_file, mfiles))
+    else:
+        heads = [try_scan_file(fname) for fname in mfiles]
+    
+    order = sort_heads(heads)
+
+    mfiles = [mfiles[k] for k in order]
+    heads = [heads[k] for k in order]
+    
+    return(mfiles, heads)
+
+def sort_heads(heads):
+    
+    """ Returns the order of the headers by end time, with the same 500ms
+    correction as make_time_info for files with the same start and end 
+    time. Unreadable headers (None) are placed last"""
+    
+    end_time = np.empty(len(heads), dtype = 'datetime64[ms]')
+    
+    for k in range(len(heads)):
+        if heads[k] == None:
+            end_time[k] = np.datetime64('NaT')
+        else:
+            end_time[k] = heads[k]['end_time']
+            if heads[k]['start_time'] == heads[k]['end_time']:
+                end_time[k] = end_time[k] + np.timedelta64(500, 'ms')
+    
+    # NaT values are sorted last, the sorting is stable for equal times
+    order = np.argsort(end_time, kind = 'stable')
+    
+    return(order)
+
+def try_scan_file(fname):
+    
+    """ Reads the header of a file and adds the file size to it. Returns
+    None if the header cannot be read"""
+    
+    try:
+        head = parse_header(read_head(fname))
+        head['size'] = archive.getsize(fname)
+    except Exception:
+        head = None
+    
+    return(head)
+
+def try_scan_buffer(buffer):
+    
+    """ Parses the header of a file buffer and adds the buffer size to it. 
+    Returns None if the header cannot be read"""
+    
+    try:
+        head = parse_header(buffer)
+        head['size'] = len(buffer)
+    except Exception:
+        head = None
+    
+    return(head)
+
+def get_layout(head):
+    
+    """ Returns the fingerprint of the channel layout of a file: a short hash
+    of the channel IDs (licel ID and laser) and acquisition modes in their
+    order in the header. The number of bins is not part of the layout, 
+    files with fewer bins are padded"""
+    
+    table = head['table']
+    
+    channels = [f"{row[header_cols.index('channel_id')]}_L{int(row[header_cols.index('laser')])}_{row[header_cols.index('acquisition_mode')]}"
+                for row in table]
+    
+    layout = hashlib.sha1('|'.join(channels).encode()).hexdigest()[:8]
+    
+    return(layout)
+
+def get_size(head):
+    
+    """ Returns the file size in bytes implied by the header: the header, the
+    separator, and one block of 4 bytes per bin plus a 2 byte terminator per 
+    channel (the terminator of the last channel is optional)"""
+    
+    return(head['sep'] + 4 + np.sum(4 * head['bins'] + 2) - 2)
+
+def preflight(mfiles, heads):
+    
+    """ Checks the consistency of the files using only their headers, no 
+    data are decoded. Reports the files with an unreadable header, the 
+    truncated files (file size below the size implied by the header), the 
+    files with a channel layout or bins different than the first file in 
+    time. Returns the layout fingerprint per file (None for the files 
+    that cannot be read)"""
+    
+    layouts = []
+    
+    for k in range(len(mfiles)):
+        
+        fname = os.path.basename(mfiles[k])
+        
+        if heads[k] == None:
+            print(f'-- Warning! File {fname} has an unreadable header and will be skipped')
+            layouts.append(None)
             
-            channels = channel_info.index.values
-            bins_arr = np.arange(1., channel_info.bins.max() + 1.)
+        elif heads[k]['size'] < get_size(heads[k]):
+            print(f"-- Warning! File {fname} is truncated ({heads[k]['size']} bytes instead of {get_size(heads[k])}) and will be skipped")
+            layouts.append(None)
+        
+        else:
+            layouts.append(get_layout(heads[k]))
+    
+    layouts_valid = [layout for layout in layouts if layout != None]
+    
+    if len(set(layouts_valid)) > 1:
+        print('-- Warning! The files have different channel layouts:')
+        for layout in unique_layouts(layouts):
+            files = [os.path.basename(mfiles[k]) for k in range(len(mfiles)) if layouts[k] == layout]
+            print(f'    Layout {layout}: {len(files)} file(s) from {files[0]} to {files[-1]}')
+    
+    valid = [k for k in range(len(mfiles)) if layouts[k] != None]
+    
+    if len(valid) > 0:
+        bins_ref = heads[valid[0]]['bins']
+        files = [os.path.basename(mfiles[k]) for k in valid 
+                 if not np.array_equal(heads[k]['bins'], bins_ref)]
+        if len(files) > 0:
+            print(f'-- Warning! {len(files)} file(s) have a different number of bins than the first file. The missing bins will be filled with nans: {files}')
+    
+    return(layouts)
 
-            # Creating empty signal, shots, and time arrays
-            start_time_arr = np.nan*np.zeros(len(mfiles), dtype = object)
-            end_time_arr = np.nan*np.zeros(len(mfiles), dtype = object)
+def unique_layouts(layouts):
+    
+    """ Returns the unique layout fingerprints in order of appearance"""
+    
+    return(list(dict.fromkeys([layout for layout in layouts if layout != None])))
 
-            shots_arr = np.nan*np.zeros((len(mfiles), len(channels)), dtype = object)
-            sig_arr = np.nan*np.zeros((len(mfiles), len(channels), len(bins_arr)), dtype = float)
+def find_layouts(dirs, mcode, workers = 1):
+    
+    """ Returns the channel layout fingerprints of the files in the folders 
+    (and their subfolders) dirs, in order of appearance in time. Used to 
+    split a conversion in one conversion per layout. Only the headers 
+    are read"""
+    
+    mfiles = []
+    for dir_meas in dirs:
+        for root, _, fnames in archive.walk(dir_meas):
+            mfiles.extend([os.path.join(root, fname) for fname in fnames 
+                           if fname.startswith(mcode)])
+    
+    mfiles, heads = sort_files(mfiles, workers = workers)
+    
+    layouts = unique_layouts([get_layout(head) for head in heads if head != None 
+                              and head['size'] >= get_size(head)])
+    
+    return(layouts)
 
-            filename = np.empty(len(mfiles), dtype = object)
-            folder = np.empty(len(mfiles), dtype = object)
+def select_bins(channel_info, channels = None, max_bins = None, max_range = None):
+    
+    """ Returns the number of bins that will be read per channel. Channels 
+    that are not in channels get 0 bins (not decoded at all). The bins are 
+    limited to max_bins and to the bins below max_range (in m)"""
+    
+    nread = channel_info.bins.values.astype(int)
+    
+    if channels is not None:
+        nread = np.where(np.isin(channel_info.index.values, channels), nread, 0)
+    
+    if max_bins != None:
+        nread = np.minimum(nread, int(max_bins))
+    
+    if max_range != None:
+        nread_range = np.ceil(max_range / channel_info.range_resolution.values)
+        nread = np.minimum(nread, nread_range.astype(int))
+    
+    if (nread <= 0).all():
+        raise Exception("-- Error: None of the selected channels was found in the licel header or no bins were selected!")
+    
+    return(nread)
 
-            # Iterate over the files
-            for k in range(len(mfiles)):
-                
-                filename[k] = os.path.basename(mfiles[k])
+def decode_files(mfiles, nread, heads = None, workers = 1, 
+                 executor = 'thread', use_mmap = False, cache_dir = None, 
+                 buffers = None):
 
-                buffer = read_buffer(mfiles[k])
+    """ Decodes the licel files serially (workers = 1) or concurrently in a 
+    thread or process pool. Yields one (result, error) pair per file in the
+    order of mfiles. A file that fails yields its error message instead of
+    stopping the rest of the files. At most 2 x workers decoded files 
+    are kept in flight so that the memory footprint stays bounded. Files 
+    inside archives are decompressed in a background thread while the 
+    previous files are decoded. If buffers is provided, it is an iterable
+    of (buffer, error) pairs per file and nothing is read from the disk.
+    heads are the headers of the files from the scan, in the order of 
+    mfiles, so that they are not parsed again (see decode_file)"""
 
-                sep = find_sep(buffer)
-                
-                stime, etime = read_time(buffer = buffer, sep = sep)
+    if heads == None:
+        heads = [None] * len(mfiles)
 
-                shots_arr[k,:] = read_shots(buffer = buffer, sep = sep)
-                
-                sig = read_body(channel_info, buffer = buffer, sep = sep)
+    if buffers == None and len(mfiles) > 0 and archive.is_member(mfiles[0]):
+        buffers = archive.read_members(mfiles, depth = 2 * workers)
+    elif buffers == None:
+        buffers = ((None, None) for fname in mfiles)
 
-                # Store signal, start and end time
-                sig_arr[k, :, :] = sig
+    if workers > 1:
 
-                start_time_arr[k] = stime
-                
-                if stime == etime: #only possible if the files are different by only milliseconds 
-                    end_time_arr[k] = etime + timedelta(milliseconds = 500)
-                    print(f'-- Warning! File {filename[k]} has the same start and end time reported (recording lasted < 1s). Please check it! ')
-                else:
-                    end_time_arr[k] = etime
-
-                     
-                if (mfiles[k]).split(os.sep)[-2] in ['north', 'east', 'south', 'west', 'inner', 'outer', '+45', '-45', 'static']:
-                    folder[k] = (mfiles[k]).split(os.sep)[-2]
+        pools = {'thread' : ThreadPoolExecutor,
+                 'process' : ProcessPoolExecutor}
+
+        if executor not in pools.keys():
+            raise Exception(f"-- Error: executor not recognized. Please use one of {list(pools.keys())}")
+
+        with pools[executor](max_workers = workers) as pool:
             
-            sig_raw = xr.DataArray(sig_arr, 
-                                   coords=[end_time_arr, channels, bins_arr],
-                                   dims=['time', 'channel', 'bins']) 
+            pending = deque()
             
-            shots = xr.DataArray(shots_arr,  
-                                 coords=[end_time_arr, channels],
-                                 dims=['time', 'channel'])
+            for fname, head, (buffer, error) in zip(mfiles, heads, buffers):
+                if error != None:
+                    pending.append(pool.submit(failed, error))
+                    continue
+                pending.append(pool.submit(try_decode_file, fname, nread, 
+                                           use_mmap, cache_dir, buffer, head))
+                if len(pending) >= 2 * workers:
+                    yield(get_output(pending.popleft()))
             
-            tdata = np.array([folder, filename, 
-                              start_time_arr, end_time_arr], dtype = object)
+            while len(pending) > 0:
+                yield(get_output(pending.popleft()))
 
-            properties = ['folder', 'filename', 'start_time', 'end_time']
-            
-            time_info = pd.DataFrame(tdata.T,  
-                                     index = end_time_arr,
-                                     columns = properties)  
-                        
-            # Sort by time
-            sig_raw = sig_raw.sortby('time').copy()
-            shots = shots.sortby('time').copy()
-            time_info = time_info.sort_index()
-            
-        else:
-            print('---- Warning! Folder empty \n'+\
-                  f'---> !! Skip reading measurement files from folder {dir_meas}')  
+    else:
+        for fname, head, (buffer, error) in zip(mfiles, heads, buffers):
+            if error != None:
+                yield(failed(error))
+                continue
+            yield(try_decode_file(fname, nread, use_mmap, cache_dir, buffer,
+                                  head))
 
-    return(meas_info, channel_info, time_info, sig_raw, shots)
+def get_output(future):
 
+    """ Collects the output of a pool task. Covers also the failures that
+    happen outside of try_decode_file (e.g. a worker process was killed)"""
 
-def read_body(channel_info, buffer, sep):
-    
-    """ Reads the information from the raw licel files below the header.
-    Blocks are separated by #"""
+    try:
+        output = future.result()
+    except Exception as e:
+        output = (None, repr(e))
 
-    data = buffer[sep+4:]
+    return(output)
 
-    max_bins = int(channel_info.bins.max())
+def failed(error):
 
-    n_channels = len(channel_info.index)
-    
-    # Parse data into dataframe    
-    sig_raw_arr = []
+    """ Returns the output of a file that could not be read"""
+
+    return((None, error))
+
+def try_decode_file(fname, nread, use_mmap = False, cache_dir = None, 
+                    buffer = None, head = None):
+
+    """ Wraps decode_file so that an exception is returned as an error 
+    message instead of being raised inside the pool"""
 
-    nbin_s = 0
-    sig_raw_arr = np.nan*np.zeros((n_channels, max_bins))
+    try:
+        output = (decode_file(fname, nread, use_mmap, cache_dir, buffer, 
+                              head), None)
+    except Exception as e:
+        output = (None, repr(e))
 
-    for j in range(n_channels):
-        nbins = int(channel_info.bins.iloc[j])
-        nbin_e = nbin_s + 4*nbins
-        icount = 0
-        for i in range(nbin_s, nbin_e, 4):
-            sig_raw_arr[j,icount] = int.from_bytes(data[i:i+4], 
-                                                   byteorder = 'little')
-            icount = icount + 1
+    return(output)
 
-        nbin_s = nbin_e + 2
+def decode_file(fname, nread, use_mmap = False, cache_dir = None, 
+                buffer = None, head = None):
+
+    """ Reads and decodes a single licel file. Only plain numpy objects are
+    returned [start time, end time, shots, data blocks] so that the function
+    can run cheaply in a process pool. The data blocks are uint32 views of 
+    the file buffer with the native number of bins of each channel, as 
+    reported in the header of the file. Only the first nread bins of each 
+    channel are kept (nread = 0 skips the channel). With a cache_dir the 
+    result is loaded from or stored to the decoding cache. The buffer is
+    read from the file unless it is provided (e.g. from an archive). The 
+    header is parsed only if it is not provided (head, from the scan)"""
+
+    if cache_dir != None:
+        result = cache.load(cache_dir, fname, nread)
+        if result != None:
+            return(result)
+
+    if buffer is None:
+        buffer = read_buffer(fname, use_mmap = use_mmap)
+
+    if head == None:
+        head = parse_header(buffer)
     
-    return(sig_raw_arr)
+    bins = head['bins']
+
+    if len(bins) != len(nread):
+        raise Exception(f"-- Error: The file contains {len(bins)} channels instead of {len(nread)}!")
+
+    blocks = read_body(bins, buffer = buffer, sep = head['sep'], 
+                       nread = np.minimum(nread, bins))
+
+    result = (head['start_time'], head['end_time'], 
+              head['shots'][nread > 0], blocks)
+
+    if cache_dir != None:
+        cache.store(cache_dir, fname, bins, nread, result = result)
+
+    return(result)
+
+def read_body(bins, buffer, sep, nread = None):
+
+    """ Reads the information from the raw licel files below the header.
+    Each channel data block is interpreted as a little endian uint32 array 
+    without copying the buffer (a view). Each block holds 4 bytes per bin
+    and is followed by a 2 byte terminator (\r\n). If nread is provided 
+    only the first nread bins of each channel are returned and the channels
+    with nread = 0 are skipped"""
+
+    if nread is None:
+        nread = bins
+
+    offsets = sep + 4 + np.concatenate(([0], np.cumsum(4 * bins + 2)[:-1]))
+
+    if offsets[-1] + 4 * bins[-1] > len(buffer):
+        raise Exception("-- Error: The licel file is shorter than the size implied by its header. Is the file truncated?")
+
+    blocks = [np.frombuffer(buffer, dtype = '<u4', count = int(nread[j]),
+                            offset = int(offsets[j]))
+              for j in range(len(bins)) if nread[j] > 0]
+
+    return(blocks)
 
 def find_sep(buffer):
     
     """ Identifies the location of the header separator field: \r\n\r\n"""
     
-    search_sequence = bytearray("\r\n\r\n", encoding="utf-8")
-    i = 0
-    while buffer[i:i+4] != search_sequence:
-        i = i + 1
-        if i >= len(buffer):
-            raise Exception("Could not find header/data separator. Is this a licel file?")
-    sep = i     
+    sep = buffer.find(b"\r\n\r\n")
+
+    if sep < 0:
+        raise Exception("Could not find header/data separator. Is this a licel file?")
     
     return(sep)
 
-def read_geodata(meas_info, buffer, sep):
+def parse_header(buffer):
+
+    """ Tokenizes the licel header once and returns a dictionary with the
+    header/data separator position, the geodata and laser rows, the channel
+    table (one row per channel), the start and end times as datetime64, and 
+    the shots and bins per channel as integer arrays"""
+
+    sep = find_sep(buffer)
+
+    # sep points to the start of the separator, AKA end of header
+    header = str(buffer[0:sep-1], encoding="utf-8").split("\r\n")
+
+    geodata = header[1].split()
+
+    lasers = header[2].split()
+
+    # Header rows
+    table = np.array([line[1:].split()[:len(header_cols)] for line in header[3:]], 
+                     dtype = object)
+
+    start_time = to_datetime64(date = geodata[1], time = geodata[2])
+
+    end_time = to_datetime64(date = geodata[3], time = geodata[4])
+
+    shots = table[:,header_cols.index('shots')].astype(int)
+
+    bins = table[:,header_cols.index('bins')].astype(int)
+
+    head = {'sep' : sep,
+            'geodata' : geodata,
+            'lasers' : lasers,
+            'table' : table,
+            'start_time' : start_time,
+            'end_time' : end_time,
+            'shots' : shots,
+            'bins' : bins}
+
+    return(head)
+
+def to_datetime64(date, time):
+
+    """ Converts the licel date (dd/mm/yyyy) and time (HH:MM:SS) fields to 
+    a datetime64 without going through strptime"""
+
+    day, month, year = date.split('/')
+
+    return(np.datetime64(f'{year}-{month:0>2}-{day:0>2}T{time}', 's'))
+
+def read_geodata(meas_info, head):
 
     """ Retrieves location and geometry relevant information from 
     the licel header [altitude, latitude, longitude, 
     zenith angle, azimuth angle]"""
 
-    # Now i points to the start of search_sequence, AKA end of header
-    header_bytes = buffer[0:sep-1]
-    
-    # Convert header to text, parse metadata
-    header = str(header_bytes, encoding="utf-8").split("\r\n")
-
-    metadata = header[1].split()
+    metadata = head['geodata']
 
     # cfg.lidar['location'] = metadata[0]
 
@@ -189,19 +918,13 @@ def read_geodata(meas_info, buffer, sep):
 
     return(meas_info)
 
-def read_lasers(meas_info, buffer, sep):
+def read_lasers(meas_info, head):
 
     """ Retrieves laser relevant information from 
     the licel header [laser A repetion rate, laser B repetion rate if it exists
     laser C repetion rate if it exists]"""
     
-    # Now i points to the start of search_sequence, AKA end of header
-    header_bytes = buffer[0:sep-1]
-    
-    # Convert header to text, parse metadata
-    header = str(header_bytes, encoding="utf-8").split("\r\n")
-
-    metadata = header[2].split()
+    metadata = head['lasers']
 
     meas_info['laser_A_repetition_rate'] = float(metadata[1])
 
@@ -213,30 +936,7 @@ def read_lasers(meas_info, buffer, sep):
         
     return(meas_info)
 
-def read_time(buffer, sep):
-    
-    """ Retrieves temporal information from 
-    the licel header [start time, stop time]"""
-
-    # Now i points to the start of search_sequence, AKA end of header
-    header_bytes = buffer[0:sep-1]
-    
-    # Convert header to text, parse metadata
-    header = str(header_bytes, encoding="utf-8").split("\r\n")
-
-    metadata = header[1].split()
-
-    start_date = metadata[1]
-    start_time = metadata[2]
-    end_date = metadata[3]
-    end_time = metadata[4]
-
-    stime = dt.strptime(start_date + ' ' + start_time, "%d/%m/%Y %H:%M:%S") # start meas
-    etime = dt.strptime(end_date + ' ' + end_time, "%d/%m/%Y %H:%M:%S") # start meas
-        
-    return(stime, etime)
-
-def read_header(channel_info, buffer, sep):
+def read_header(channel_info, head):
     
     """ Collects channel specific information from the licel header
     [analog/photon mode (0/1), laser number (A,B,C), number of range bins,
@@ -244,23 +944,9 @@ def read_header(channel_info, buffer, sep):
      ADC range in mV (20,100,500), ADC bit used for the bit to mV conversion
      laser repetiotion rate, detected wavelength, channel polarization] """
 
-    cols = ['active', 'acquisition_mode', 'laser', 'bins', 
-            'laser_polarization', 'pmt_high_voltage', 'range_resolution', 
-            'wave_pol', 'unk1', 'unk2', 'unk3', 'unk4', 
-            'analog_to_digital_resolution', 'shots', 'data_acquisition_range',
-            'channel_id']
-
-    # Now i points to the start of search_sequence, AKA end of header
-    header_bytes = buffer[0:sep-1]
-    
-    # Convert header to text, parse metadata
-    header = str(header_bytes, encoding="utf-8").split("\r\n")
-
-    # Header rows
-    header = np.array([line[1:].split()[:len(cols)] for line in header[3:]], 
-                      dtype = object)
+    header = head['table']
 
-    arr_head = pd.DataFrame(header, columns = cols, dtype = object)
+    arr_head = pd.DataFrame(header, columns = header_cols, dtype = object)
 
     # Produce the channel ID from the licel channel ID and the laser polarization    
     channel_ID = []
@@ -287,38 +973,42 @@ def read_header(channel_info, buffer, sep):
 
     return(channel_info)
 
-def read_shots(buffer, sep):
-    
-    """ Gets the number of shots for each channel and file"""
-
-
-    cols = ['active', 'acquisition_mode', 'laser', 'bins', 
-            'laser_polarization', 'pmt_high_voltage', 'range_resolution', 
-            'wave_pol', 'unk1', 'unk2', 'unk3', 'unk4', 
-            'analog_to_digital_resolution', 'shots', 'data_acquisition_range',
-            'channel_id']
-
-    # Now i points to the start of search_sequence, AKA end of header
-    header_bytes = buffer[0:sep-1]
-    
-    # Convert header to text, parse metadata
-    header = str(header_bytes, encoding="utf-8").split("\r\n")
-
-    # Header rows
-    header = np.array([line[1:].split()[:len(cols)] for line in header[3:]], 
-                      dtype = object)
-    
-    ind_shots = np.where(np.array(cols) == 'shots')[0][0]
+def read_buffer(fname, use_mmap = False):
+       
+    """ Reads the binary file as a single byte sequence (buffer). With 
+    use_mmap the file is memory-mapped instead. The map is released when
+    the last array view on it is garbage collected. Files inside archives
+    are always read in memory"""
     
-    shots = header[:,ind_shots].astype(int)
+    if archive.is_member(fname):
+        return(archive.read(fname))
     
-    return(shots)
+    with open(fname, 'rb') as f:
+        if use_mmap:
+            buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            buffer = f.read()
+        
+    return(buffer)
 
-def read_buffer(fname):
+def read_head(fname, chunk = 4096):
        
-    """ Reads the binary file as a single byte sequence (buffer)"""
+    """ Reads only the header of the licel file, in chunks of a few KB 
+    until the header/data separator is found. For files inside archives
+    the first KB are taken from the archive index"""
+    
+    if archive.is_member(fname):
+        buffer = archive.read_head(fname)
+        if buffer.find(b"\r\n\r\n") < 0:
+            buffer = archive.read(fname)
+        return(buffer)
     
     with open(fname, 'rb') as f:
-        buffer = f.read()
+        buffer = f.read(chunk)
+        while buffer.find(b"\r\n\r\n") < 0:
+            buffer_next = f.read(chunk)
+            if len(buffer_next) == 0:
+                break
+            buffer = buffer + buffer_next
         
-    return(buffer)
\ No newline at end of file
+    return(buffer)
@@ -9,122 +9,291 @@ import numpy as np
 import os
 import xarray as xr
 
+try:
+    import dask
+except ImportError:
+    dask = None
 
-def dtfs(dir_meas, cfg, cal_angle=0.):
+# Channel IDs of the PollyXT channels in the order of the channel dimension
+raw_channels = ['355_total','355_cross','387','407','532_total','532_cross',
+                '607','1064','532_NR','607_NR','355_NR','387_NR']
+
+# Range resolution of the PollyXT raw signals in m
+range_resolution = 7.5
+
+# Depolarization calibrator angle (depol_cal_angle) per measurement
+cal_angles = {'nrm' : 0., '+45' : 45., '-45' : -45.}
+
+def dtfs(dir_meas, mcode, cal_angle = 0., channels = None, max_bins = None,
+         max_range = None, compact = False, lazy = False, chunk_size = 100,
+         **options):
+
+    """ Reads the raw PollyXT NetCDF files of dir_meas. Only the profiles
+    with a depol_cal_angle equal to cal_angle are kept. Only the metadata
+    of the files are read in full, the signals are read only for the 
+    selected profiles, channels, and bins. Returns the same (meas_info,
+    channel_info, time_info, sig_raw, shots) as read_licel.dtfs, the 
+    signals are in counts. The channels are named as the licel channels
+    (channel_id_Llaser, see get_channel_names). The channels, max_bins, 
+    max_range, compact, lazy, and chunk_size arguments work as in 
+    read_licel.dtfs. The rest of the licel reader options (options) do not
+    apply and are ignored"""
+
+    # Setting sig, info, and time as empty lists in the beggining
+    sig_raw = []
+    shots = []
+
+    meas_info = []
+    channel_info = []
+    time_info = []
+
+    raw_polly = read_folder(dir_meas, mcode = mcode, lazy = lazy,
+                            chunk_size = chunk_size)
+
+    if raw_polly == None:
+        return(meas_info, channel_info, time_info, sig_raw, shots)
+
+    datasets, profiles = raw_polly
+
+    # The lazy signals reopen the files when they are computed
+    try:
+        mask = profiles['depol_cal_angle'] == cal_angle
+
+        if not mask.any():
+            print(f'---- Warning! No profiles with a calibrator angle of {cal_angle} were found \n'+\
+                  f'---> !! Skip reading measurement files from folder {dir_meas}')
+            return(meas_info, channel_info, time_info, sig_raw, shots)
+
+        meas_info, channel_info, time_info, sig_raw, shots = \
+            to_licel(datasets, profiles = profiles, mask = mask, 
+                     channels = channels, max_bins = max_bins,
+                     max_range = max_range, compact = compact, lazy = lazy)
     
-    # Get raw lidar files code from the ini file
-    m_code = cfg.lidar.m_code
-        
-    sig_raw, sig_raw_dev = [], []     
-    info, info_dev = [], []
-    ground_alt, SZA, azimuth = [], [], []
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    return(meas_info, channel_info, time_info, sig_raw, shots)
+
+def read_folder(dir_meas, mcode, lazy = False, chunk_size = 100):
     
+    """ Opens the PollyXT NetCDF files of the folder without reading the 
+    signals. With lazy the signals are dask arrays in chunks of chunk_size
+    profiles (requires dask). Returns the datasets and a dictionary with
+    the file position (file), the position in the file (profile), the 
+    filename, the time (measurement_time), the calibrator angle 
+    (depol_cal_angle), and the shots (measurement_shots) of all the 
+    profiles. Returns None if there are no files"""
+
     if not(os.path.exists(dir_meas)):
-        print('---- Error : The folder for reading signals does not exist! \r\n' +\
-              f'---- Check the input directory! \n Given folder: {dir_meas}')
-        #sys.exit(0)
+        print('---- Warning : The folder for reading signals does not exist! '+\
+              f'Check the input directory! \n Given folder: {dir_meas}')
+        return(None)
+
+    mfiles = sorted(glob.glob(os.path.join(dir_meas,'*' + mcode + '*.nc')))
+
+    if len(mfiles) == 0:
+        print('---- Warning! Folder empty \n'+\
+              f'---> !! Skip reading measurement files from folder {dir_meas}')
+        return(None)
+
+    print(f'-- Folder contains {len(mfiles)} file(s)!')
+
+    if lazy and dask == None:
+        raise Exception("-- Error: The lazy mode requires the dask package. Please install it or disable the lazy option!")
+
+    chunks = {'time' : chunk_size} if lazy else None
+
+    # Only the metadata are read here
+    datasets = [xr.open_dataset(fname, chunks = chunks) for fname in mfiles]
+
+    sizes = [ds.sizes['time'] for ds in datasets]
+
+    profiles = {'file' : np.repeat(np.arange(len(mfiles)), sizes),
+                'profile' : np.concatenate([np.arange(size) for size in sizes]),
+                'filename' : np.repeat([os.path.basename(fname) for fname in mfiles], sizes).astype(object)}
+
+    for key in ['measurement_time', 'depol_cal_angle', 'measurement_shots']:
+        profiles[key] = np.concatenate([np.asarray(ds[key].values) for ds in datasets])
+
+    profiles['measurement_time'] = meas_time_to_npdatetime(profiles['measurement_time'])
+
+    return(datasets, profiles)
+
+def to_licel(datasets, profiles, mask, channels = None, max_bins = None,
+             max_range = None, compact = False, lazy = False):
+
+    """ Converts the profiles of the PollyXT datasets selected by mask to the
+    structure of the licel reader (see dtfs). The profiles are sorted by
+    time. The measurement time of a profile is used as its end time and
+    the start time is derived from the shots and the laser repetition rate.
+    The metadata are taken from the first file. Only the selected part of 
+    the signals is read, file by file (or lazily with dask)"""
+
+    ds = datasets[0]
+
+    rep_rate = float(ds.laser_rep_rate.values)
+
+    n_channels = ds.sizes['channel']
+
+    if n_channels == len(raw_channels):
+        channel_id = np.array(raw_channels, dtype = object)
+    else:
+        channel_id = np.array([f'channel_{j + 1}' for j in range(n_channels)], dtype = object)
+
+    channel_names = get_channel_names(channel_id)
+
+    # Channels and bins that will be read
+    if channels is not None:
+        ch_sel = np.where(np.isin(channel_names, channels))[0]
+    else:
+        ch_sel = np.arange(n_channels)
+
+    if len(ch_sel) == 0:
+        raise Exception("-- Error: None of the selected channels was found in the PollyXT channels!")
+
+    nread = ds.sizes['height']
+
+    if max_bins != None:
+        nread = min(nread, int(max_bins))
+
+    if max_range != None:
+        nread = min(nread, int(np.ceil(max_range / range_resolution)))
+
+    # Time ordered profiles
+    end_time_arr = profiles['measurement_time'][mask].astype('datetime64[ms]')
+
+    order = np.argsort(end_time_arr, kind = 'stable')
+
+    t_sel = np.where(mask)[0][order]
+
+    end_time_arr = end_time_arr[order]
+
+    shots_arr = profiles['measurement_shots'][t_sel, :][:, ch_sel].astype(float)
+
+    duration = (1E3 * np.nanmax(shots_arr, axis = 1) / rep_rate).astype('timedelta64[ms]')
+
+    start_time_arr = end_time_arr - duration
+
+    bins_arr = np.arange(1., nread + 1.)
+
+    dtype = np.float32 if compact else float
+
+    if lazy:
+        # Still lazy at this point, only the selected part is read when computed
+        raw_signal = xr.concat([ds_i.raw_signal for ds_i in datasets], dim = 'time')
+        
+        sig_arr = raw_signal.isel(time = t_sel, channel = ch_sel, 
+                                  height = slice(0, nread))\
+            .transpose('time', 'channel', 'height').data.astype(dtype)
     
     else:
+        sig_arr = np.empty((len(t_sel), len(ch_sel), nread), dtype = dtype)
         
-        mfiles = glob.glob(os.path.join(dir_meas,'*'+m_code + '*.nc'))
+        file_pos = profiles['file'][t_sel]
         
-        if len(mfiles)>0:
-            print(f'-- Folder contains {len(mfiles)} file(s)!')
-            
-            list_sig = []
-            
-            for fname in mfiles: 
-            
-                raw_polly = xr.open_dataset(fname)
-
-                # Mask normal measurements from routine calibration measurements (True:norm / False:clb)
-                # Mask measurements (normal, +45, -45) according to cal_angle (True:norm or +45 or -45 / False:other)                
-                mask_nrm = (raw_polly.depol_cal_angle.values == cal_angle)
-                # xarray with dims [time, bins, channel]
-                raw_signal = raw_polly.raw_signal[mask_nrm,:,:].values.astype(float)
-                
-                # convert the time to npdatetime format and mask them
-                meas_time = meas_time_to_npdatetime(raw_polly.measurement_time)                
-                meas_time= np.array(meas_time)[mask_nrm]
-
-                # Convert the signal from counts to MHz                
-                # rep = raw_polly.laser_rep_rate.values
-                # shots = raw_polly.measurement_shots[mask_nrm,:].values.astype(float)
-
-                # for k in range(raw_signal.shape[0]):
-                    # for j in range(raw_signal.shape[2]):
-                        # raw_signal[k,:,j] = raw_signal[k,:,j]*rep/shots[k,j]
-
-                # Define temporal xarray
-                arr = xr.DataArray(data = raw_signal, 
-                                   dims=['time','height','channel'],
-                                   coords=[meas_time, raw_polly.height.values, raw_polly.channel.values],
-                                   name='signals')
-                # append the xarray to a list
-                list_sig.append(arr)
-            
-            # Append in the time dimension all the time frames
-            sig_raw = xr.concat(list_sig, dim='time')
-            
-            # Transpose the dims in [time, channel, bins]            
-            sig_raw = sig_raw.transpose('time','channel','height')
-            
-            # channels IDs
-            raw_channels = ['355_total','355_cross','387','407','532_total','532_cross',
-                            '607','1064','532_NR','607_NR','355_NR','387_NR']
-            
-            channels = raw_to_config(raw_channels, cfg.ch_list)
-            sig_raw = signal.change_dim(sig_raw.copy(), 'channel', 'channel', channels)
-
-            # Bins
-            bins = raw_polly.raw_signal.height.values + 1            
-            sig_raw = signal.change_dim(sig_raw.copy(), 'height', 'bins', bins)            
-
-            
-            # Create the info dataframe from the last file            
-            # Setting info Dataframe            
-            info = pd.DataFrame(index = channels,
-                                columns = ['ch_mode', 'bins', 'laser_pol', 'resol',
-                                           'shots', 'ADC_range', 'ADC_bit'], 
-                                dtype = object)
-            
-            info.loc[:, 'laser_pol'] =  1
-            info.loc[:, 'ch_mode'] = 1.
-            info.loc[:, 'shots'] = raw_polly.measurement_shots.values[-1,:] 
-            info.loc[:, 'bins'] = bins[-1]
-            info.loc[:, 'wave'] = raw_polly.if_center.values
-            info.loc[:, 'resol'] = 7.5
-            info.loc[:, 'ch_pol'] = np.array(['o', 's', 'o', 'o', 'o', 's', 'o', 'o', 'o', 'o', 'o','o'])
-            info.loc[:, 'ADC_range'] = 0.
-            info.loc[:, 'sampl_rate'] =  raw_polly.laser_rep_rate.values
-            
-            # Sort by time
-            sig_raw = sig_raw.sortby('time')
-            
-            # Analog units conversion from bits to mV for analog 
-            # and summed counts to MHz for photon
-            sig_raw = signal.unit_conv(sig_raw, info)
-                
-            # Sort by channel
-            #sig_raw = sig_raw.sortby('channel')
-            #info = info.sort_index()
-            
-            SZA = raw_polly.zenithangle.values
-            ground_alt = raw_polly.location_height.values
-            azimuth = 0.
-
-    return(sig_raw, sig_raw_dev, info, info_dev, ground_alt, SZA, azimuth)
+        # The profiles of each file are read in increasing order
+        for i in np.unique(file_pos):
+            rows = np.where(file_pos == i)[0]
+            rows = rows[np.argsort(profiles['profile'][t_sel[rows]], kind = 'stable')]
+            raw_signal = datasets[i].raw_signal.isel(time = profiles['profile'][t_sel[rows]], 
+                                                     channel = ch_sel,
+                                                     height = slice(0, nread))
+            sig_arr[rows] = raw_signal.transpose('time', 'channel', 'height').values
+
+    time_info = pd.DataFrame({'folder' : np.empty(len(t_sel), dtype = object),
+                              'filename' : profiles['filename'][t_sel],
+                              'start_time' : start_time_arr,
+                              'end_time' : end_time_arr},
+                             index = end_time_arr)
+
+    sig_raw = xr.DataArray(sig_arr,
+                           coords = [end_time_arr, channel_names[ch_sel], bins_arr],
+                           dims = ['time', 'channel', 'bins'])
+
+    shots = xr.DataArray(shots_arr,
+                         coords = [end_time_arr, channel_names[ch_sel]],
+                         dims = ['time', 'channel'])
+
+    meas_info = read_meas_info(ds)
+
+    channel_info = read_channel_info(ds, channel_id = channel_id,
+                                     nread = nread).iloc[ch_sel,:].copy()
+
+    return(meas_info, channel_info, time_info, sig_raw, shots)
+
+def read_meas_info(ds):
+
+    """ Retrieves the location, geometry, and laser information of the
+    PollyXT dataset with the same keys as the licel reader"""
+
+    meas_info = pd.Series(dtype = object)
+
+    meas_info['altitude'] = float(ds.location_height.values)
+
+    if 'location_coordinates' in ds.variables:
+        meas_info['latitude'] = float(ds.location_coordinates.values[0])
+        meas_info['longitude'] = float(ds.location_coordinates.values[1])
+
+    meas_info['zenith_angle'] = float(ds.zenithangle.values)
+
+    meas_info['azimuth_angle'] = 0.
+
+    meas_info['laser_A_repetition_rate'] = float(ds.laser_rep_rate.values)
+
+    return(meas_info)
+
+def read_channel_info(ds, channel_id, nread):
+
+    """ Creates the channel information of the PollyXT channels with the
+    same columns and channel names as the licel reader. All the channels 
+    are photon counting channels of laser A"""
+
+    channel_info = pd.DataFrame(index = get_channel_names(channel_id))
+
+    channel_info.loc[:, 'channel_id'] = channel_id
+    channel_info.loc[:, 'acquisition_mode'] = 1.
+    channel_info.loc[:, 'laser'] = 1.
+    channel_info.loc[:, 'bins'] = float(nread)
+    channel_info.loc[:, 'laser_polarization'] = 1.
+
+    if 'pm_voltage' in ds.variables:
+        channel_info.loc[:, 'pmt_high_voltage'] = ds.pm_voltage.values.astype(float)
+    else:
+        channel_info.loc[:, 'pmt_high_voltage'] = np.nan
+
+    channel_info.loc[:, 'range_resolution'] = range_resolution
+    channel_info.loc[:, 'data_acquisition_range'] = np.nan
+    channel_info.loc[:, 'analog_to_digital_resolution'] = np.nan
+    channel_info.loc[:, 'detected_wavelength'] = ds.if_center.values.astype(float)
+
+    return(channel_info)
+
+def get_channel_names(channel_id):
+
+    """ Returns the channel names of the PollyXT channels in the same format
+    as the licel channel names and the configuration file (channel_id_Llaser).
+    All the channels belong to laser A (L1)"""
+
+    return(np.array([f'{channel_id_i}_L1' for channel_id_i in channel_id], dtype = object))
 
 def meas_time_to_npdatetime(meas_time):
-    # meas_time: 2d array : [times, 2], 2: [yyyymmdd, second of day]
-    t_dims = np.shape(meas_time)
-    npdatetime = []
-    
-    for i in range(t_dims[0]): 
-        temp_str = str(meas_time.values[i][0])
-        hr = np.divide(meas_time.values[i][1],(60*60)); minute = (hr - np.fix(hr))*60; sec = (minute - np.fix(minute))*60
-        date = temp_str[0:4]+'-'+temp_str[4:6]+'-'+temp_str[6:8]+'T'+"%02d" %np.fix(hr)+':'+"%02d" %np.fix(minute)+':'+"%02d" %np.fix(sec)
-        npdatetime.append(np.datetime64(date))
-    
-    return(npdatetime)
 
+    """ Converts the PollyXT measurement_time [yyyymmdd, second of day] of
+    all profiles at once to datetime64 (s). The seconds are truncated"""
+
+    ymd = meas_time[:, 0].astype(int)
+
+    sod = meas_time[:, 1].astype(int)
+
+    year = (ymd // 10000 - 1970).astype('datetime64[Y]')
+
+    month = (ymd // 100 % 100 - 1).astype('timedelta64[M]')
+
+    day = (ymd % 100 - 1).astype('timedelta64[D]')
+
+    npdatetime = (year + month).astype('datetime64[D]') + day
+
+    npdatetime = npdatetime.astype('datetime64[s]') + sod.astype('timedelta64[s]')
+
+    return(npdatetime)
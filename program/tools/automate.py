@@ -1,10 +1,11 @@
 """
 @author: Peristera
 """
-import os, sys
+import sys, json
 import numpy as np
 import xarray as xr
 import pandas as pd
+from readers import archive
 
 def get_meas_type(args):
 
@@ -21,18 +22,18 @@ def get_meas_type(args):
             'pcl_p45' : args['pol_cal_p45_folder'],
             'pcl_m45' : args['pol_cal_m45_folder']}                                        
         
-    if os.path.exists(dirs['ray']): 
+    if archive.exists(dirs['ray']): 
         meas_type.append('rayleigh')
 
-    if os.path.exists(dirs['tlc_sec']) or os.path.exists(dirs['tlc_rin']): 
+    if archive.exists(dirs['tlc_sec']) or archive.exists(dirs['tlc_rin']): 
         meas_type.append('telecover')
 
-    if (os.path.exists(dirs['pcl_p45']) and os.path.exists(dirs['pcl_m45'])) \
-        or os.path.exists(dirs['pcl_stc']):
+    if (archive.exists(dirs['pcl_p45']) and archive.exists(dirs['pcl_m45'])) \
+        or archive.exists(dirs['pcl_stc']):
         meas_type.append('polarization_calibration')
 
-    if os.path.exists(dirs['drk']) and \
-        all([not(os.path.exists(dirs[key])) 
+    if archive.exists(dirs['drk']) and \
+        all([not(archive.exists(dirs[key])) 
              for key in dirs.keys() if key != 'drk']):
         meas_type.append('standalone_dark')
     
@@ -47,11 +48,11 @@ def check_telecover_sec(path, files_per_sector):
     """Ensures that the telecover folder is properly set, otherwise it raises 
     an error """
         
-    if os.path.exists(path):
+    if archive.exists(path):
     
         allowed_folders = ['north', 'east', 'south', 'west']
 
-        list_dirs = [dir_i for dir_i in os.listdir(path)]
+        list_dirs = [dir_i for dir_i in archive.listdir(path)]
 
         unk_folder = [dir_i not in allowed_folders for dir_i in list_dirs]
 
@@ -78,11 +79,11 @@ def check_telecover_rin(path, files_per_ring):
     """Ensures that the telecover folder is properly set, otherwise it raises 
     an error """
         
-    if os.path.exists(path):
+    if archive.exists(path):
     
         allowed_folders = ['inner', 'outer']
 
-        list_dirs = [dir_i for dir_i in os.listdir(path)]
+        list_dirs = [dir_i for dir_i in archive.listdir(path)]
 
         unk_folder = [dir_i not in allowed_folders for dir_i in list_dirs]
 
@@ -104,7 +105,8 @@ def check_telecover_rin(path, files_per_ring):
     return()
 
 
-def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0):
+def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0,
+                     summary = False, index = None):
 
     """
     General:
@@ -153,6 +155,16 @@ def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0)
             encountered. If set to 1 all files with overflows will be
             discarded. If set to 2 overflows will be removed and 
             interpolated instead
+
+        summary:
+            If True the overflows are added to the overflow summary of the 
+            run (see overflow_summary), which is written once at the end of
+            the run (see write_overflow_summary). Defaults to False
+
+        index:
+            The overflow index (see get_overflow_index) if it has already
+            been computed (see modify.preprocess). Defaults to None (it is
+            computed here)
             
             
     Returns:
@@ -167,9 +179,12 @@ def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0)
                              removed
                 
                 method = 2 : only sig changes, overflowed values are replaced
-                             by interpolated values from the surrounding bins
+                             by interpolated values from the surrounding bins.
+                             sig is modified in place, the caller must own 
+                             it (see process)
 
                 method = 3 : do nothing about it, use only while debugging            
+
     """
     
     meas_label = {'ray': 'Rayleigh', 'tlc' : 'Telecover',
@@ -185,34 +200,50 @@ def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0)
 
     filename = time_info.filename
         
-    # Get an overflow mask for each bin
-    mask = get_overflow_mask(sig, acquisition_mode, daq_range)
+    # Get an overflow mask for each bin and the sparse (time, channel, bin) index of the overflows
+    if index is None:
+        mask = get_overflow_mask(sig, acquisition_mode, daq_range)
+        
+        index = get_overflow_index(mask)
+    
+    else:
+        mask = None
+    
+    mask_any = index.shape[0] > 0
+    
+    overflow_warnings(index, channels = sig.channel.values, 
+                      acquisition_mode = acquisition_mode)
+    
+    if summary:
+        overflow_summary(index, sig = sig, filename = filename, 
+                         meas_type = meas_type, method = method)
 
-    if method == 0 and mask.any(): # Detect the problematic profiles and raise error
+    if method == 0 and mask_any: # Detect the problematic profiles and raise error
 
-        overflow_method_0(mask = mask, filename = filename)
+        overflow_method_0(sig = sig, index = index, filename = filename)
             
-    elif method == 1 and mask.any(): # Remove the problematic profiles
+    elif method == 1 and mask_any: # Remove the problematic profiles
     
-        sig, shots, time_info = overflow_method_1(sig = sig.copy(), 
-                                                  shots = shots.copy(),
+        sig, shots, time_info = overflow_method_1(sig = sig, 
+                                                  shots = shots,
                                                   time_info = time_info, 
-                                                  mask = mask, 
+                                                  index = index, 
                                                   filename = filename)
         print("Profiles with overflowed bin were succesfully removed!")
         
-    elif method == 2 and mask.any(): # Replace the overflowed values with interpolated ones from the nearby bins
+    elif method == 2 and mask_any: # Replace the overflowed values with interpolated ones from the nearby bins
         
-        sig = overflow_method_2(sig = sig.copy(), 
+        sig = overflow_method_2(sig = sig, 
+                                index = index,
                                 mask = mask, 
                                 filename = filename)
         print("Overflowed were succesfully replaced!")
     
-    elif method == 3 and mask.any():
+    elif method == 3 and mask_any:
 
         print("-- Warning: Overflows were detected but no action has been performed! Use trim_overflows to 3 only when debugging!")
 
-    elif not mask.any():
+    elif not mask_any:
         
         print("No bins with overflows have been encountered!")
     
@@ -224,127 +255,251 @@ def detect_overflows(sig, shots, channel_info, time_info, meas_type, method = 0)
 
 def get_overflow_mask(sig, acquisition_mode, daq_range):
 
+    """ The thresholds are broadcasted over the channels (2^15 summed counts
+    for the photon channels, the data acquisition range and 0 mV for the 
+    analog channels) so that the mask is built in a single expression that 
+    stays lazy for dask signals"""
+
     channels = sig.channel.values
+
+    mode = xr.DataArray(acquisition_mode.loc[channels].values,
+                        dims = ['channel'], coords = [channels])
+
+    max_mV = xr.DataArray(daq_range.loc[channels].values,
+                          dims = ['channel'], coords = [channels])
     
-    time = sig.time.values
+    max_count = np.power(2.,15)
 
-    bins = sig.bins.values
+    crit_pc = (mode == 1) & (sig >= max_count)
     
-    mask = xr.DataArray(np.zeros([time.size, channels.size, bins.size], 
-                                 dtype = bool),
-                        dims = ['time','channel', 'bins'],
-                        coords = [time, channels, bins])
+    crit_an = (mode == 0) & ((sig >= max_mV) | (sig <= 0.))
     
-    for ch in channels:
+    mask = (crit_pc | crit_an).transpose('time', 'channel', 'bins')
+    
+    return(mask)
 
-        ch_d = dict(channel = ch)
+def get_overflow_index(mask):
+    
+    """ Returns the positions of the overflowed bins as an integer array with
+    one (time, channel, bin) row per overflow, ordered by time, channel, and
+    bin. Dask masks are reduced chunk by chunk without computing the full 
+    mask in memory"""
+    
+    index = np.argwhere(mask.data)
+    
+    if not isinstance(index, np.ndarray):
+        index = np.asarray(index.compute())
+    
+    return(index)
 
-        if acquisition_mode.loc[ch] == 1: #3rd digit of channel name is the acquisition mode (a or p)
-        
-            max_count = np.power(2.,15)
+def overflow_profiles(index):
+    
+    """ Groups the overflow index per (time, channel) profile. Returns the 
+    time and channel positions of each affected profile and the index rows 
+    where each profile starts (the index is ordered by time and channel)"""
+    
+    new_profile = np.ones(index.shape[0], dtype = bool)
+    
+    new_profile[1:] = (np.diff(index[:, 0]) != 0) | (np.diff(index[:, 1]) != 0)
+    
+    start = np.where(new_profile)[0]
+    
+    return(index[start, 0], index[start, 1], start)
 
-            crit = (sig.loc[ch_d] >= max_count)
-            
-            if crit.any():
-                print(f"-- Warning: Channel {ch} - Photon signal count values above the maximum allowed summed counts were detected! ")
+def overflow_warnings(index, channels, acquisition_mode):
+    
+    """ Prints a warning per channel with overflows"""
+    
+    for ch in channels[np.unique(index[:, 1])]:
 
-                mask.loc[ch_d] = crit.values                                           
+        if acquisition_mode.loc[ch] == 1: #3rd digit of channel name is the acquisition mode (a or p)
+            print(f"-- Warning: Channel {ch} - Photon signal count values above the maximum allowed summed counts were detected! ")
 
         if acquisition_mode.loc[ch] == 0: #3rd digit of channel name is the acquisition mode (a or p)
+            print(f"-- Warning: Channel {ch} - Analog signal mV values above the data acqusition range or below 0. were detected! ")
 
-            max_mV = daq_range.loc[ch]
-        
-            crit = (sig.loc[ch_d] >= max_mV) | (sig.loc[ch_d] <= 0.)
-            
-            if crit.any():
-                print(f"-- Warning: Channel {ch} - Analog signal mV values above the data acqusition range or below 0. were detected! ")
+    return()
+
+# Overflow summary of the run per measurement type (see overflow_summary)
+_summary = dict()
 
-                mask.loc[ch_d] = crit.values
+def overflow_summary(index, sig, filename, meas_type, method):
     
-    return(mask)
+    """ Adds the overflows of a measurement to the overflow summary of the 
+    run. Per measurement type, the summary holds the handling method, the 
+    number of overflowed bins and profiles per channel, and per file and 
+    channel the number of overflowed bins and the first and last of them"""
+    
+    time = sig.time.values
+    
+    channels = sig.channel.values
+    
+    bins = sig.bins.values.astype(int)
+    
+    t_pos, ch_pos, start = overflow_profiles(index)
+    
+    stop = np.append(start[1:], index.shape[0])
+    
+    entry = {'method' : int(method),
+             'overflowed_bins' : int(index.shape[0]),
+             'overflowed_files' : int(np.unique(index[:, 0]).size),
+             'channels' : {str(ch) : {'overflowed_bins' : int(np.sum(index[:, 1] == k)),
+                                      'overflowed_profiles' : int(np.sum(ch_pos == k))}
+                           for k, ch in enumerate(channels) if k in ch_pos},
+             'profiles' : [{'file' : str(filename[time[t_pos[k]]]),
+                            'time' : str(time[t_pos[k]]),
+                            'channel' : str(channels[ch_pos[k]]),
+                            'overflowed_bins' : int(stop[k] - start[k]),
+                            'first_bin' : int(bins[index[start[k], 2]]),
+                            'last_bin' : int(bins[index[stop[k] - 1, 2]])}
+                           for k in range(start.size)]}
+    
+    _summary.setdefault(meas_type, []).append(entry)
+    
+    return()
 
-def overflow_method_0(mask, filename):
+def write_overflow_summary(summary_file):
     
-    time = mask.time.values
+    """ Writes the overflow summary of the run to summary_file (json) if 
+    overflows were checked for the summary (see detect_overflows). The 
+    summary is then cleared for the next run"""
     
-    channels = mask.channel.values
+    if len(_summary) == 0:
+        return()
     
-    bins = mask.bins.values
+    with open(summary_file, 'w') as f:
+        json.dump(_summary, f, indent = 1)
     
-    # use the index and not the time....
-    if mask.any():
+    _summary.clear()
+    
+    return()
+
+def overflow_method_0(sig, index, filename):
+    
+    time = sig.time.values
+    
+    channels = sig.channel.values
+    
+    bins = sig.bins.values.astype(int)
+    
+    print("-- Error at least one bin with an overflow was detected. ")
+    print("-- Please revise the following bins: ")
+    
+    t_pos, ch_pos, start = overflow_profiles(index)
+    
+    stop = np.append(start[1:], index.shape[0])
+                    
+    for k in range(start.size):
         
-        print("-- Error at least one bin with an overflow was detected. ")
-        print("-- Please revise the following bins: ")
+        filename_ovf = filename[time[t_pos[k]]]
         
-        mask_t = mask.any(dim = 'bins').any(dim = 'channel').values
-                    
-        time_ovf = time[mask_t]
-                    
-        for t in time_ovf:
-            filename_ovf = filename[t]
-            
-            t_d = dict(time = t)
-                            
-            ch_ovf = channels[mask.any(dim = 'bins').loc[t_d].values]
-            
-            for ch in ch_ovf:
-            
-                ch_d = dict(channel = ch)
-                
-                bins_ovf = bins[mask.loc[t_d].loc[ch_d].values].astype(int)
-                
-                print(f"    file: {filename_ovf} | ch: {ch} | bins: {bins_ovf}")
+        bins_ovf = bins[index[start[k]:stop[k], 2]]
         
-        raise Exception("-- Error: In order to continue with an automated overflow removal use the trim_overflow argument with value 1 or 2 (default is 0) ")
+        print(f"    file: {filename_ovf} | ch: {channels[ch_pos[k]]} | bins: {bins_ovf}")
+    
+    raise Exception("-- Error: In order to continue with an automated overflow removal use the trim_overflow argument with value 1 or 2 (default is 0) ")
         
     return()
 
-def overflow_method_1(sig, shots, time_info, mask, filename):
+def overflow_method_1(sig, shots, time_info, index, filename):
 
-    time = mask.time.values
+    time = sig.time.values
     
-    mask_t = mask.any(dim = 'bins').any(dim = 'channel').values
+    mask_t = np.zeros(time.size, dtype = bool)
+    
+    mask_t[index[:, 0]] = True
 
     print(f"-- Warning: {np.sum(mask_t)} profiles with at least one overflowed bin have been detected ")
     print("-- Warning: trim_overflows = 1: The following profiles have been removed ")
                 
-    time_ovf = time[mask_t]
-
-    time_cor = time[~mask_t]
-                
-    for t in time_ovf:
+    for t in time[mask_t]:
         filename_ovf = filename[t]
         
         print(f"    {filename_ovf} ")
 
-    time_d = dict(time = time_cor)
-    
-    sig_out = sig.copy().loc[time_d] 
+    sig_out = sig.isel(time = ~mask_t)
 
-    shots_out = shots.copy().loc[time_d] 
+    shots_out = shots.isel(time = ~mask_t)
     
-    time_info = time_info.loc[time_cor,:]
+    time_info = time_info.iloc[~mask_t, :]
     
     return(sig_out, shots_out, time_info)
 
-def overflow_method_2(sig, mask, filename):
+def overflow_method_2(sig, index, mask, filename, max_bins = 100):
 
-    mask_t = mask.any(dim = 'bins').any(dim = 'channel').values
+    """ Replaces the overflowed bins by linear interpolation across the bins.
+    Only the (time, channel) profiles with overflows are visited and they 
+    are modified in place. Profiles with more than max_bins overflowed bins
+    are not interpolated, their overflowed bins are set to nan instead.
+    Lazy (dask) signals are interpolated as a whole with xarray"""
 
-    ovfs = mask.sum(dim = 'bins')
+    t_pos, ch_pos, start = overflow_profiles(index)
+    
+    n_ovfs = np.diff(np.append(start, index.shape[0]))
 
-    print(f"-- Warning: {np.sum(mask_t)} profiles with at least one overflowed bin have been detected ")
+    print(f"-- Warning: {np.unique(t_pos).size} profiles with at least one overflowed bin have been detected ")
     print("-- Warning: trim_overflows = 2: Will attempt to replace the overflows ")
           
-    if (ovfs > 100).any():
-        print("-- Warning: More that 100 overflowed bins encountered in single profiles... Interpolation is too risky, please revise the input files or consider switching to --trim_overflows 2 ")
+    if (n_ovfs > max_bins).any():
+        print(f"-- Warning: More that {max_bins} overflowed bins encountered in single profiles... Interpolation is too risky, the overflowed bins of these profiles will be set to nan. Please revise the input files or consider switching to --trim_overflows 1 ")
+        
+        time = sig.time.values
+        
+        channels = sig.channel.values
+        
+        for k in np.where(n_ovfs > max_bins)[0]:
+            print(f"    file: {filename[time[t_pos[k]]]} | ch: {channels[ch_pos[k]]} | overflowed bins: {n_ovfs[k]}")
     
-    sig = sig.copy().where(~mask)
+    if not isinstance(sig.data, np.ndarray):
+        
+        # The profiles with more than max_bins overflows, as in the eager case
+        limit = np.zeros(sig.shape[:2], dtype = bool)
+        
+        limit[t_pos[n_ovfs > max_bins], ch_pos[n_ovfs > max_bins]] = True
+        
+        limit = xr.DataArray(limit, coords = [sig.time.values, sig.channel.values],
+                             dims = ['time', 'channel'])
+        
+        sig = sig.where(~mask)
+        
+        sig_out = sig.interpolate_na(dim = "bins", method = "linear").astype(sig.dtype)
+        
+        # The overflowed bins of these profiles stay nan
+        sig_out = sig_out.where(~(mask & limit))
+        
+        n_rep = np.sum(n_ovfs[n_ovfs <= max_bins])
+        
+        print(f"-- Warning: {n_rep} overflows have been replaced by interpolating across the bins ")
+        
+        return(sig_out)
     
-    sig_out = sig.copy().interpolate_na(dim = "bins", method = "linear")
+    sig_arr = sig.values
+    
+    x = np.arange(sig_arr.shape[2])
+    
+    n_rep = 0
+    
+    for k in range(start.size):
+        
+        row = sig_arr[t_pos[k], ch_pos[k], :]
+        
+        row[index[start[k]:start[k] + n_ovfs[k], 2]] = np.nan
+        
+        if n_ovfs[k] > max_bins:
+            continue
+        
+        valid = ~np.isnan(row)
+        
+        if not valid.any():
+            continue
+        
+        # Gaps at the edges of the profile are not extrapolated 
+        fill = ~valid & (x > x[valid][0]) & (x < x[valid][-1])
+        
+        row[fill] = np.interp(x[fill], x[valid], row[valid])
+        
+        n_rep = n_rep + n_ovfs[k]
 
-    print(f"-- Warning: {np.sum(mask).values} overflows have been replaced by interpolating across the bins ")
+    print(f"-- Warning: {n_rep} overflows have been replaced by interpolating across the bins ")
     
-    return(sig_out)
-  
\ No newline at end of file
+    return(sig)
@@ -10,6 +10,11 @@ import os, sys
 import netCDF4 as nc
 import numpy as np
 
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
 def rayleigh_file(meas_info, channel_info, time_info, time_info_d, nc_path,
                   meas_ID, sig, sig_d, shots, shots_d, 
                   P = None, T = None, radiosonde_file = None):
@@ -110,7 +115,7 @@ def rayleigh_file(meas_info, channel_info, time_info, time_info_d, nc_path,
     make_nc_var(ds, name = 'Background_High', value = channel_info.background_high.values, dtype = 'int', dims = ('channels',))
     
     if not isinstance(sig_d,list):
-        make_nc_var(ds, name = 'Background_Profile', value = sig_d.values, dtype = 'float', dims = ('time_bck', 'channels', 'points',))
+        make_nc_var(ds, name = 'Background_Profile', value = sig_d.data, dtype = float_type(sig_d), dims = ('time_bck', 'channels', 'points',))
 
     make_nc_var(ds, name = 'channel_ID', value = channel_info.scc_id.values, dtype = 'int', dims = ('channels',))
 
@@ -154,7 +159,7 @@ def rayleigh_file(meas_info, channel_info, time_info, time_info_d, nc_path,
 
     make_nc_var(ds, name = 'PMT_High_Voltage', value = channel_info.pmt_high_voltage.values, dtype = 'float', dims = ('channels',))
     
-    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.values, dtype = 'float', dims = ('time', 'channels', 'points',))
+    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.data, dtype = float_type(sig), dims = ('time', 'channels', 'points',))
     
     make_nc_var(ds, name = 'Raw_Data_Range_Resolution', value = channel_info.range_resolution.values, dtype = 'float', dims = ('channels',))
     
@@ -283,7 +288,7 @@ def telecover_file(meas_info, channel_info, time_info, time_info_d, nc_path,
     make_nc_var(ds, name = 'Background_High', value = channel_info.background_high.values, dtype = 'int', dims = ('channels',))
     
     if not isinstance(sig_d,list):
-        make_nc_var(ds, name = 'Background_Profile', value = sig_d.values, dtype = 'float', dims = ('time_bck', 'channels', 'points',))
+        make_nc_var(ds, name = 'Background_Profile', value = sig_d.data, dtype = float_type(sig_d), dims = ('time_bck', 'channels', 'points',))
 
     make_nc_var(ds, name = 'channel_ID', value = channel_info.scc_id.values, dtype = 'int', dims = ('channels',))
 
@@ -331,7 +336,7 @@ def telecover_file(meas_info, channel_info, time_info, time_info_d, nc_path,
 
     make_nc_var(ds, name = 'PMT_High_Voltage', value = channel_info.pmt_high_voltage.values, dtype = 'float', dims = ('channels',))
     
-    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.values, dtype = 'float', dims = ('time', 'channels', 'points',))
+    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.data, dtype = float_type(sig), dims = ('time', 'channels', 'points',))
     
     make_nc_var(ds, name = 'Raw_Data_Range_Resolution', value = channel_info.range_resolution.values, dtype = 'float', dims = ('channels',))
     
@@ -452,7 +457,7 @@ def polarization_calibration_file(
     make_nc_var(ds, name = 'Background_High', value = channel_info.background_high.values, dtype = 'int', dims = ('channels',))
     
     if not isinstance(sig_d,list):
-        make_nc_var(ds, name = 'Background_Profile', value = sig_d.values, dtype = 'float', dims = ('time_bck', 'channels', 'points',))
+        make_nc_var(ds, name = 'Background_Profile', value = sig_d.data, dtype = float_type(sig_d), dims = ('time_bck', 'channels', 'points',))
 
     make_nc_var(ds, name = 'channel_ID', value = channel_info.scc_id.values, dtype = 'int', dims = ('channels',))
 
@@ -496,7 +501,7 @@ def polarization_calibration_file(
 
     make_nc_var(ds, name = 'PMT_High_Voltage', value = channel_info.pmt_high_voltage.values, dtype = 'float', dims = ('channels',))
     
-    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.values, dtype = 'float', dims = ('time', 'channels', 'points',))
+    make_nc_var(ds, name = 'Raw_Lidar_Data', value = sig.data, dtype = float_type(sig), dims = ('time', 'channels', 'points',))
     
     make_nc_var(ds, name = 'Raw_Data_Range_Resolution', value = channel_info.range_resolution.values, dtype = 'float', dims = ('channels',))
     
@@ -606,7 +611,7 @@ def dark_file(meas_info, channel_info, time_info_d, nc_path,
     
     make_nc_var(ds, name = 'Background_High', value = channel_info.background_high.values, dtype = 'int', dims = ('channels',))
     
-    make_nc_var(ds, name = 'Background_Profile', value = sig_d.values, dtype = 'float', dims = ('time_bck', 'channels', 'points',))
+    make_nc_var(ds, name = 'Background_Profile', value = sig_d.data, dtype = float_type(sig_d), dims = ('time_bck', 'channels', 'points',))
 
     make_nc_var(ds, name = 'channel_ID', value = channel_info.scc_id.values, dtype = 'int', dims = ('channels',))
 
@@ -740,7 +745,8 @@ def path(results_folder, meas_ID, meas_type):
 
 def make_nc_var(ds, name, value, dtype, dims = []):  
     """Function called by the *_file functions in order to fascilitate variable
-    creation in the netcdf"""
+    creation in the netcdf. Dask (lazy) arrays are computed and written 
+    chunk by chunk"""
     
     if dtype == 'int':
         func = np.int32
@@ -749,16 +755,26 @@ def make_nc_var(ds, name, value, dtype, dims = []):
     if dtype == 'float':
         func = np.double
         default_val = nc.default_fillvals['f8']
+
+    if dtype == 'single':
+        func = np.single
+        default_val = nc.default_fillvals['f4']
       
     if len(dims) == 0:
         value = func(value)
+    elif is_lazy(value):
+        value = da.where(value != value, default_val, value).astype(dtype)
     else:
-        value[value != value] = default_val
-        value = value.astype(dtype)
+        # The input array is not modified, it may be shared (e.g. the dark)
+        value = np.where(value != value, default_val, value).astype(dtype)
 
     var = ds.createVariable(name, func, dims)
     
-    if len(dims) == 0:
+    if is_lazy(value):
+        # The netcdf file is not thread safe, the chunks are written one at a time
+        da.store(value, var, lock = True)
+
+    elif len(dims) == 0:
         var[:] = value
 
     elif len(dims) == 1:
@@ -775,6 +791,22 @@ def make_nc_var(ds, name, value, dtype, dims = []):
         
     return()
 
+def is_lazy(value):  
+    """Returns True for dask (lazy) arrays"""
+    
+    return(da != None and isinstance(value, da.Array))
+
+def float_type(value):  
+    """Returns the make_nc_var dtype of a floating point array. Single 
+    precision arrays (compact mode) are exported as single"""
+    
+    if value.dtype == np.float32:
+        dtype = 'single'
+    else:
+        dtype = 'float'
+        
+    return(dtype)
+
 def make_nc_str(ds, name, value, dims, length):  
     """Function called by the *_file functions in order to fascilitate variable
     creation in the netcdf"""
@@ -7,7 +7,9 @@ Created on Tue Jul 26 15:22:31 2022
 """
 
 import numpy as np
+import xarray as xr
 import sys
+from tools.automate import detect_overflows
 
 def trim_channels(cfg, sig, shots, channel_info, meas_type):
     
@@ -15,18 +17,11 @@ def trim_channels(cfg, sig, shots, channel_info, meas_type):
     file. All IDs in the config_file must be correspondent to the Licel IDs in
     the raw files. If an unkown ID is included in the config_file then an error
     is raised. For polarization calibration measurements, channels that are 
-    neither co- nor cross- polar will be automatically removed"""
+    neither co- nor cross- polar will be automatically removed. The 
+    returned sig and shots may be views of the input ones"""
     
 
-    channel_type_cfg = cfg.channels.channel_type.values
-
-    channel_ind_cfg = cfg.channels.index.values
-        
-    
-    if meas_type == 'pcl':
-        
-        channel_ind_cfg = channel_ind_cfg[(channel_type_cfg == 'p') | 
-                                          (channel_type_cfg == 'c')]
+    channel_ind_cfg = select_channels(cfg, meas_type = meas_type)
         
     channel_ind_raw = channel_info.index.values
     
@@ -38,9 +33,15 @@ def trim_channels(cfg, sig, shots, channel_info, meas_type):
                        if channel_ind_cfg_i in channel_ind_raw]
 
     
-    sig = sig.loc[dict(channel = channel_ind_com)]
+    # Contiguous selections (e.g. all channels) are views, the rest copies
+    pos = np.array([np.where(sig.channel.values == ch)[0][0] for ch in channel_ind_com], dtype = int)
+    
+    if pos.size > 0 and (np.diff(pos) == 1).all():
+        pos = slice(pos[0], pos[-1] + 1)
+    
+    sig = sig.isel(channel = pos)
     
-    shots = shots.loc[dict(channel = channel_ind_com)]
+    shots = shots.isel(channel = pos)
     
     channel_info = channel_info.loc[channel_ind_com,:]
     
@@ -51,6 +52,23 @@ def trim_channels(cfg, sig, shots, channel_info, meas_type):
         
     return(sig, shots, channel_info, cfg)
 
+def select_channels(cfg, meas_type):
+    
+    """Returns the IDs of the channels of the configuration file that are
+    used for the given measurement type. Polarization calibration 
+    measurements use only the co- and cross- polar channels"""
+    
+    channel_type_cfg = cfg.channels.channel_type.values
+
+    channel_ind_cfg = cfg.channels.index.values
+    
+    if meas_type == 'pcl':
+        
+        channel_ind_cfg = channel_ind_cfg[(channel_type_cfg == 'p') | 
+                                          (channel_type_cfg == 'c')]
+        
+    return(channel_ind_cfg)
+
 def merge_config(cfg, meas_info, channel_info):
 
     for key in meas_info.index:
@@ -90,22 +108,32 @@ def fill_defaults(cfg):
 
 def unit_conv_bits_to_mV(channel_info, signal, shots):
 
-    """Converts analog signals from bits to mV"""
+    """Converts analog signals from bits to mV. The conversion factors are
+    broadcasted over the channels (1 for the photon channels) so that the
+    same operation works for both numpy and dask (lazy) signals"""
     
     if len(signal) > 0:
         
-        mask_an = channel_info.acquisition_mode.values == 0
+        mask_an = xr.DataArray(channel_info.acquisition_mode.values == 0,
+                               coords = [channel_info.index.values],
+                               dims = ['channel'])
+        
+        data_acquisition_range = \
+            xr.DataArray(channel_info.data_acquisition_range.values,
+                         coords = [channel_info.index.values],
+                         dims = ['channel'])
         
-        channel_id_an = channel_info.index.values[mask_an]
+        analog_to_digital_resolution = \
+            xr.DataArray(channel_info.analog_to_digital_resolution.values,
+                         coords = [channel_info.index.values],
+                         dims = ['channel'])
         
-        data_acquisition_range = channel_info.data_acquisition_range
+        # analog conversion (to mV)
+        factor = xr.where(mask_an, data_acquisition_range, 1.)
         
-        analog_to_digital_resolution = channel_info.analog_to_digital_resolution
+        norm = xr.where(mask_an, shots*(np.power(2,analog_to_digital_resolution)-1.), 1.)
         
-        for ch in channel_id_an:
-            ch_d = dict(channel = ch)
-            # analog conversion (to mV)
-            signal.loc[ch_d] = signal.loc[ch_d]*data_acquisition_range.loc[ch]/(shots.loc[ch_d]*(np.power(2,analog_to_digital_resolution.loc[ch])-1.))
+        signal = (signal*factor/norm).astype(signal.dtype)
     
     return(signal) 
 
@@ -116,32 +144,175 @@ def screen_low_shots(time_info, channel_info, signal, shots):
     
     
     if len(signal) > 0:
-        time = signal.copy().time.values
-                
-        channel_id = channel_info.index.values
-        
-        time_ls = []
-                
-        for ch in channel_id:
-            ch_d = dict(channel = ch)
-            
-            shots_ch = shots.loc[ch_d].values
-            
-            mask_t = shots_ch < 0.9 * np.nanmax(shots_ch)
-            
-            time_ls.extend(time[mask_t])
+        time = signal.time.values
+        
+        mask_t = low_shots_mask(time_info, channel_info, signal = signal, shots = shots)
             
-        if len(time_ls) > 0:
-            t_d = dict(time = np.unique(time_ls))
+        if mask_t.any():
+            t_d = dict(time = np.unique(time[mask_t]))
             
-            print('-- Warning: The following files have less shots than 90% of the naximum number of shots encountered and will be screened out:')
-            for t in np.unique(time_ls):
-                ind_t = np.where(t == time)[0][0]
-                print(f'    Filename: {time_info.filename[ind_t]}')
-                
-            signal.loc[t_d] = np.nan
+            # where keeps the signal lazy if it is a dask array
+            signal = signal.where(xr.DataArray(~mask_t, coords = [time], 
+                                               dims = ['time']))
     
             shots.loc[t_d] = np.nan
         
             
-    return(signal) 
\ No newline at end of file
+    return(signal)
+
+def low_shots_mask(time_info, channel_info, signal, shots):
+
+    """Returns a mask of the profiles with less shots than 90% of the 
+    maximum in any channel and prints the respective files"""
+
+    time = signal.time.values
+            
+    shots_arr = shots.loc[dict(channel = channel_info.index.values)].values
+    
+    mask_t = (shots_arr < 0.9 * np.nanmax(shots_arr, axis = 0)).any(axis = 1)
+        
+    if mask_t.any():
+        print('-- Warning: The following files have less shots than 90% of the naximum number of shots encountered and will be screened out:')
+        for t in np.unique(time[mask_t]):
+            ind_t = np.where(t == time)[0][0]
+            print(f'    Filename: {time_info.filename[ind_t]}')
+    
+    return(mask_t)
+
+def preprocess(time_info, channel_info, cfg_channels, signal, shots, meas_type, 
+               method = 0, summary = False, block_size = 2**18):
+
+    """Screens the profiles with low shots (see screen_low_shots), converts 
+    the analog signals to mV (see unit_conv_bits_to_mV), and detects and 
+    handles the overflows (see automate.detect_overflows) with the same 
+    output and warnings as the three steps one after the other. The 
+    screening is applied with the conversion (nan normalization for the 
+    screened profiles). The signal is converted in place in blocks of about
+    block_size values and each block is checked for overflows right after 
+    its conversion, so the signal is swept only once.
+    The conversion uses the channel_info of the raw files and the overflow
+    thresholds the cfg_channels of the configuration. Lazy (dask) signals
+    go through the three steps. Returns signal, shots, time_info"""
+    
+    if len(signal) == 0:
+        return(signal, shots, time_info)
+    
+    if not isinstance(signal.data, np.ndarray):
+        
+        signal = screen_low_shots(time_info, channel_info, signal = signal, shots = shots)
+        
+        signal = unit_conv_bits_to_mV(channel_info, signal = signal, shots = shots)
+        
+        return(detect_overflows(sig = signal, shots = shots, 
+                                channel_info = cfg_channels,
+                                time_info = time_info, method = method,
+                                meas_type = meas_type, 
+                                summary = summary))
+
+    channels = signal.channel.values
+    
+    channel_info = channel_info.loc[channels, :]
+    
+    mask_t = low_shots_mask(time_info, channel_info, signal = signal, shots = shots)
+    
+    shots.values[mask_t, :] = np.nan
+    
+    # Conversion factors as in unit_conv_bits_to_mV: signal * factor / norm
+    mask_an = channel_info.acquisition_mode.values == 0
+    
+    factor = np.where(mask_an, channel_info.data_acquisition_range.values, 1.)
+    
+    norm = np.where(mask_an, shots.values * (np.power(2, channel_info.analog_to_digital_resolution.values) - 1.), 1.)
+    
+    # The screened profiles become nan in all channels
+    norm[mask_t, :] = np.nan
+    
+    # Overflow thresholds per channel, see automate.get_overflow_mask
+    mode = cfg_channels.acquisition_mode.loc[channels].values
+    
+    daq_range = cfg_channels.data_acquisition_range.loc[channels].values
+    
+    upper = np.where(mode == 1, np.power(2.,15), np.where(mode == 0, daq_range, np.inf))
+    
+    lower = np.where(mode == 0, 0., -np.inf)
+    
+    sig_arr = signal.values
+    
+    rows = max(1, block_size // max(1, sig_arr[0].size))
+    
+    index = []
+    
+    for t0 in range(0, sig_arr.shape[0], rows):
+        
+        block = sig_arr[t0:t0 + rows]
+        
+        # Same operations in the same order (and precision) as the separate 
+        # steps, so that the output is bit identical to them
+        if block.dtype == np.float64:
+            block *= factor[:, np.newaxis]
+            block /= norm[t0:t0 + rows, :, np.newaxis]
+        else:
+            block[...] = block * factor[:, np.newaxis] / norm[t0:t0 + rows, :, np.newaxis]
+        
+        hits = (block >= upper[:, np.newaxis]) | (block <= lower[:, np.newaxis])
+        
+        index_b = np.argwhere(hits)
+        
+        index_b[:, 0] = index_b[:, 0] + t0
+        
+        index.append(index_b)
+        
+    index = np.concatenate(index)
+    
+    return(detect_overflows(sig = signal, shots = shots, 
+                            channel_info = cfg_channels,
+                            time_info = time_info, method = method,
+                            meas_type = meas_type, 
+                            summary = summary, index = index))
+
+def regrid_radiosonde(atmo, resolution):
+
+    """Resamples the radiosonde profiles (height, parameters) on a regular 
+    altitude grid with the given resolution in m. The grid starts at the 
+    lowest valid level, so the surface level is kept. Only the levels with an 
+    altitude higher than all the previous ones are used, so duplicate 
+    altitudes and descending parts of the sounding are dropped. The pressure
+    is interpolated in logarithmic scale, the rest of the parameters 
+    linearly"""
+    
+    alt = atmo.height.values
+    
+    data = atmo.values
+    
+    # Strictly increasing altitudes, nans are dropped
+    alt_prev = np.maximum.accumulate(np.concatenate(([-np.inf], np.nan_to_num(alt[:-1], nan = -np.inf))))
+    
+    keep = (alt > alt_prev) & np.isfinite(data).all(axis = 1)
+    
+    alt = alt[keep]
+    
+    data = data[keep, :]
+    
+    if alt.size > 1:
+        alt_grid = alt[0] + np.arange(np.floor((alt[-1] - alt[0]) / resolution) + 1.) * resolution
+    
+    if alt.size < 2 or alt_grid.size < 2:
+        raise Exception("-- Error: The valid levels of the radiosonde file do not cover at least 2 levels of the altitude grid, the profiles cannot be resampled! Please revise the radiosonde file or the rsonde_resolution argument")
+
+    parameters = atmo.parameters.values
+    
+    data_grid = np.empty((alt_grid.size, parameters.size))
+    
+    for j in range(parameters.size):
+        if parameters[j] == 'P':
+            data_grid[:, j] = np.exp(np.interp(alt_grid, alt, np.log(data[:, j])))
+        else:
+            data_grid[:, j] = np.interp(alt_grid, alt, data[:, j])
+    
+    print(f'-- The radiosonde profiles were resampled from {atmo.height.size} to {alt_grid.size} levels with a resolution of {resolution} m')
+    
+    atmo = xr.DataArray(data_grid, 
+                        coords = [alt_grid, parameters], 
+                        dims = ['height', 'parameters'] )
+    
+    return(atmo)
@@ -7,12 +7,18 @@ Created on Thu Aug  4 23:30:39 2022
 """
 
 from readers.read_config import config
-import os, sys
+import os, sys, json
 import numpy as np
 from readers import read_files
 from tools import modify, make
 from tools.automate import check_telecover_sec, check_telecover_rin
-from tools.automate import detect_overflows
+
+# Data ownership: the signals and shots returned by the readers belong to the
+# processor that read them. The pre-processing steps (trim_channels, preprocess,
+# detect_overflows) may return views or modify them in place, so only the
+# returned objects are used afterwards and no defensive copies are made. The
+# dark of the run is shared by the processors (see read_dark), it is copied
+# once before it is pre-processed and it is read only afterwards.
 
 def rayleigh(args):
    
@@ -22,23 +28,24 @@ def rayleigh(args):
     
     file_format = args['file_format']
     mcode = args['measurement_identifier']
+    options = reader_options(args)
     
 
     # Reading of the configuration file    
     cfg = config(path = path_cfg) 
 
-    # Read the files in the dark folder
+    # Read and pre-process the files in the dark folder (shared by all processors)
     sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d  = \
-        read_files.dark(finput_drk = path_drk, file_format = file_format, mcode = mcode)
+        read_dark(args, path_drk = path_drk, meas_type = 'drk')
     
     # Read the files in the rayleigh folder
     sig_raw, shots, meas_info, channel_info, time_info = \
-        read_files.rayleigh(finput_ray = path_ray, file_format = file_format, mcode = mcode)
+        read_files.rayleigh(finput_ray = path_ray, file_format = file_format, mcode = mcode, 
+                            channels = modify.select_channels(cfg, meas_type = 'ray'), **options)
 
     # Remove channels that should be excluded according to the configuration file
     if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, channel_info_d, cfg = \
-            modify.trim_channels(cfg = cfg, sig = sig_raw_d, shots = shots_d, channel_info = channel_info_d, meas_type = 'drk')
+        cfg.channels = cfg.channels.loc[channel_info_d.index,:]
     
     sig_raw, shots, channel_info, cfg = \
         modify.trim_channels(cfg = cfg, sig = sig_raw, shots = shots, channel_info = channel_info, meas_type = 'ray')
@@ -51,36 +58,17 @@ def rayleigh(args):
     # Add default values to the configuration object when the respective variables are not provided in the configuration file
     cfg = modify.fill_defaults(cfg)
 
-    # Screen profiles that have an iregularly low number of shots
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.screen_low_shots(time_info_d, channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    sig_raw = modify.screen_low_shots(time_info, channel_info, signal = sig_raw.copy(), shots = shots)
-
-    # Convert analog channel units to mV (applicable mainly to licel)   
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.unit_conv_bits_to_mV(channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    
-    sig_raw = modify.unit_conv_bits_to_mV(channel_info, signal = sig_raw.copy(), shots = shots)
-
-
-    # Detect and Screen Overflows
+    # Screen profiles that have an iregularly low number of shots, convert analog 
+    # channel units to mV (applicable mainly to licel), and detect and screen overflows
     sig_raw, shots, time_info = \
-        detect_overflows(sig = sig_raw.copy(), 
-                         shots = shots.copy(),
-                         channel_info = cfg.channels,
-                         time_info = time_info,
-                         method = args['trim_overflows'],
-                         meas_type = 'ray')
-
-    # Detect and Screen Overflows for the dark
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, time_info_d = \
-            detect_overflows(sig = sig_raw_d.copy(), 
-                             shots = shots_d.copy(),
-                             channel_info = cfg.channels,
-                             time_info = time_info_d,
-                             method = args['trim_overflows'],
-                             meas_type = 'drk')    
+        modify.preprocess(time_info, channel_info, 
+                          cfg_channels = cfg.channels,
+                          signal = sig_raw, 
+                          shots = shots,
+                          method = args['trim_overflows'],
+                          meas_type = 'ray',
+                          summary = True)
+
             
     # Creating the measurement ID
     meas_ID = make.meas_id(lr_id = cfg.meas['lidar_id'], time = sig_raw.time)
@@ -90,7 +78,7 @@ def rayleigh(args):
     
     # Checking for radiosonde data
     if args['radiosonde_filename'] == None:
-        nc_path_rs = radiosonde(args, time = sig_raw.time.values)
+        nc_path_rs = radiosonde(args, time = sig_raw.time.values, cfg = cfg)
         args['radiosonde_filename'] = os.path.basename(nc_path_rs)
     else: nc_path_rs = None
         
@@ -128,6 +116,7 @@ def telecover(args):
 
     file_format = args['file_format']
     mcode = args['measurement_identifier']
+    options = reader_options(args)
     
     files_per_sector = args['files_per_sector']
     files_per_ring = args['files_per_ring']
@@ -140,18 +129,18 @@ def telecover(args):
     # Reading of the configuration file    
     cfg = config(path = path_cfg)   
 
-    # Read the files in the dark folder
+    # Read and pre-process the files in the dark folder (shared by all processors)
     sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d  = \
-        read_files.dark(finput_drk = path_drk, file_format = file_format, mcode = mcode)
+        read_dark(args, path_drk = path_drk, meas_type = 'drk')
     
     # Read the files in the telecover folder
     sig_raw, shots, meas_info, channel_info, time_info = \
-        read_files.telecover(finput_sec = path_sec, finput_rin = path_rin, file_format = file_format, mcode = mcode, files_per_sector = files_per_sector, files_per_ring = files_per_ring)
+        read_files.telecover(finput_sec = path_sec, finput_rin = path_rin, file_format = file_format, mcode = mcode, files_per_sector = files_per_sector, files_per_ring = files_per_ring, 
+                             channels = modify.select_channels(cfg, meas_type = 'tlc'), **options)
 
     # Remove channels that should be excluded according to the configuration file
     if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, channel_info_d, cfg = \
-            modify.trim_channels(cfg = cfg, sig = sig_raw_d, shots = shots_d, channel_info = channel_info_d, meas_type = 'drk')
+        cfg.channels = cfg.channels.loc[channel_info_d.index,:]
     
     sig_raw, shots, channel_info, cfg = \
         modify.trim_channels(cfg = cfg, sig = sig_raw, shots = shots, channel_info = channel_info, meas_type = 'tlc')
@@ -164,36 +153,17 @@ def telecover(args):
     # Add default values to the configuration object when the respective variables are not provided in the configuration file
     cfg = modify.fill_defaults(cfg)
 
-    # Screen profiles that have an iregularly low number of shots
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.screen_low_shots(time_info_d, channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    sig_raw = modify.screen_low_shots(time_info, channel_info, signal = sig_raw.copy(), shots = shots)
-
-    # Convert analog channel units to mV (applicable mainly to licel)   
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.unit_conv_bits_to_mV(channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    
-    sig_raw = modify.unit_conv_bits_to_mV(channel_info, signal = sig_raw.copy(), shots = shots)
-
-
-    # Detect and Screen Overflows
+    # Screen profiles that have an iregularly low number of shots, convert analog 
+    # channel units to mV (applicable mainly to licel), and detect and screen overflows
     sig_raw, shots, time_info = \
-        detect_overflows(sig = sig_raw.copy(), 
-                         shots = shots.copy(),
-                         channel_info = cfg.channels,
-                         time_info = time_info,
-                         method = args['trim_overflows'],
-                         meas_type = 'tlc')
+        modify.preprocess(time_info, channel_info, 
+                          cfg_channels = cfg.channels,
+                          signal = sig_raw, 
+                          shots = shots,
+                          method = args['trim_overflows'],
+                          meas_type = 'tlc',
+                          summary = True)
         
-    # Detect and Screen Overflows for the dark
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, time_info_d = \
-            detect_overflows(sig = sig_raw_d.copy(), 
-                             shots = shots_d.copy(),
-                             channel_info = cfg.channels,
-                             time_info = time_info_d,
-                             method = args['trim_overflows'],
-                             meas_type = 'drk')    
     # Creating the measurement ID
     meas_ID = make.meas_id(lr_id = cfg.meas['lidar_id'], time = sig_raw.time)
           
@@ -231,6 +201,7 @@ def polarization_calibration(args):
     
     file_format = args['file_format']
     mcode = args['measurement_identifier']
+    options = reader_options(args)
     
     # Reading of the configuration file    
     cfg = config(path = args['config_file'])   
@@ -239,18 +210,18 @@ def polarization_calibration(args):
     if not args['rayleigh_filename']:
         raise Exception("-- Error: A polarization calibration measurement is being processed but the rayleigh filename was not provided in the arguments! Please prepare the rayleigh file fist and included it with: -l <rayleigh_filename>'")
         
-    # Read the files in the dark folder
+    # Read and pre-process the files in the dark folder (shared by all processors)
     sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d  = \
-        read_files.dark(finput_drk = path_drk, file_format = file_format, mcode = mcode)
-
+        read_dark(args, path_drk = path_drk, meas_type = 'pcl')
+    
     # Read the files in the calibration folder
     sig_raw, shots, meas_info, channel_info, time_info = \
-        read_files.polarization_calibration(finput_p45 = path_p45, finput_m45 = path_m45, finput_stc = path_stc, file_format = file_format, mcode = mcode)
+        read_files.polarization_calibration(finput_p45 = path_p45, finput_m45 = path_m45, finput_stc = path_stc, file_format = file_format, mcode = mcode, 
+                                            channels = modify.select_channels(cfg, meas_type = 'pcl'), **options)
 
     # Remove channels that should be excluded according to the configuration file
     if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, channel_info_d, cfg = \
-            modify.trim_channels(cfg = cfg, sig = sig_raw_d, shots = shots_d, channel_info = channel_info_d, meas_type = 'pcl')
+        cfg.channels = cfg.channels.loc[channel_info_d.index,:]
     
     sig_raw, shots, channel_info, cfg = \
         modify.trim_channels(cfg = cfg, sig = sig_raw, shots = shots, channel_info = channel_info, meas_type = 'pcl')
@@ -263,35 +234,17 @@ def polarization_calibration(args):
     # Add default values to the configuration object when the respective variables are not provided in the configuration file
     cfg = modify.fill_defaults(cfg)
 
-    # Screen profiles that have an iregularly low number of shots
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.screen_low_shots(time_info_d, channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    sig_raw = modify.screen_low_shots(time_info, channel_info, signal = sig_raw.copy(), shots = shots)
-
-    # Convert analog channel units to mV (applicable mainly to licel)   
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d = modify.unit_conv_bits_to_mV(channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    
-    sig_raw = modify.unit_conv_bits_to_mV(channel_info, signal = sig_raw.copy(), shots = shots)
-
-    # Detect and Screen Overflows
+    # Screen profiles that have an iregularly low number of shots, convert analog 
+    # channel units to mV (applicable mainly to licel), and detect and screen overflows
     sig_raw, shots, time_info = \
-        detect_overflows(sig = sig_raw.copy(), 
-                         shots = shots.copy(),
-                         channel_info = cfg.channels,
-                         time_info = time_info,
-                         method = args['trim_overflows'],
-                         meas_type = 'pcl')
+        modify.preprocess(time_info, channel_info, 
+                          cfg_channels = cfg.channels,
+                          signal = sig_raw, 
+                          shots = shots,
+                          method = args['trim_overflows'],
+                          meas_type = 'pcl',
+                          summary = True)
         
-    # Detect and Screen Overflows for the dark
-    if not isinstance(sig_raw_d,list):
-        sig_raw_d, shots_d, time_info_d = \
-            detect_overflows(sig = sig_raw_d.copy(), 
-                             shots = shots_d.copy(),
-                             channel_info = cfg.channels,
-                             time_info = time_info_d,
-                             method = args['trim_overflows'],
-                             meas_type = 'drk')
             
     # Creating the measurement ID
     meas_ID = make.meas_id(lr_id = cfg.meas['lidar_id'], time = sig_raw.time)
@@ -328,41 +281,22 @@ def polarization_calibration(args):
 def dark(args):
    
     path_drk = os.path.join(args['parent_folder'],'drk')
-    file_format = args['file_format']
-    mcode = args['measurement_identifier']
     
     # Reading of the configuration file    
     cfg = config(path = args['config_file'])   
 
-    # Read the files in the dark folder
+    # Read and pre-process the files in the dark folder (shared by all processors)
     sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d  = \
-        read_files.dark(finput_drk = path_drk, file_format = file_format, mcode = mcode)
+        read_dark(args, path_drk = path_drk, meas_type = 'drk')
 
     # Remove channels that should be excluded according to the configuration file
-    sig_raw_d, shots_d, channel_info_d, cfg = \
-        modify.trim_channels(cfg = cfg, sig = sig_raw_d, shots = shots_d, channel_info = channel_info_d, meas_type = 'drk')
-    
+    cfg.channels = cfg.channels.loc[channel_info_d.index,:]
 
     # Add the information from the raw file headers to the configuration object
     cfg = modify.merge_config(cfg = cfg, meas_info = meas_info_d, channel_info = channel_info_d)
 
     # Add default values to the configuration object when the respective variables are not provided in the configuration file
     cfg = modify.fill_defaults(cfg)
-
-    # Screen profiles that have an iregularly low number of shots
-    sig_raw_d = modify.screen_low_shots(time_info_d, channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-
-    # Convert analog channel units to mV (applicable mainly to licel)   
-    sig_raw_d = modify.unit_conv_bits_to_mV(channel_info_d, signal = sig_raw_d.copy(), shots = shots_d)
-    
-    # Detect and Screen Overflows for the dark
-    sig_raw_d, shots_d, time_info_d = \
-        detect_overflows(sig = sig_raw_d.copy(), 
-                         shots = shots_d.copy(),
-                         channel_info = cfg.channels,
-                         time_info = time_info_d,
-                         method = args['trim_overflows'],
-                         meas_type = 'drk')
     
     # Creating the measurement ID
     meas_ID = make.meas_id(lr_id = cfg.meas['lidar_id'], time = sig_raw_d.time)
@@ -389,7 +323,7 @@ def dark(args):
     
     return(nc_path)
 
-def radiosonde(args, time):
+def radiosonde(args, time, cfg = None):
    
     path_rs = args['radiosonde_folder']
     
@@ -399,32 +333,211 @@ def radiosonde(args, time):
     usecols = args['rsonde_column_index']
     units = args['rsonde_column_units']
     geodata = args['rsonde_geodata']
+    resolution = args['rsonde_resolution']
     
     mtime = np.datetime64(time[0] + (time[-1] - time[0]) / 2., 'us').item()
     
+    # Reading radiosonde geodata with the lidar station values if a geodata argument is not provided  
+    if any([geodata_i == None for geodata_i in geodata]):
+        raise Exception("-- Error: The rsonde_geodata field is mandatory when processing a radiosonde file (mode = A and the radiosonde folder exists). Please provide 3 floats that correspond to the radiosonde station latitude, longitude, and altitude eg: --rsonde_geodata 40.5 22.9 60.0")
+
+    # Reading of the configuration file, only if the caller has not done it already
+    if cfg == None:
+        cfg = config(path = args['config_file'])
+    
+    bpath = read_files.nearest_radiosonde(path_rs, mtime = mtime)
+
+    # Creating the radiosonde ID
+    rsonde_ID = f"{bpath[:8]}{cfg.meas['lidar_id']}{bpath[9:13]}"
+    
+    # The same sounding is converted only once with the same settings
+    stat = os.stat(os.path.join(path_rs, bpath))
+    
+    key = [os.path.abspath(os.path.join(path_rs, bpath)), stat.st_size, 
+           stat.st_mtime_ns, list(geodata), list(units), list(usecols), 
+           delimiter, skip_header, skip_footer, resolution]
+    
+    nc_path = os.path.join(args['results_folder'], f'rs_{rsonde_ID}.nc')
+    
+    if os.path.exists(nc_path) and get_sounding_key(nc_path) == key:
+        print(f'-- The radiosonde file {os.path.basename(nc_path)} has already been created from {bpath} and will be reused')
+        print('')
+        return(nc_path)
+    
     date, time, atmo = read_files.radiosonde(path_rs, delimiter = delimiter, 
                                              skip_header = skip_header, 
                                              skip_footer = skip_footer, 
                                              usecols = usecols,
                                              units = units,
                                              mtime = mtime)
-    # Reading of the configuration file    
-    cfg = config(path = args['config_file'])
     
-    # Reading radiosonde geodata with the lidar station values if a geodata argument is not provided  
-    if any([geodata_i == None for geodata_i in geodata]):
-        raise Exception("-- Error: The rsonde_geodata field is mandatory when processing a radiosonde file (mode = A and the radiosonde folder exists). Please provide 3 floats that correspond to the radiosonde station latitude, longitude, and altitude eg: --rsonde_geodata 40.5 22.9 60.0")
+    # Resampling of the high resolution soundings
+    if resolution != None:
+        atmo = modify.regrid_radiosonde(atmo, resolution = resolution)
 
-    # Creating the radiosonde ID
-    rsonde_ID = f"{date}{cfg.meas['lidar_id']}{time[:4]}"
-    
     # Creating the paths and folders
     nc_path = make.path(results_folder = args['results_folder'], meas_ID = rsonde_ID, meas_type = 'rs')
     
     # Making the raw SCC file
     make.radiosonde_file(nc_path = nc_path, date = date, time = time, geodata = geodata, atmo = atmo)
     
+    set_sounding_key(nc_path, key = key)
+    
     print('Succesfully generated a radiosonde file!')
     print('')
     
-    return(nc_path)
\ No newline at end of file
+    return(nc_path)
+
+def get_sounding_key(nc_path):
+    
+    """Returns the sounding file and the settings that the radiosonde file
+    nc_path was created with (see radiosonde). These are kept in a json 
+    file next to the radiosonde files so that they are reused by later
+    measurements, also in separate runs"""
+    
+    path = os.path.join(os.path.dirname(nc_path), '.rs_files.json')
+    
+    if not os.path.exists(path):
+        return(None)
+    
+    try:
+        with open(path, 'r') as f:
+            keys = json.load(f)
+    except Exception:
+        return(None)
+    
+    return(keys.get(os.path.basename(nc_path)))
+
+def set_sounding_key(nc_path, key):
+    
+    """Stores the sounding file and the settings of the radiosonde file
+    nc_path, see get_sounding_key"""
+
+    path = os.path.join(os.path.dirname(nc_path), '.rs_files.json')
+    
+    keys = dict()
+    
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                keys = json.load(f)
+        except Exception:
+            keys = dict()
+        
+    keys[os.path.basename(nc_path)] = key
+    
+    with open(path, 'w') as f:
+        json.dump(keys, f, indent = 1)
+
+    return()
+
+# Dark measurements of the run, read once and pre-processed once per 
+# channel selection, shared by all the processors (see read_dark). Cleared
+# at the end of each run (see clear_darks)
+_darks = dict()
+
+def clear_darks():
+    
+    """Releases the dark measurements of the run, so that a later run in the 
+    same process reads the dark folder again"""
+    
+    _darks.clear()
+    
+    return()
+
+def read_dark(args, path_drk, meas_type):
+    
+    """Reads and pre-processes the files in the dark folder: channel trimming
+    for the given meas_type, low shot screening, unit conversion to mV, and
+    overflow handling. The files are read once per run and pre-processed 
+    once per channel selection, so the rayleigh, telecover, and 
+    polarization calibration processors get the same arrays. These are 
+    shared and must not be modified by the processors. Returns the same 
+    output as read_files.dark (empty lists if there are no dark files)"""
+
+    cfg = config(path = args['config_file'])   
+
+    options = reader_options(args)
+    
+    key = (path_drk, args['file_format'], args['measurement_identifier'],
+           args['trim_overflows'], tuple(sorted(options.items())))
+    
+    if key not in _darks.keys():
+        _darks[key] = dict()
+        
+        # All the channels of the configuration file are read
+        _darks[key]['raw'] = \
+            read_files.dark(finput_drk = path_drk, 
+                            file_format = args['file_format'], 
+                            mcode = args['measurement_identifier'], 
+                            channels = modify.select_channels(cfg, meas_type = 'drk'), 
+                            **options)
+    else:
+        print(f'-- Using the dark files already read from folder {path_drk}')
+        
+    darks = _darks[key]
+    
+    sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d = darks['raw']
+
+    if isinstance(sig_raw_d,list):
+        return(darks['raw'])
+    
+    channels = tuple(modify.select_channels(cfg, meas_type = meas_type))
+    
+    if channels not in darks.keys():
+        
+        # Remove channels that should be excluded according to the configuration file
+        sig_raw_d, shots_d, channel_info_d, cfg = \
+            modify.trim_channels(cfg = cfg, sig = sig_raw_d, shots = shots_d, channel_info = channel_info_d, meas_type = meas_type)
+        
+        # The raw dark is kept for the other channel selections
+        if isinstance(sig_raw_d.data, np.ndarray) and \
+            np.may_share_memory(sig_raw_d.data, darks['raw'][0].data):
+            sig_raw_d = sig_raw_d.copy()
+            
+        if np.may_share_memory(shots_d.values, darks['raw'][1].values):
+            shots_d = shots_d.copy()
+        
+        # The overflow thresholds are taken from the configuration file or else from the raw file headers
+        cfg = modify.merge_config(cfg = cfg, meas_info = meas_info_d, channel_info = channel_info_d)
+        
+        cfg = modify.fill_defaults(cfg)
+        
+        # Screen profiles that have an iregularly low number of shots, convert analog 
+        # channel units to mV (applicable mainly to licel), and detect and screen overflows
+        sig_raw_d, shots_d, time_info_d = \
+            modify.preprocess(time_info_d, channel_info_d, 
+                              cfg_channels = cfg.channels,
+                              signal = sig_raw_d, 
+                              shots = shots_d,
+                              method = args['trim_overflows'],
+                              meas_type = 'drk',
+                              summary = True)
+        
+        # Read only from now on, shared by the processors
+        for arr in [sig_raw_d.data, shots_d.values]:
+            if isinstance(arr, np.ndarray):
+                arr.setflags(write = False)
+        
+        darks[channels] = (sig_raw_d, shots_d, meas_info_d, channel_info_d, time_info_d)
+    
+    return(darks[channels])
+
+def reader_options(args):
+    
+    """Collects the command line arguments that are passed to the raw file
+    reader (e.g. read_licel.dtfs) as keyword arguments"""
+    
+    options = {'workers' : args['workers'],
+               'executor' : args['executor'],
+               'use_mmap' : args['mmap'],
+               'cache_dir' : args['cache_dir'],
+               'cache_size' : args['cache_size'],
+               'max_bins' : args['max_bins'],
+               'max_range' : args['max_range'],
+               'compact' : args['compact'],
+               'lazy' : args['lazy'],
+               'chunk_size' : args['chunk_size'],
+               'layout' : args['layout']}
+    
+    return(options)
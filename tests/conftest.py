@@ -0,0 +1,7 @@
+"""
+The modules of the converter are imported as in program/__scc_convert__.py
+(from readers import ..., from tools import ...)
+"""
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'program'))
@@ -0,0 +1,20 @@
+"""
+Paths inside archives (archive)
+"""
+import os, zipfile
+import pytest
+from readers import archive
+
+@pytest.mark.parametrize('top', ['', '20220617/'])
+def test_top_folder(tmp_path, top):
+
+    path_arc = os.path.join(tmp_path, 'meas.zip')
+
+    with zipfile.ZipFile(path_arc, 'w') as zf:
+        zf.writestr(f'{top}drk/ID22617.0000', b'dark')
+        zf.writestr(f'{top}drk/ID22617.0001', b'dark')
+
+    # The measurement folder is kept, the date folder is skipped
+    assert archive.exists(os.path.join(path_arc, 'drk'))
+    assert archive.listdir(path_arc) == ['drk']
+    assert archive.read(os.path.join(path_arc, 'drk', 'ID22617.0001')) == b'dark'
@@ -0,0 +1,24 @@
+"""
+The resampling of the radiosonde profiles (modify.regrid_radiosonde)
+"""
+import numpy as np
+import xarray as xr
+from tools import modify
+
+def test_regrid_radiosonde_keeps_surface():
+
+    alt = np.array([61., 102., 150., 150., 420., 774.])
+
+    data = np.array([[1005., 294.5, 65.],
+                     [1000., 294.2, 60.],
+                     [994.5, 293.9, 58.],
+                     [994.5, 293.9, 58.],
+                     [963., 292.0, 55.],
+                     [925., 289.3, 50.]])
+
+    atmo = xr.DataArray(data, coords = [alt, ['P', 'T', 'RH']], dims = ['height', 'parameters'])
+
+    atmo_grid = modify.regrid_radiosonde(atmo, resolution = 100.)
+
+    np.testing.assert_allclose(atmo_grid.height.values, 61. + 100. * np.arange(8))
+    np.testing.assert_allclose(atmo_grid.values[0, :], data[0, :])
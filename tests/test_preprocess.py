@@ -0,0 +1,89 @@
+"""
+The fused pre-processing (modify.preprocess) against the separate steps
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+from tools import modify
+from tools.automate import detect_overflows
+
+def make_measurement(dtype = float, n_time = 40, n_bins = 500, seed = 1):
+
+    rng = np.random.default_rng(seed)
+
+    channels = np.array(['00355o_L1', 'BC0355o_L1', '00532p_L1', 'BC0532p_L1'], dtype = object)
+
+    time = np.datetime64('2022-06-17T20:00:00') + np.arange(n_time).astype('timedelta64[m]')
+
+    channel_info = pd.DataFrame({'acquisition_mode' : [0., 1., 0., 1.],
+                                 'data_acquisition_range' : [500., np.nan, 100., np.nan],
+                                 'analog_to_digital_resolution' : [16., np.nan, 12., np.nan]},
+                                index = channels)
+
+    shots_arr = np.full((n_time, channels.size), 1000.)
+    shots_arr[[3, 17], :] = 500.
+
+    # Bits for analog and counts for photon channels, a few overflows in both
+    sig_arr = rng.uniform(1., 2.**15 * 0.9, size = (n_time, channels.size, n_bins))
+    sig_arr[:, 0, :] = sig_arr[:, 0, :] * 1000. 
+    sig_arr[5, 1, 100:104] = 2.**15
+    sig_arr[9, 0, 7] = 0.
+
+    sig = xr.DataArray(sig_arr.astype(dtype), coords = [time, channels, np.arange(1., n_bins + 1.)],
+                       dims = ['time', 'channel', 'bins'])
+
+    shots = xr.DataArray(shots_arr, coords = [time, channels], dims = ['time', 'channel'])
+
+    time_info = pd.DataFrame({'filename' : [f'ID{k:04d}' for k in range(n_time)]}, index = time)
+
+    return(sig, shots, channel_info, time_info)
+
+@pytest.mark.parametrize('dtype', [float, np.float32])
+@pytest.mark.parametrize('method', [1, 2, 3])
+def test_preprocess_matches_separate_steps(dtype, method):
+
+    sig, shots, channel_info, time_info = make_measurement(dtype = dtype)
+
+    sig_ref, shots_ref = sig.copy(), shots.copy()
+
+    sig_ref = modify.screen_low_shots(time_info, channel_info, signal = sig_ref, shots = shots_ref)
+    sig_ref = modify.unit_conv_bits_to_mV(channel_info, signal = sig_ref, shots = shots_ref)
+    sig_ref, shots_ref, time_info_ref = \
+        detect_overflows(sig = sig_ref, shots = shots_ref, channel_info = channel_info,
+                         time_info = time_info, meas_type = 'ray', method = method)
+
+    sig_out, shots_out, time_info_out = \
+        modify.preprocess(time_info, channel_info, cfg_channels = channel_info,
+                          signal = sig, shots = shots, meas_type = 'ray',
+                          method = method, block_size = 3000)
+
+    assert sig_out.dtype == sig_ref.dtype
+    np.testing.assert_array_equal(sig_out.values, sig_ref.values)
+    np.testing.assert_array_equal(shots_out.values, shots_ref.values)
+    np.testing.assert_array_equal(sig_out.time.values, sig_ref.time.values)
+    assert time_info_out.equals(time_info_ref)
+
+def test_preprocess_lazy_matches_eager():
+
+    pytest.importorskip('dask')
+
+    sig, shots, channel_info, time_info = make_measurement()
+
+    # A profile with more overflows than can be interpolated (max_bins)
+    sig[12, 1, 200:320] = 2.**15
+
+    sig_eager, shots_eager, time_info_eager = \
+        modify.preprocess(time_info, channel_info, cfg_channels = channel_info,
+                          signal = sig.copy(), shots = shots.copy(), 
+                          meas_type = 'ray', method = 2)
+
+    sig_lazy, shots_lazy, time_info_lazy = \
+        modify.preprocess(time_info, channel_info, cfg_channels = channel_info,
+                          signal = sig.chunk({'time' : 8}), shots = shots.copy(), 
+                          meas_type = 'ray', method = 2)
+
+    assert not isinstance(sig_lazy.data, np.ndarray)
+    assert np.isnan(sig_eager.values[12, 1, 200:320]).all()
+    np.testing.assert_allclose(sig_lazy.values, sig_eager.values, rtol = 1E-12)
+    np.testing.assert_array_equal(shots_lazy.values, shots_eager.values)
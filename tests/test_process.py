@@ -0,0 +1,102 @@
+"""
+The dark of the run that is shared by the processors (process.read_dark)
+"""
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+from tools import process, automate
+from test_preprocess import make_measurement
+
+class Config:
+
+    def __init__(self):
+
+        self.channels = pd.DataFrame({'channel_type' : ['p', 'p', 't', 't']},
+                                     index = ['00355o_L1', 'BC0355o_L1', '00532p_L1', 'BC0532p_L1'])
+
+        self.meas = pd.Series({'lidar_id' : 'tst'}, dtype = object)
+
+args = {'config_file' : 'config.ini', 'file_format' : 'licel',
+        'measurement_identifier' : 'ID', 'trim_overflows' : 2,
+        'workers' : 1, 'executor' : 'thread', 'mmap' : False,
+        'cache_dir' : None, 'cache_size' : 2048., 'max_bins' : None,
+        'max_range' : None, 'compact' : False, 'lazy' : False,
+        'chunk_size' : 100, 'layout' : None}
+
+@pytest.fixture
+def raw(monkeypatch):
+
+    sig, shots, channel_info, time_info = make_measurement(n_time = 200, n_bins = 2000)
+
+    channel_info.loc[:, 'laser'] = 1.
+
+    meas_info = pd.Series({'laser_A_repetition_rate' : 10.})
+
+    raw = (sig, shots, meas_info, channel_info, time_info)
+
+    calls = []
+
+    def dark(**kwargs):
+        calls.append(kwargs)
+        return(raw)
+
+    monkeypatch.setattr(process, 'config', lambda path: Config())
+    monkeypatch.setattr(process.read_files, 'dark', dark)
+    monkeypatch.setattr(process, '_darks', dict())
+    monkeypatch.setattr(automate, '_summary', dict())
+
+    return(raw, calls)
+
+def test_read_dark_is_shared_and_read_only(raw):
+
+    (sig, shots, meas_info, channel_info, time_info), calls = raw
+
+    sig_before, shots_before = sig.values.copy(), shots.values.copy()
+
+    dark_ray = process.read_dark(args, path_drk = 'drk', meas_type = 'ray')
+
+    dark_pcl = process.read_dark(args, path_drk = 'drk', meas_type = 'pcl')
+
+    # Read once, pre-processed once per channel selection
+    assert len(calls) == 1
+    assert process.read_dark(args, path_drk = 'drk', meas_type = 'ray')[0] is dark_ray[0]
+    assert list(dark_pcl[0].channel.values) == ['00355o_L1', 'BC0355o_L1']
+
+    # The cached raw dark is not modified by the pre-processing
+    np.testing.assert_array_equal(sig.values, sig_before)
+    np.testing.assert_array_equal(shots.values, shots_before)
+
+    for dark in [dark_ray, dark_pcl]:
+        assert not dark[0].values.flags.writeable
+        assert not dark[1].values.flags.writeable
+        with pytest.raises(ValueError):
+            dark[0].values[0, 0, 0] = 0.
+
+def test_read_dark_memory(raw):
+
+    sig = raw[0][0]
+
+    tracemalloc.start()
+
+    try:
+        process.read_dark(args, path_drk = 'drk', meas_type = 'ray')
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # A single copy of the raw dark, the pre-processing works in place
+    assert peak < 1.5 * sig.nbytes
+
+def test_clear_darks(raw):
+
+    calls = raw[1]
+
+    process.read_dark(args, path_drk = 'drk', meas_type = 'ray')
+
+    process.clear_darks()
+
+    process.read_dark(args, path_drk = 'drk', meas_type = 'ray')
+
+    # A new run reads the dark folder again
+    assert len(calls) == 2
@@ -0,0 +1,26 @@
+"""
+The radiosonde text files (read_files.read_sounding)
+"""
+import os
+import numpy as np
+from readers import read_files
+
+def test_read_sounding_comments_and_missing_values(tmp_path):
+
+    path = os.path.join(tmp_path, '20220617_1200_sounding.txt')
+
+    with open(path, 'w') as f:
+        f.write('Station 16622\n'
+                'PRES HGHT TEMP RELH\n'
+                '1005.0 60 21.4 65\n'
+                '# Tropopause\n'
+                '1000.0 102 // 60\n'
+                '925.0 774 16.2 //  # Missing humidity\n'
+                'End of sounding\n\n')
+
+    data = read_files.read_sounding(path, delimiter = 'S', skip_header = 2,
+                                    skip_footer = 1, usecols = [2, 1, 3, 4])
+
+    np.testing.assert_array_equal(data, [[60., 1005., 21.4, 65.],
+                                         [102., 1000., np.nan, 60.],
+                                         [774., 925., 16.2, np.nan]])
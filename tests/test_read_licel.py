@@ -0,0 +1,149 @@
+"""
+The licel decoder (read_licel) against the original per bin decoder on a
+small generated licel folder
+"""
+import os
+from datetime import datetime as dt
+import numpy as np
+import pytest
+from readers import read_licel
+
+# Channel rows: active, mode, laser, bins, laser polarization, high voltage,
+# resolution, wavelength.polarization, 4 x unknown, ADC bits, shots, range, ID
+channel_rows = [' 1 0 1 300 1 0750 7.50 00355.o 0 0 00 000 12 001200 0.500 BT0 ',
+                ' 1 1 1 300 1 0750 7.50 00355.o 0 0 00 000 00 001200 3.1746 BC0 ',
+                ' 1 0 1 200 1 0800 7.50 00532.p 0 0 00 000 16 001200 0.100 BT1 ',
+                ' 1 1 1 250 1 0800 7.50 00532.p 0 0 00 000 00 001200 3.1746 BC1 ']
+
+channel_bins = [300, 300, 200, 250]
+
+def make_file(path, start, end, shots, seed, rows = channel_rows):
+
+    rng = np.random.default_rng(seed)
+
+    bins = [int(row.split()[3]) for row in rows]
+
+    rows = [row.replace('001200', f'{shots:06d}') for row in rows]
+
+    header = [f' {os.path.basename(path)}',
+              f' Thessaloniki {start:%d/%m/%Y %H:%M:%S} {end:%d/%m/%Y %H:%M:%S} 0060 0040.6 0022.9 00 000',
+              ' 0001200 0010 0000000 0010 04 0000000 0000'] + rows
+
+    body = [rng.integers(0, 2**32, size = nbins, dtype = np.uint64).astype('<u4').tobytes()
+            for nbins in bins]
+
+    # The header ends with an empty line, each data block with \r\n
+    buffer = ('\r\n'.join(header) + '\r\n\r\n').encode('utf-8') + \
+        b''.join([block + b'\r\n' for block in body])
+
+    with open(path, 'wb') as f:
+        f.write(buffer)
+
+    return(buffer)
+
+@pytest.fixture
+def folder(tmp_path):
+
+    # The file names are not in time order, the files are sorted by end time
+    starts = [dt(2022, 6, 17, 20, minute) for minute in [3, 0, 2, 1, 4]]
+
+    for k, start in enumerate(starts):
+        make_file(os.path.join(tmp_path, f'ID22617.{k:04d}'), start = start,
+                  end = start.replace(second = 59), shots = 1200 - k, seed = k)
+
+    return(str(tmp_path))
+
+def read_body_loop(bins, buffer, sep):
+
+    """ The original decoder, one int.from_bytes call per bin"""
+
+    data = buffer[sep+4:]
+
+    sig_raw_arr = np.nan*np.zeros((len(bins), max(bins)))
+
+    nbin_s = 0
+    for j in range(len(bins)):
+        nbin_e = nbin_s + 4*bins[j]
+        icount = 0
+        for i in range(nbin_s, nbin_e, 4):
+            sig_raw_arr[j,icount] = int.from_bytes(data[i:i+4], byteorder = 'little')
+            icount = icount + 1
+        nbin_s = nbin_e + 2
+
+    return(sig_raw_arr)
+
+def read_folder_loop(folder):
+
+    """ The folder decoded file by file with the original decoder and sorted
+    by end time"""
+
+    fnames = sorted(os.listdir(folder))
+
+    sig = []
+    shots = []
+    start_time = []
+    end_time = []
+
+    for fname in fnames:
+        with open(os.path.join(folder, fname), 'rb') as f:
+            buffer = f.read()
+        sep = read_licel.find_sep(buffer)
+        header = str(buffer[0:sep-1], encoding = "utf-8").split("\r\n")
+        geodata = header[1].split()
+        start_time.append(np.datetime64(dt.strptime(geodata[1] + ' ' + geodata[2], "%d/%m/%Y %H:%M:%S"), 'ms'))
+        end_time.append(np.datetime64(dt.strptime(geodata[3] + ' ' + geodata[4], "%d/%m/%Y %H:%M:%S"), 'ms'))
+        shots.append([float(line[1:].split()[13]) for line in header[3:]])
+        sig.append(read_body_loop(channel_bins, buffer = buffer, sep = sep))
+
+    order = np.argsort(end_time)
+
+    return(np.array(fnames)[order], np.array(start_time)[order],
+           np.array(end_time)[order], np.array(shots)[order], np.array(sig)[order])
+
+def test_read_body_matches_loop(folder):
+
+    for fname in os.listdir(folder):
+
+        with open(os.path.join(folder, fname), 'rb') as f:
+            buffer = f.read()
+
+        head = read_licel.parse_header(buffer)
+
+        blocks = read_licel.read_body(head['bins'], buffer = buffer, sep = head['sep'])
+
+        sig_ref = read_body_loop(channel_bins, buffer = buffer, sep = head['sep'])
+
+        for j in range(len(channel_bins)):
+            assert blocks[j].dtype == np.dtype('<u4')
+            np.testing.assert_array_equal(blocks[j].astype(float), sig_ref[j, :channel_bins[j]])
+
+@pytest.mark.parametrize('options', [{}, {'workers' : 2}, {'use_mmap' : True}])
+def test_dtfs_matches_loop(folder, options):
+
+    fnames, start_time, end_time, shots_ref, sig_ref = read_folder_loop(folder)
+
+    meas_info, channel_info, time_info, sig, shots = \
+        read_licel.dtfs(folder, mcode = 'ID', **options)
+
+    assert list(channel_info.index) == ['BT0_L1', 'BC0_L1', 'BT1_L1', 'BC1_L1']
+    np.testing.assert_array_equal(time_info.filename.values, fnames)
+    np.testing.assert_array_equal(time_info.start_time.values, start_time)
+    np.testing.assert_array_equal(time_info.end_time.values, end_time)
+    np.testing.assert_array_equal(sig.time.values, end_time)
+    np.testing.assert_array_equal(shots.values, shots_ref)
+    np.testing.assert_array_equal(sig.values, sig_ref)
+
+def test_dtfs_buffers_matches_dtfs(folder):
+
+    buffers = []
+    for fname in os.listdir(folder):
+        with open(os.path.join(folder, fname), 'rb') as f:
+            buffers.append((fname, f.read()))
+
+    time_info, sig, shots = read_licel.dtfs(folder, mcode = 'ID')[2:]
+
+    time_info_b, sig_b, shots_b = read_licel.dtfs_buffers(buffers)[2:]
+
+    np.testing.assert_array_equal(time_info_b.filename.values, time_info.filename.values)
+    np.testing.assert_array_equal(shots_b.values, shots.values)
+    np.testing.assert_array_equal(sig_b.values, sig.values)
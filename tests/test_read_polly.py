@@ -0,0 +1,114 @@
+"""
+The PollyXT reader (read_polly) through read_files on small synthetic
+PollyXT NetCDF files
+"""
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+from readers import read_files, read_polly
+from tools import modify
+
+n_height = 100
+
+# Calibrator angle per profile of each file
+angles = [[0., 0., 45., -45., 0.], [0., 45., -45., 0., 0.]]
+
+def make_file(path, angle, t0, seed):
+
+    rng = np.random.default_rng(seed)
+
+    n_time = len(angle)
+
+    n_channels = len(read_polly.raw_channels)
+
+    ds = xr.Dataset({'raw_signal' : (('time', 'height', 'channel'),
+                                     rng.integers(0, 1000, size = (n_time, n_height, n_channels)).astype('int32')),
+                     'measurement_shots' : (('time', 'channel'), np.full((n_time, n_channels), 600, dtype = 'int32')),
+                     'measurement_time' : (('time', 'date_time'),
+                                           np.array([[20220617, t0 + 30 * k] for k in range(n_time)], dtype = 'int32')),
+                     'depol_cal_angle' : (('time',), np.array(angle)),
+                     'laser_rep_rate' : ((), 20.),
+                     'location_height' : ((), 60.),
+                     'location_coordinates' : (('coordinates',), np.array([40.6, 22.9])),
+                     'zenithangle' : ((), 5.),
+                     'pm_voltage' : (('channel',), np.full(n_channels, 800.)),
+                     'if_center' : (('channel',), np.array([355, 355, 387, 407, 532, 532, 607, 1064, 532, 607, 355, 387], dtype = float))})
+
+    ds.to_netcdf(path)
+
+    return(ds)
+
+@pytest.fixture
+def folder(tmp_path):
+
+    for k, angle in enumerate(angles):
+        make_file(os.path.join(tmp_path, f'2022_06_17_Fri_TROPOS_{k:02d}_00_01.nc'),
+                  angle = angle, t0 = 72000 + 3600 * k, seed = k)
+
+    return(str(tmp_path))
+
+class Config:
+
+    """ The channel section as in read_config, indexed by channel_id_Llaser"""
+
+    def __init__(self, channel_id):
+
+        self.channels = pd.DataFrame({'channel_id' : channel_id,
+                                      'laser' : np.ones(len(channel_id), dtype = int),
+                                      'channel_type' : ['p', 'c', 't']},
+                                     index = [f'{channel_id_i}_L1' for channel_id_i in channel_id])
+
+def test_rayleigh_with_config_channels(folder):
+
+    cfg = Config(['355_total', '355_cross', '387'])
+
+    channels = modify.select_channels(cfg, meas_type = 'ray')
+
+    sig, shots, meas_info, channel_info, time_info = \
+        read_files.rayleigh(finput_ray = folder, mcode = '', file_format = 'polly_xt',
+                            channels = channels, max_bins = 80)
+
+    assert list(sig.channel.values) == list(channels)
+    assert list(channel_info.index) == list(channels)
+    assert list(channel_info.channel_id) == ['355_total', '355_cross', '387']
+    assert sig.shape == (6, 3, 80)
+    assert (np.diff(time_info.index.values) > np.timedelta64(0)).all()
+
+    # No channel is dropped by the channel trimming of the processors
+    sig_t, shots_t, channel_info_t, cfg = \
+        modify.trim_channels(cfg = cfg, sig = sig, shots = shots,
+                             channel_info = channel_info, meas_type = 'ray')
+
+    assert list(sig_t.channel.values) == list(channels)
+
+def test_polarization_calibration_with_config_channels(folder):
+
+    cfg = Config(['355_total', '355_cross', '387'])
+
+    channels = modify.select_channels(cfg, meas_type = 'pcl')
+
+    sig, shots, meas_info, channel_info, time_info = \
+        read_files.polarization_calibration(finput_p45 = folder, finput_m45 = folder,
+                                            finput_stc = os.path.join(folder, 'stc'),
+                                            mcode = '', file_format = 'polly_xt',
+                                            channels = channels)
+
+    assert list(sig.channel.values) == ['355_total_L1', '355_cross_L1']
+    assert sorted(time_info.position.values) == [1, 1, 2, 2]
+
+def test_signals_match_files(folder):
+
+    sig, shots = read_files.rayleigh(finput_ray = folder, mcode = '', 
+                                     file_format = 'polly_xt')[:2]
+
+    # The profiles are already in time order in the files
+    sig_ref = []
+    for fname in sorted(os.listdir(folder)):
+        with xr.open_dataset(os.path.join(folder, fname)) as ds:
+            ds = ds.isel(time = np.where(ds.depol_cal_angle.values == 0.)[0])
+            sig_ref.append(ds.raw_signal.transpose('time', 'channel', 'height').values)
+
+    np.testing.assert_array_equal(sig.values, np.concatenate(sig_ref).astype(float))
+    assert (shots.values == 600.).all()
@@ -0,0 +1,71 @@
+"""
+The conversion of a folder with several channel layouts (--split_layouts)
+"""
+import os
+from datetime import datetime as dt
+import pytest
+import __scc_convert__
+from tools import process
+from test_read_licel import make_file, channel_rows
+
+@pytest.fixture
+def args(tmp_path):
+
+    # Two channel layouts in the same folders, the second one later in time
+    for folder in ['ray', 'p45', 'm45']:
+        os.makedirs(os.path.join(tmp_path, folder))
+        for k in range(4):
+            start = dt(2022, 6, 17, 20, k)
+            make_file(os.path.join(tmp_path, folder, f'ID22617.{k:04d}'), start = start,
+                      end = start.replace(second = 59), shots = 1200, seed = k,
+                      rows = channel_rows if k < 2 else channel_rows[:2])
+
+    args = {'rayleigh_folder' : os.path.join(tmp_path, 'ray'),
+            'pol_cal_p45_folder' : os.path.join(tmp_path, 'p45'),
+            'pol_cal_m45_folder' : os.path.join(tmp_path, 'm45'),
+            'pol_cal_stc_folder' : os.path.join(tmp_path, 'stc'),
+            'dark_folder' : os.path.join(tmp_path, 'drk'),
+            'telecover_sectors_folder' : os.path.join(tmp_path, 'tlc'),
+            'telecover_rings_folder' : os.path.join(tmp_path, 'tlc_rin'),
+            'results_folder' : os.path.join(tmp_path, 'out'),
+            'measurement_identifier' : 'ID', 'mode' : 'A', 'workers' : 1,
+            'layout' : None, 'split_layouts' : True,
+            'rayleigh_filename' : None, 'radiosonde_filename' : None}
+
+    return(args)
+
+def test_split_layouts(args, monkeypatch):
+
+    calls = []
+
+    def rayleigh(args):
+        calls.append(('rayleigh', args['layout'], args['radiosonde_filename']))
+        nc_path_rs = None
+        if args['radiosonde_filename'] == None:
+            nc_path_rs = os.path.join(args['results_folder'], f"rs_{args['layout']}.nc")
+        return([os.path.join(args['results_folder'], f"ray_{args['layout']}.nc"), nc_path_rs])
+
+    def polarization_calibration(args):
+        calls.append(('polarization_calibration', args['layout'], args['rayleigh_filename']))
+        return(os.path.join(args['results_folder'], f"pcl_{args['layout']}.nc"))
+
+    monkeypatch.setattr(process, 'rayleigh', rayleigh)
+    monkeypatch.setattr(process, 'polarization_calibration', polarization_calibration)
+
+    fnames = __scc_convert__.main(args)
+
+    layouts = [call[1] for call in calls if call[0] == 'rayleigh']
+
+    assert len(layouts) == 2 and layouts[0] != layouts[1]
+
+    # The radiosonde file is created once, by the first layout
+    assert calls[:2] == [('rayleigh', layouts[0], None),
+                         ('rayleigh', layouts[1], f'rs_{layouts[0]}.nc')]
+    assert fnames[f'radiosonde_{layouts[0]}'].endswith(f'rs_{layouts[0]}.nc')
+    assert f'radiosonde_{layouts[1]}' not in fnames.keys()
+
+    # Each polarization calibration refers to the rayleigh file of its layout
+    assert calls[2:] == [('polarization_calibration', layout, f'ray_{layout}.nc')
+                         for layout in layouts]
+
+    assert args['layout'] == None